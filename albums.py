@@ -0,0 +1,80 @@
+# coding: utf-8
+"""
+Сборка альбомов: Telegram присылает каждый элемент media group отдельным апдейтом.
+Буфер копит элементы по (отправитель, media_group_id) и отдаёт альбом целиком —
+после window секунд без новых элементов или сразу по достижении max_items.
+"""
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_ALBUM_ITEMS = 10  # лимит Telegram для sendMediaGroup
+
+
+class AlbumBuffer:
+    def __init__(self, flush, window=0.8, max_items=MAX_ALBUM_ITEMS):
+        """flush(messages) — корутина, получает элементы альбома по порядку message_id."""
+        self.flush = flush
+        self.window = window
+        self.max_items = max_items
+        self._albums = {}    # (uid, media_group_id) -> [messages, TimerHandle]
+        self._running = {}   # uid -> {task} — альбомы, которые уже отправляются
+
+    def pending(self):
+        return len(self._albums)
+
+    def add(self, message):
+        key = (message.from_user.id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = [[], None]
+        elif album[1] is not None:
+            album[1].cancel()
+        album[0].append(message)
+        if len(album[0]) >= self.max_items:
+            self._fire(key)
+        else:
+            album[1] = asyncio.get_running_loop().call_later(self.window, self._fire, key)
+
+    def _fire(self, key):
+        album = self._albums.pop(key, None)
+        if album is None:
+            return None
+        if album[1] is not None:
+            album[1].cancel()
+        messages = sorted(album[0], key=lambda m: m.message_id)
+        task = asyncio.ensure_future(self._run(messages))
+        tasks = self._running.setdefault(key[0], set())
+        tasks.add(task)
+        task.add_done_callback(lambda t, uid=key[0]: self._done(uid, t))
+        return task
+
+    def _done(self, uid, task):
+        tasks = self._running.get(uid)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self._running[uid]
+
+    async def _run(self, messages):
+        try:
+            await self.flush(messages)
+        except Exception:
+            logger.exception("Album flush failed (%d items)", len(messages))
+
+    async def flush_sender(self, uid:int):
+        """Отправляет недособранные альбомы uid и ждёт их — чтобы следующее сообщение не обогнало альбом."""
+        for key in [k for k in self._albums if k[0] == uid]:
+            self._fire(key)
+        tasks = self._running.get(uid)
+        if tasks:
+            await asyncio.wait(set(tasks))
+
+    async def close(self):
+        for key in list(self._albums):
+            self._fire(key)
+        tasks = {t for tasks in self._running.values() for t in tasks}
+        if tasks:
+            await asyncio.wait(tasks)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Пропускная способность кластера (cluster.py) в зависимости от числа воркеров.
+Против заглушки Bot API (loadtest/fake_api.py) запускается `python cluster.py` с WORKERS=1, 2, 4...;
+в БД заранее созданы пары, половина из которых разнесена по разным воркерам. Меряем,
+сколько сообщений в секунду доходит до собеседника, и проверяем адресата и порядок.
+
+    python bench/bench_cluster.py --workers 1 2 4 --pairs 500 --messages 20000 --latency 0.02
+"""
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from storage import connect
+from migrations import migrate
+from loadtest.fake_api import FakeBotAPI
+
+TOKEN = "123456789:AAHfakeTokenForLoadTestingOnly000000"
+BASE_UID = 10 ** 6
+
+
+def make_pairs(path, pairs):
+    """Пары по четвёркам id: (a, a+1) — соседи, (a, a+2) — через одного; шард = uid % N."""
+    migrate(path)
+    partner = {}
+    uids = list(range(BASE_UID, BASE_UID + 2 * pairs))
+    for group, i in enumerate(range(0, len(uids) - 3, 4)):
+        a, b, c, d = uids[i:i + 4]
+        group_pairs = ((a, b), (c, d)) if group % 2 else ((a, c), (b, d))
+        for x, y in group_pairs:
+            partner[x], partner[y] = y, x
+    conn = connect(path)
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO users (id, username, name, partner, created_at) VALUES (?, ?, ?, ?, '')",
+                     ((u, f"user{u}", f"u{u}", p) for u, p in partner.items()))
+    conn.execute("COMMIT")
+    conn.close()
+    return partner
+
+
+class Delivery:
+    def __init__(self, partner):
+        self.partner = partner
+        self.delivered = 0
+        self.misrouted = 0
+        self.reordered = 0
+        self._last_seq = {}
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    def __call__(self, method, params):
+        if method != 'sendMessage':
+            return
+        text = str(params.get('text', ''))
+        if not text.startswith('bm '):
+            return
+        _, sender, seq = text.split()
+        sender, seq = int(sender), int(seq)
+        if self.partner.get(sender) != int(params['chat_id']):
+            self.misrouted += 1
+        if seq < self._last_seq.get(sender, -1):
+            self.reordered += 1
+        self._last_seq[sender] = seq
+        self.delivered += 1
+        if self.delivered >= self.expected:
+            self.done.set()
+
+
+def message(uid, text, n):
+    return {"message": {"message_id": n, "date": int(time.time()), "text": text,
+                        "from": {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"},
+                        "chat": {"id": uid, "type": "private", "first_name": f"u{uid}"}}}
+
+
+async def run_once(workers, args):
+    tmp = tempfile.mkdtemp(prefix="bench-cluster-")
+    db = os.path.join(tmp, "bot.db")
+    partner = make_pairs(db, args.pairs)
+    cross = sum(1 for a, b in partner.items() if a % workers != b % workers) / len(partner)
+
+    api = FakeBotAPI(latency=args.latency)
+    delivery = Delivery(partner)
+    api.listeners.append(delivery)
+    url = await api.start('127.0.0.1', args.port)
+    env = dict(os.environ, TOKEN=TOKEN, ADMIN_ID="1", BOT_API_SERVER=url, BOT_DB_PATH=db,
+               BOT_LOG=os.path.join(tmp, "bot.log"), WORKERS=str(workers), WORKER_SOCKET_DIR=tmp, POLL_TIMEOUT="1",
+               MSG_RATE_LIMIT_PER_MIN="1000000", OUTBOUND_GLOBAL_RATE=str(1e6 * workers),
+               OUTBOUND_CHAT_RATE="1000000", OUTBOUND_WORKERS=str(args.outbound_workers))
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "cluster.py")], env=env)
+    try:
+        # прогрев: по сообщению от каждого пользователя (старт воркеров, профили в БД)
+        senders = list(partner)
+        delivery.expected = len(senders)
+        for n, uid in enumerate(senders):
+            api.push_update(message(uid, f"bm {uid} 0", n))
+        await asyncio.wait_for(delivery.done.wait(), args.timeout)
+
+        delivery.done.clear()
+        delivery.delivered = 0
+        delivery.expected = args.messages
+        started = time.perf_counter()
+        for n in range(args.messages):
+            uid = senders[n % len(senders)]
+            api.push_update(message(uid, f"bm {uid} {1 + n // len(senders)}", n))
+        await asyncio.wait_for(delivery.done.wait(), args.timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        await asyncio.get_running_loop().run_in_executor(None, proc.wait)
+        await api.stop()
+    return elapsed, cross, delivery
+
+
+async def main_async(args):
+    print(f"{'workers':>7} {'msgs/s':>9} {'speedup':>8} {'cross-shard':>12} {'misrouted':>10} {'reordered':>10}")
+    baseline = None
+    for workers in args.workers:
+        elapsed, cross, delivery = await run_once(workers, args)
+        rate = args.messages / elapsed
+        baseline = baseline or rate
+        print(f"{workers:>7} {rate:>9.0f} {rate / baseline:>7.2f}x {cross:>11.0%} "
+              f"{delivery.misrouted:>10} {delivery.reordered:>10}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--pairs", type=int, default=500)
+    ap.add_argument("--messages", type=int, default=20000)
+    ap.add_argument("--latency", type=float, default=0.02, help="задержка ответа заглушки Bot API, с")
+    ap.add_argument("--outbound-workers", type=int, default=8)
+    ap.add_argument("--timeout", type=float, default=300)
+    ap.add_argument("--port", type=int, default=18082)
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Размер БД и время записи истории: строка на сообщение (как было) против секций с блоками
+(history.py) — сразу после записи, после слияния мелких блоков (так держится открытая
+секция) и после уплотнения закрытых секций. Обе схемы хранят одинаково: не больше --keep
+последних сообщений на пользователя (0 — всё).
+
+    python bench/bench_history.py --messages 300000 --users 6000 --days 21
+    python bench/bench_history.py --messages 200000 --users 500   # упор в --keep
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from storage import Storage, connect
+from history import HistoryArchiver, list_partitions, partition_of, partition_table, partition_ddl, insert_blocks, trim_user
+
+WORDS = "привет как дела что делаешь откуда ты сколько лет хорошо пока ладно давай музыка кино".split()
+
+OLD_DDL = ["""CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, direction TEXT,
+                                    content TEXT, created_at REAL)""",
+           "CREATE INDEX idx_history_user_id ON history (user_id, id)"]
+OLD_INSERT = "INSERT INTO history (user_id, direction, content, created_at) VALUES (?, ?, ?, ?)"
+OLD_TRIM = """DELETE FROM history WHERE user_id = ? AND id < (
+                  SELECT MIN(id) FROM (SELECT id FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?))"""
+
+
+def batches(messages, users, batch_size, days, seed=1):
+    rnd = random.Random(seed)
+    ts = time.time() - days * 86400
+    step = days * 86400 / messages
+    batch = []
+    for _ in range(messages):
+        ts += step
+        text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12)))
+        batch.append((rnd.randint(1, users), rnd.choice(('in', 'out')), text, ts))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_old(conn, batch, keep):
+    conn.executemany(OLD_INSERT, batch)
+    if keep:
+        conn.executemany(OLD_TRIM, [(uid, uid, keep) for uid in {row[0] for row in batch}])
+
+
+def write_new(conn, batch, created, keep, untrimmed):
+    groups = {}
+    for uid, direction, content, ts in batch:
+        groups.setdefault((partition_of(ts), uid), []).append((direction, content, ts))
+    for number, _ in groups:
+        if number not in created:
+            created.add(number)
+            for sql in partition_ddl(number):
+                conn.execute(sql)
+    insert_blocks(conn, groups)
+    if keep:
+        # как HistoryWriter: обрезка, когда с прошлой набралось keep/2 сообщений
+        partitions = [(number, partition_table(number)) for number in sorted(created)]
+        for (_, uid), rows in groups.items():
+            untrimmed[uid] = untrimmed.get(uid, 0) + len(rows)
+            if untrimmed[uid] >= max(1, keep // 2):
+                untrimmed[uid] = 0
+                trim_user(conn, uid, keep, partitions)
+
+
+def db_size(path):
+    conn = connect(path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    return os.path.getsize(path)
+
+
+async def maintain(path, sealed, keep):
+    storage = Storage(path)
+    try:
+        archiver = HistoryArchiver(storage, retention_days=10 ** 4, archive_dir=None, compact_delay=0, keep=keep)
+        start = time.perf_counter()
+        if sealed:
+            await archiver.run_once(now=time.time() + 8 * 86400)   # все секции уже закрыты
+            return time.perf_counter() - start, f"{len(archiver.compacted)} секц."
+        for number, _ in await list_partitions(storage):
+            await archiver.merge(number)
+        return time.perf_counter() - start, f"-{archiver.merged} бл."
+    finally:
+        storage.close()
+
+
+def run(kind, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        conn = connect(path)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")   # как после миграции 6
+        conn.execute("VACUUM")
+        if kind == 'old':
+            for sql in OLD_DDL:
+                conn.execute(sql)
+        created, untrimmed = set(), {}
+        start = time.perf_counter()
+        for batch in batches(args.messages, args.users, args.batch, args.days):
+            conn.execute("BEGIN")
+            if kind == 'old':
+                write_old(conn, batch, args.keep)
+            else:
+                write_new(conn, batch, created, args.keep, untrimmed)
+            conn.execute("COMMIT")
+        took = time.perf_counter() - start
+        conn.close()
+        rows = [(kind, took, db_size(path))]
+        if kind == 'blocks':
+            for name, sealed in (("merged", False), ("compacted", True)):
+                took, done = asyncio.run(maintain(path, sealed, args.keep))
+                rows.append((f"{name} ({done}, {took:.1f} s)", None, db_size(path)))
+        return rows
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=200000)
+    ap.add_argument("--users", type=int, default=4000)
+    ap.add_argument("--batch", type=int, default=500)
+    ap.add_argument("--days", type=float, default=21, help="на сколько дней растянуть сообщения")
+    ap.add_argument("--keep", type=int, default=50, help="сообщений на пользователя в обеих схемах (HISTORY_KEEP)")
+    args = ap.parse_args()
+    print(f"{'layout':32} {'write, s':>9} {'msg/s':>9} {'db, MB':>8}")
+    for kind in ('old', 'blocks'):
+        for name, took, size in run(kind, args):
+            speed = f"{took:9.2f} {args.messages / took:9.0f}" if took else f"{'':9} {'':9}"
+            print(f"{name:32} {speed} {size / 2**20:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
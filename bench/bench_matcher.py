@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Задержка Matcher.match с подбором по интересам/возрасту в зависимости от длины очереди.
+Для сравнения — наивный подбор, который оценивает каждого стоящего в очереди.
+
+    python bench/bench_matcher.py --sizes 1000 10000 50000 --joins 2000
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from matcher import Matcher
+
+SEXES = ['Мужчина', 'Женщина', 'Любой']
+
+
+def make_profile(rnd, tags):
+    # популярность интересов по Ципфу: несколько тегов есть почти у всех
+    interests = {tags[min(int(rnd.paretovariate(1.2)) - 1, len(tags) - 1)] for _ in range(rnd.randint(1, 4))}
+    return sorted(interests), rnd.randint(16, 60)
+
+
+def naive_best(queue, uid, profile, age_step=5):
+    interests, age = set(profile[0]), profile[1]
+    best, best_score = None, 0
+    for cid, (c_interests, c_age) in queue.items():
+        score = 2 * len(interests & c_interests) + (age // age_step == c_age // age_step)
+        if cid != uid and score > best_score:
+            best, best_score = cid, score
+    return best
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(size, joins, tags, seed=1):
+    rnd = random.Random(seed)
+    m = Matcher(by_profile=True, wait=1e9)
+    naive = {}
+    uid = 0
+    for _ in range(size):
+        uid += 1
+        profile = make_profile(rnd, tags)
+        m.add(uid, rnd.choice(SEXES), profile, now=0)
+        naive[uid] = (set(profile[0]), profile[1])
+
+    fast, slow, matched = [], [], 0
+    for _ in range(joins):
+        uid += 1
+        profile = make_profile(rnd, tags)
+        sex = rnd.choice(SEXES)
+
+        started = time.perf_counter()
+        candidate = m.match(uid, sex, profile, now=1)
+        fast.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        naive_best(naive, uid, profile)
+        slow.append(time.perf_counter() - started)
+
+        # держим длину очереди постоянной
+        if candidate is not None:
+            matched += 1
+            naive.pop(candidate, None)
+            uid += 1
+            refill = make_profile(rnd, tags)
+            m.add(uid, rnd.choice(SEXES), refill, now=0)
+            naive[uid] = (set(refill[0]), refill[1])
+        else:
+            m.remove(uid)
+    return fast, slow, matched
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 10000, 25000, 50000])
+    ap.add_argument("--joins", type=int, default=2000)
+    ap.add_argument("--tags", type=int, default=300, help="размер словаря интересов")
+    args = ap.parse_args()
+    tags = [f"tag{i}" for i in range(args.tags)]
+
+    print(f"{'queue':>7} {'index p50':>10} {'index p99':>10} {'scan p50':>10} {'scan p99':>10} {'matched':>8}")
+    for size in args.sizes:
+        fast, slow, matched = run(size, args.joins, tags)
+        print(f"{size:>7} {percentile(fast, .5) * 1e6:>8.0f}us {percentile(fast, .99) * 1e6:>8.0f}us "
+              f"{percentile(slow, .5) * 1e6:>8.0f}us {percentile(slow, .99) * 1e6:>8.0f}us "
+              f"{matched / args.joins:>7.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Время горячих запросов до и после индексных миграций (2, 3).
+База заполняется синтетическими данными на версии схемы 1, затем применяются остальные миграции.
+
+    python bench/bench_migrations.py --users 200000 --queue 20000 --history 500000
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from storage import connect
+from migrations import migrate
+
+SEXES = ['Мужчина', 'Женщина', 'Любой']
+
+
+def populate(conn, users, queue, history):
+    rnd = random.Random(42)
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO users (id, username, name, vip, banned, created_at) VALUES (?, ?, ?, ?, ?, '')",
+                     ((i, f"u{i}", f"n{i}", int(rnd.random() < 0.05), int(rnd.random() < 0.01))
+                      for i in range(1, users + 1)))
+    conn.executemany("INSERT INTO search_queue (user_id, sex_filter, queued_at) VALUES (?, ?, ?)",
+                     ((rnd.randint(1, users), rnd.choice(SEXES), rnd.random() * 1e6) for _ in range(queue)))
+    conn.executemany("INSERT INTO history (user_id, direction, content, created_at) VALUES (?, 'out', 'hello', 0)",
+                     ((rnd.randint(1, users),) for _ in range(history)))
+    conn.execute("COMMIT")
+
+
+def workload(users):
+    rnd = random.Random(7)
+    uid = lambda: (rnd.randint(1, users),)
+    return [
+        ("pop_queue_candidate", "SELECT user_id FROM search_queue WHERE sex_filter = ? ORDER BY queued_at ASC LIMIT 1",
+         lambda: (rnd.choice(SEXES),)),
+        ("queue lookup by user", "SELECT 1 FROM search_queue WHERE user_id = ?", uid),
+        ("history trim probe", "SELECT id FROM history WHERE user_id = ? ORDER BY id DESC LIMIT 51", uid),
+        ("get_history", "SELECT direction, content, created_at FROM history WHERE user_id = ? ORDER BY id DESC LIMIT 50", uid),
+        ("COUNT vip", "SELECT COUNT(*) FROM users WHERE vip = 1", lambda: ()),
+        ("COUNT banned", "SELECT COUNT(*) FROM users WHERE banned = 1", lambda: ()),
+    ]
+
+
+def measure(conn, users, repeat):
+    results = {}
+    for name, sql, params in workload(users):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(sql, params()).fetchall()
+        results[name] = (time.perf_counter() - start) / repeat * 1e3
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=100000)
+    ap.add_argument("--queue", type=int, default=10000)
+    ap.add_argument("--history", type=int, default=300000)
+    ap.add_argument("--repeat", type=int, default=50)
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        migrate(path, target=1)
+        conn = connect(path)
+        populate(conn, args.users, args.queue, args.history)
+        before = measure(conn, args.users, args.repeat)
+        conn.close()
+        start = time.perf_counter()
+        applied = migrate(path, target=3)
+        took = time.perf_counter() - start
+        conn = connect(path)
+        after = measure(conn, args.users, args.repeat)
+        conn.close()
+    print(f"migrations {applied} applied in {took:.2f}s")
+    print(f"{'query':24} {'before, ms':>12} {'after, ms':>12} {'speedup':>9}")
+    for name in before:
+        print(f"{name:24} {before[name]:12.3f} {after[name]:12.3f} {before[name] / max(after[name], 1e-6):8.0f}x")
+
+
+if __name__ == '__main__':
+    main()
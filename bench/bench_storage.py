@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Сравнение записей в секунду: старый run_db (connect/commit/close на каждый вызов)
+против Storage (долгоживущие соединения + групповой коммит).
+
+    python bench/bench_storage.py --ops 5000 --concurrency 50
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from storage import Storage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    name TEXT,
+    partner INTEGER DEFAULT NULL
+)"""
+
+
+def make_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute(SCHEMA)
+    conn.commit()
+    conn.close()
+
+
+def legacy_run_db(pool, path, query, params=(), fetch=False):
+    # копия run_db до перехода на Storage
+    def _run():
+        conn = sqlite3.connect(path, check_same_thread=False)
+        cur = conn.cursor()
+        cur.execute(query, params)
+        rows = cur.fetchall() if fetch else None
+        conn.commit()
+        conn.close()
+        return rows
+    return asyncio.get_running_loop().run_in_executor(pool, _run)
+
+
+async def drive(run, ops, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with sem:
+            await run("INSERT OR REPLACE INTO users (id, username, name) VALUES (?, ?, ?)",
+                      (i, f"user{i}", f"name{i}"))
+            await run("UPDATE users SET partner = ? WHERE id = ?", (i + 1, i))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(ops)))
+    return (ops * 2) / (time.perf_counter() - start)
+
+
+async def bench_legacy(path, ops, concurrency):
+    pool = ThreadPoolExecutor(max_workers=4)
+    try:
+        return await drive(lambda q, p=(): legacy_run_db(pool, path, q, p), ops, concurrency)
+    finally:
+        pool.shutdown()
+
+
+async def bench_storage(path, ops, concurrency):
+    storage = Storage(path)
+    try:
+        rate = await drive(storage.execute, ops, concurrency)
+        return rate, storage.commits
+    finally:
+        storage.close()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--ops", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, default=50)
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_db = os.path.join(tmp, "legacy.db")
+        storage_db = os.path.join(tmp, "storage.db")
+        make_db(legacy_db)
+        make_db(storage_db)
+        legacy = asyncio.run(bench_legacy(legacy_db, args.ops, args.concurrency))
+        new, commits = asyncio.run(bench_storage(storage_db, args.ops, args.concurrency))
+    print(f"legacy run_db: {legacy:10.0f} writes/s")
+    print(f"Storage:       {new:10.0f} writes/s  ({commits} commits for {args.ops * 2} writes)")
+    print(f"speedup:       {new / legacy:10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
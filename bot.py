@@ -8,18 +8,39 @@
 
 import os
 import re
+import html
 import time
 import logging
-import sqlite3
+import tempfile
 from datetime import datetime
 from functools import wraps
-from concurrent.futures import ThreadPoolExecutor
 import asyncio
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
+from aiogram.types import InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
 from aiogram.utils import exceptions
 from aiogram.utils.executor import start_polling
+from aiogram.bot.api import TelegramAPIServer
+
+from storage import Storage
+from migrations import migrate
+from state import make_state
+from cache import LRUCache
+from history import HistoryWriter, HistoryArchiver, history_page
+from albums import AlbumBuffer
+from complaints import ComplaintAggregator
+from errors import ErrorAggregator
+from sweeper import Sweeper
+from broadcast import BroadcastManager
+from ratelimit import RateLimiter
+from middlewares import RateLimitMiddleware, LatencyMiddleware
+from outbound import SendScheduler, DIALOG, NOTIFY, BROADCAST, MESSAGE_LIMIT, split_text
+from metrics import Registry, start_metrics_server
+from instrumentation import Instrumentation, InstrumentedBot, current_handler
+from logsetup import setup_logging, stop_logging, settings_from_env
+import bulk
+import fsm
 
 # ---------------------------
 # Конфигурация (берётся из окружения)
@@ -28,6 +49,24 @@ TOKEN = os.getenv("TOKEN") or os.getenv("TG_BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID") or os.getenv("TG_ADMIN_ID") or 0)
 DB_PATH = os.getenv("BOT_DB_PATH", "bot_data.db")
 LOG_FILE = os.getenv("BOT_LOG", "bot.log")
+BOT_API_SERVER = os.getenv("BOT_API_SERVER")  # напр. http://127.0.0.1:8081, по умолчанию api.telegram.org
+
+# Режим получения апдейтов (см. config.py): polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT") or os.getenv("PORT") or 8080)
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 64))
+
+# Кластер (см. cluster.py): воркеры запускает приёмник, эти переменные он выставляет сам
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 1))
+WORKER_SOCKET = os.getenv("WORKER_SOCKET")
+WORKER_MAX_PENDING = int(os.getenv("WORKER_MAX_PENDING", 1000))
+# Где очередь поиска и пары: local — Matcher в памяти, sqlite — общая БД для нескольких процессов
+STATE_BACKEND = os.getenv("STATE_BACKEND") or ("sqlite" if BOT_MODE == "worker" else "local")
 
 if not TOKEN:
     raise RuntimeError("TOKEN is not set. Set TOKEN in environment variables.")
@@ -36,85 +75,93 @@ if not TOKEN:
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 10 * 1024 * 1024))  # 10 MB
 ALLOWED_DOCUMENT_EXT = {'.pdf', '.txt', '.jpg', '.jpeg', '.png', '.mp3', '.ogg', '.mp4', '.webm'}
 MSG_RATE_LIMIT_PER_MIN = int(os.getenv("MSG_RATE_LIMIT_PER_MIN", 20))
+CALLBACK_RATE_LIMIT_PER_MIN = int(os.getenv("CALLBACK_RATE_LIMIT_PER_MIN", 30))
+QUEUE_JOIN_LIMIT_PER_MIN = int(os.getenv("QUEUE_JOIN_LIMIT_PER_MIN", 6))
+DB_READERS = int(os.getenv("DB_READERS", 4))
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", 256))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 50000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 600))
+HISTORY_QUEUE_SIZE = int(os.getenv("HISTORY_QUEUE_SIZE", 10000))
+# История: не больше HISTORY_KEEP последних сообщений на пользователя (0 — без ограничения);
+# недельные секции старше HISTORY_RETENTION_DAYS удаляются или, если задан HISTORY_ARCHIVE_DIR, выгружаются туда
+HISTORY_KEEP = int(os.getenv("HISTORY_KEEP", 50))
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", 30))
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "")
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 10))
+HISTORY_ENTRY_CHARS = int(os.getenv("HISTORY_ENTRY_CHARS", 300))  # длиннее — обрезается в /history
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))  # сообщений в секунду, лимит Telegram ~30
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", 28))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", 8))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))  # 0 — эндпоинт /metrics выключен
+SLOW_OP_MS = float(os.getenv("SLOW_OP_MS", 500))  # порог для лога медленных операций
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", 0.8))  # сколько ждать следующий элемент альбома, с
+# Жалобы: админу — дайджест раз в интервал; столько разных жалобщиков за сутки — автобан (0 — выкл.)
+COMPLAINT_DIGEST_INTERVAL = float(os.getenv("COMPLAINT_DIGEST_INTERVAL", 300))
+AUTO_BAN_REPORTERS = int(os.getenv("AUTO_BAN_REPORTERS", 5))
+ERROR_SUMMARY_WINDOW = float(os.getenv("ERROR_SUMMARY_WINDOW", 300))  # не чаще одной сводки на ошибку за окно
+# Подбор по интересам и возрасту (только STATE_BACKEND=local): сколько ждать пару по профилю до FIFO
+MATCH_BY_INTERESTS = os.getenv("MATCH_BY_INTERESTS", "0").lower() in ("1", "true", "yes")
+MATCH_WAIT = float(os.getenv("MATCH_WAIT", 15))
+MATCH_REMATCH_INTERVAL = float(os.getenv("MATCH_REMATCH_INTERVAL", 2))
+# Сколько ждать в очереди и сколько может молчать диалог до автоматического снятия, с (0 — не снимать)
+QUEUE_TTL = float(os.getenv("QUEUE_TTL", 600))
+DIALOG_IDLE_TIMEOUT = float(os.getenv("DIALOG_IDLE_TIMEOUT", 1800))
 
-# Логирование
-logging.basicConfig(level=logging.INFO, filename=LOG_FILE,
-                    format="%(asctime)s %(levelname)s %(message)s")
+# Логирование: запись в файл — в фоновом потоке; LOG_* из окружения — см. logsetup.settings_from_env
+if WORKER_COUNT > 1:
+    # ротацию одного файла из нескольких процессов logging не поддерживает — у воркера свой файл
+    LOG_FILE = "{0}.{2}{1}".format(*os.path.splitext(LOG_FILE), WORKER_INDEX)
+log_handler = setup_logging(LOG_FILE, **settings_from_env())
 logger = logging.getLogger(__name__)
 
+# Реестр метрик и замеры задержек (хендлеры, БД, Bot API)
+metrics = Registry()
+instrumentation = Instrumentation(metrics, slow_threshold=SLOW_OP_MS / 1000)
+
 # ---------------------------
 # Aiogram init
 # ---------------------------
-bot = Bot(TOKEN, parse_mode='HTML')
+if BOT_API_SERVER:
+    # свой/локальный Bot API сервер (например, фейковый для нагрузочных тестов)
+    bot = InstrumentedBot(TOKEN, parse_mode='HTML', server=TelegramAPIServer.from_base(BOT_API_SERVER))
+else:
+    bot = InstrumentedBot(TOKEN, parse_mode='HTML')
+bot.instrumentation = instrumentation
 dp = Dispatcher(bot)
+dp.middleware.setup(LatencyMiddleware(instrumentation))
+
+# Все исходящие сообщения идут через планировщик: лимиты Telegram, приоритеты, RetryAfter
+# общий лимит Telegram делим между воркерами кластера
+outbound = SendScheduler(global_rate=OUTBOUND_GLOBAL_RATE / WORKER_COUNT, chat_rate=OUTBOUND_CHAT_RATE,
+                         workers=OUTBOUND_WORKERS)
+
+def send_message(chat_id: int, text: str, priority=NOTIFY, **kwargs):
+    return outbound.call(chat_id, bot.send_message, chat_id, text, priority=priority, **kwargs)
+
+def reply(message: Message, text: str, **kwargs):
+    return send_message(message.chat.id, text, **kwargs)
 
-# Thread pool for sqlite sync calls
-executor_pool = ThreadPoolExecutor(max_workers=4)
 loop = asyncio.get_event_loop()
 
 # ---------------------------
-# Простые sync-DB вызовы в executor
+# DB: схема и доступ через Storage (WAL, один писатель, пул читателей)
 # ---------------------------
-def _init_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY,
-        username TEXT,
-        name TEXT,
-        sex TEXT DEFAULT 'Не выбран',
-        age INTEGER DEFAULT 0,
-        interests TEXT DEFAULT '',
-        vip INTEGER DEFAULT 0,
-        partner INTEGER DEFAULT NULL,
-        banned INTEGER DEFAULT 0,
-        created_at TEXT
-    )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS search_queue (
-        user_id INTEGER,
-        sex_filter TEXT,
-        queued_at REAL
-    )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        direction TEXT,
-        content TEXT,
-        created_at REAL
-    )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS complaints (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        from_user INTEGER,
-        about_user INTEGER,
-        reason TEXT,
-        created_at REAL
-    )""")
-    conn.commit()
-    conn.close()
+migrate(DB_PATH)
+storage = Storage(DB_PATH, readers=DB_READERS, batch_size=DB_BATCH_SIZE, observer=instrumentation.observe_db)
 
 def run_db(query, params=(), fetch=False, many=False):
-    def _run():
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        cur = conn.cursor()
-        if many:
-            cur.executemany(query, params)
-        else:
-            cur.execute(query, params)
-        if fetch:
-            rows = cur.fetchall()
-            conn.commit()
-            conn.close()
-            return rows
-        conn.commit()
-        conn.close()
-        return None
-    return loop.run_in_executor(executor_pool, _run)
+    return storage.execute(query, params, fetch=fetch, many=many)
+
+# Очередь поиска и пары (Matcher в памяти или общая SQLite для кластера)
+state = make_state(STATE_BACKEND, storage,
+                   matcher_options={"by_profile": MATCH_BY_INTERESTS, "wait": MATCH_WAIT})
 
-_init_db()
+history_writer = HistoryWriter(storage, keep=HISTORY_KEEP, max_queue=HISTORY_QUEUE_SIZE)
+history_archiver = HistoryArchiver(storage, retention_days=HISTORY_RETENTION_DAYS,
+                                   archive_dir=HISTORY_ARCHIVE_DIR or None, keep=HISTORY_KEEP)
 
 # ---------------------------
 # Утилиты
@@ -129,41 +176,43 @@ def sanitize_text(text: str, max_len=1000):
 def is_admin(user_id: int):
     return user_id == ADMIN_ID
 
-user_rates = {}  # user_id -> [timestamps]
-def rate_limited(user_id: int, limit=MSG_RATE_LIMIT_PER_MIN):
-    now = time.time()
-    window_start = now - 60
-    arr = user_rates.get(user_id, [])
-    arr = [t for t in arr if t > window_start]
-    if len(arr) >= limit:
-        user_rates[user_id] = arr
-        return True
-    arr.append(now)
-    user_rates[user_id] = arr
-    return False
+rate_limiter = RateLimiter({
+    'messages': (MSG_RATE_LIMIT_PER_MIN, 60),
+    'callbacks': (CALLBACK_RATE_LIMIT_PER_MIN, 60),
+    'queue': (QUEUE_JOIN_LIMIT_PER_MIN, 60),
+})
+dp.middleware.setup(RateLimitMiddleware(rate_limiter, exempt=[ADMIN_ID], reply=reply))
+
+# ---------------------------
+# Метрики: поддерживаются хелперами ниже, при старте сверяются с БД
+# ---------------------------
+m_users = metrics.gauge("users_total", "Registered users")
+m_vip = metrics.gauge("users_vip", "VIP users")
+m_banned = metrics.gauge("users_banned", "Banned users")
+m_in_dialog = metrics.gauge("users_in_dialog", "Users that currently have a partner")
+metrics.gauge("active_dialogs", "Active dialogs", fn=lambda: m_in_dialog.value // 2)
+metrics.gauge("queued", "Users waiting in the search queue", fn=lambda: len(state))
+m_forwarded = metrics.counter("messages_forwarded_total", "Messages forwarded between partners")
+m_complaints = metrics.counter("complaints_total", "Complaints filed")
+metrics.gauge("log_dropped", "Log records dropped on a full queue", fn=lambda: log_handler.dropped)
+metrics.gauge("log_sampled_out", "Log records skipped by sampling", fn=lambda: log_handler.sampling.sampled_out)
+
+async def reconcile_metrics():
+    for gauge, query in ((m_users, "SELECT COUNT(*) FROM users"),
+                         (m_vip, "SELECT COUNT(*) FROM users WHERE vip = 1"),
+                         (m_banned, "SELECT COUNT(*) FROM users WHERE banned = 1"),
+                         (m_in_dialog, "SELECT COUNT(*) FROM users WHERE partner IS NOT NULL")):
+        rows = await run_db(query, fetch=True)
+        gauge.set(rows[0][0] if rows else 0)
 
 # ---------------------------
 # DB helper functions (async wrappers)
 # ---------------------------
-async def ensure_user_record(user: types.User):
-    uid = user.id
-    username = sanitize_text(user.username or "")
-    name = sanitize_text(user.first_name or "")
-    rows = await run_db("SELECT id FROM users WHERE id = ?", (uid,), fetch=True)
-    if not rows:
-        created = datetime.utcnow().isoformat()
-        await run_db("INSERT INTO users (id, username, name, created_at) VALUES (?, ?, ?, ?)",
-                     (uid, username, name, created))
-    else:
-        await run_db("UPDATE users SET username = ?, name = ? WHERE id = ?",
-                     (username, name, uid))
+# Кэш строк users (write-through): все изменения users ниже обновляют и его.
+# С общим состоянием выключен: партнёра и флаги меняют и другие процессы
+user_cache = LRUCache(maxsize=USER_CACHE_SIZE if state.caches_users else 0, ttl=USER_CACHE_TTL)
 
-async def get_user(uid: int):
-    rows = await run_db("SELECT id, username, name, sex, age, interests, vip, partner, banned FROM users WHERE id = ?",
-                        (uid,), fetch=True)
-    if not rows:
-        return None
-    row = rows[0]
+def _user_from_row(row):
     return {
         "id": row[0],
         "username": row[1],
@@ -173,64 +222,172 @@ async def get_user(uid: int):
         "interests": row[5].split(',') if row[5] else [],
         "vip": bool(row[6]),
         "partner": row[7],
-        "banned": bool(row[8])
+        "banned": bool(row[8]),
+        "conv_state": row[9] or fsm.IDLE
     }
 
+# Последние записанные (username, name) по пользователю: без изменений — в БД не ходим
+profile_fingerprints = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+profile_sync_stats = {"written": 0, "skipped": 0}
+
+async def ensure_user_record(user: types.User):
+    uid = user.id
+    username = sanitize_text(user.username or "")
+    name = sanitize_text(user.first_name or "")
+    fingerprint = (username, name)
+    if profile_fingerprints.get(uid) == fingerprint:
+        profile_sync_stats["skipped"] += 1
+        return
+    created = datetime.utcnow().isoformat()
+    # UPDATE срабатывает только если username/name реально поменялись;
+    # RETURNING отдаёт строку, только если что-то записано (вставка или UPDATE), и наш created_at —
+    # только для только что вставленной строки
+    rows = await run_db("""INSERT INTO users (id, username, name, created_at) VALUES (?, ?, ?, ?)
+                           ON CONFLICT(id) DO UPDATE SET username = excluded.username, name = excluded.name
+                           WHERE users.username IS NOT excluded.username OR users.name IS NOT excluded.name
+                           RETURNING created_at""",
+                        (uid, username, name, created), fetch=True)
+    if rows and rows[0][0] == created:
+        m_users.inc()
+    # промах кэша отпечатков (рестарт, TTL) при неизменном профиле — тоже пропуск записи
+    profile_sync_stats["written" if rows else "skipped"] += 1
+    profile_fingerprints.set(uid, fingerprint)
+    user_cache.update(uid, username=username, name=name)
+
+async def get_user(uid: int):
+    cached = user_cache.get(uid)
+    if cached is not None:
+        return dict(cached)
+    token = user_cache.begin_load(uid)
+    user = None
+    try:
+        rows = await run_db("SELECT id, username, name, sex, age, interests, vip, partner, banned, conv_state "
+                            "FROM users WHERE id = ?", (uid,), fetch=True)
+        if rows:
+            user = _user_from_row(rows[0])
+    finally:
+        user_cache.finish_load(uid, user, token)
+    return dict(user) if user else None
+
+async def update_user(uid: int, **fields):
+    """UPDATE users по полям + write-through в кэш. interests передаётся списком."""
+    columns = {k: (','.join(v) if k == 'interests' else v) for k, v in fields.items()}
+    assignments = ", ".join(f"{k} = ?" for k in columns)
+    await run_db(f"UPDATE users SET {assignments} WHERE id = ?", (*columns.values(), uid))
+    user_cache.update(uid, **fields)
+    if 'interests' in fields or 'age' in fields:
+        state.set_profile(uid, fields.get('interests'), fields.get('age'))
+
+async def set_user_flag(uid: int, flag: str, value: bool):
+    """vip/banned: пишет флаг и двигает счётчик, только если значение действительно поменялось."""
+    def _tx(conn):
+        return conn.execute(f"UPDATE users SET {flag} = ? WHERE id = ? AND {flag} != ?",
+                            (int(value), uid, int(value))).rowcount
+    changed = await storage.transaction(_tx)
+    user_cache.update(uid, **{flag: value})
+    if changed:
+        (m_vip if flag == 'vip' else m_banned).inc(1 if value else -1)
+    return bool(changed)
+
 async def set_partner(u1:int, u2:int):
-    await run_db("UPDATE users SET partner = ? WHERE id = ?", (u2, u1))
-    await run_db("UPDATE users SET partner = ? WHERE id = ?", (u1, u2))
+    state.set_busy(u1, True)
+    state.set_busy(u2, True)
+    def _tx(conn):
+        free = conn.execute("SELECT COUNT(*) FROM users WHERE id IN (?, ?) AND partner IS NULL", (u1, u2)).fetchone()[0]
+        conn.executemany("UPDATE users SET partner = ?, conv_state = ? WHERE id = ?",
+                         [(u2, fsm.IN_DIALOG, u1), (u1, fsm.IN_DIALOG, u2)])
+        return free
+    m_in_dialog.inc(await storage.transaction(_tx))
+    user_cache.update(u1, partner=u2, conv_state=fsm.IN_DIALOG)
+    user_cache.update(u2, partner=u1, conv_state=fsm.IN_DIALOG)
 
 async def clear_partner(uid:int):
-    await run_db("UPDATE users SET partner = NULL WHERE id = ?", (uid,))
+    state.set_busy(uid, False)
+    changed = await storage.transaction(lambda conn: conn.execute(
+        "UPDATE users SET partner = NULL, conv_state = ? WHERE id = ? AND partner IS NOT NULL",
+        (fsm.IDLE, uid)).rowcount)
+    m_in_dialog.dec(changed)
+    user_cache.update(uid, partner=None)
+    if changed:
+        user_cache.update(uid, conv_state=fsm.IDLE)
+
+async def set_conv_state(uid:int, value:str):
+    """Переход состояния разговора (см. fsm.py); если в кэше уже это состояние — в БД не ходим."""
+    cached = user_cache.get(uid)
+    if cached is not None and cached.get('conv_state') == value:
+        return
+    await update_user(uid, conv_state=value)
+
+# ---------------------------
+# Очередь поиска: всё хранит state (см. state.py)
+# ---------------------------
+def _profile(user):
+    return (user.get('interests') or [], user.get('age') or 0) if user else None
 
-async def add_to_queue(uid:int, sex_filter:str):
-    await run_db("INSERT INTO search_queue (user_id, sex_filter, queued_at) VALUES (?, ?, ?)",
-                 (uid, sex_filter, time.time()))
+async def add_to_queue(uid:int, sex_filter:str, profile=None):
+    await state.enqueue(uid, sex_filter, profile)
+    sweeper.track_queue(uid)
+    await set_conv_state(uid, fsm.SEARCHING)
 
 async def remove_from_queue(uid:int):
-    await run_db("DELETE FROM search_queue WHERE user_id = ?", (uid,))
+    await state.dequeue(uid)
 
-async def pop_queue_candidate(sex_filter:str, prefer_vip=True):
-    rows = await run_db("SELECT user_id FROM search_queue WHERE sex_filter = ? ORDER BY queued_at ASC", (sex_filter,), fetch=True)
-    if not rows:
-        return None
-    candidate_ids = [r[0] for r in rows]
-    if prefer_vip:
-        for cid in candidate_ids:
-            u = await get_user(cid)
-            if u and u['vip'] and not u['partner'] and not u['banned']:
-                await remove_from_queue(cid)
-                return cid
-    # fallback to first suitable
-    for cid in candidate_ids:
-        u = await get_user(cid)
-        if u and not u['partner'] and not u['banned']:
-            await remove_from_queue(cid)
-            return cid
-    return None
+async def match_partner(uid:int, sex_filter:str, profile=None):
+    """Атомарно подбирает пару или ставит uid в очередь. Возвращает кандидата или None."""
+    candidate = await state.match(uid, sex_filter, profile)
+    if candidate is None:
+        sweeper.track_queue(uid)
+        await set_conv_state(uid, fsm.SEARCHING)
+    return candidate
 
 async def save_history(user_id:int, direction:str, content:str):
-    content = sanitize_text(content, max_len=2000)
-    await run_db("INSERT INTO history (user_id, direction, content, created_at) VALUES (?, ?, ?, ?)",
-                 (user_id, direction, content, time.time()))
-    rows = await run_db("SELECT id FROM history WHERE user_id = ? ORDER BY id DESC LIMIT 51", (user_id,), fetch=True)
-    if rows and len(rows) > 50:
-        keep_ids = [r[0] for r in rows[:50]]
-        min_keep = min(keep_ids)
-        await run_db("DELETE FROM history WHERE user_id = ? AND id < ?", (user_id, min_keep))
-
-async def get_history(user_id:int, limit=50):
-    rows = await run_db("SELECT direction, content, created_at FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?",
-                        (user_id, limit), fetch=True)
-    return rows or []
+    # пишет фоновый HistoryWriter; ждём только если его очередь переполнена
+    await history_writer.put(user_id, direction, sanitize_text(content, max_len=2000))
+
+def _history_text(items):
+    # сообщение хранится до 2000 символов, а страница должна влезть в одно сообщение Telegram
+    # (4096 символов после разбора HTML): каждую запись обрезаем, чтобы хватило на всю страницу
+    width = max(50, min(HISTORY_ENTRY_CHARS, (MESSAGE_LIMIT - 200) // max(1, len(items)) - 20))
+    lines = ["<b>🕘 История</b>"]
+    for direction, content, created_at in items:
+        arrow = "➡️" if direction == 'out' else "⬅️"
+        if len(content) > width:
+            content = content[:width - 1] + "…"
+        lines.append(f"{arrow} {datetime.fromtimestamp(created_at):%d.%m %H:%M} {html.escape(content)}")
+    return "\n".join(lines)
+
+def kb_history(cursor):
+    if cursor is None:
+        return None
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("Раньше ⏪", callback_data="hist_{}_{}".format(*cursor)))
+    return kb
+
+async def _send_complaint_digest(text:str):
+    if ADMIN_ID:
+        await send_message(ADMIN_ID, text, parse_mode='HTML')
+
+async def _auto_ban(uid:int):
+    changed = await set_user_flag(uid, 'banned', True)
+    await state.set_banned(uid, True)
+    if changed:
+        try:
+            await send_message(uid, "⛔ Вы заблокированы: на вас поступило много жалоб.")
+        except Exception:
+            pass
+    return changed
+
+complaints = ComplaintAggregator(storage, _send_complaint_digest, ban=_auto_ban,
+                                 digest_interval=COMPLAINT_DIGEST_INTERVAL, ban_threshold=AUTO_BAN_REPORTERS,
+                                 shared=state.shared)
 
 async def complain(from_user:int, about_user:int, reason:str):
+    reason = sanitize_text(reason, 500)
     await run_db("INSERT INTO complaints (from_user, about_user, reason, created_at) VALUES (?, ?, ?, ?)",
-                 (from_user, about_user, sanitize_text(reason, 500), time.time()))
-    try:
-        await bot.send_message(ADMIN_ID, f"⚠️ Жалоба: от <a href='tg://user?id={from_user}'>{from_user}</a> на <a href='tg://user?id={about_user}'>{about_user}</a>\nПричина: {sanitize_text(reason,300)}", parse_mode='HTML')
-    except Exception as e:
-        logger.exception("Can't notify admin of complaint: %s", e)
+                 (from_user, about_user, reason, time.time()))
+    m_complaints.inc()
+    # админу — в ближайшем дайджесте, не отдельным сообщением
+    await complaints.add(from_user, about_user, reason)
 
 # ---------------------------
 # Keyboards
@@ -270,43 +427,62 @@ def kb_choose_sex():
 @dp.message_handler(commands=['start'])
 async def start_handler(message: Message):
     await ensure_user_record(message.from_user)
-    await message.answer("<b>💻 Главное меню</b>", reply_markup=kb_main())
-
-@dp.message_handler(lambda m: m.text and m.text.strip() == 'Поиск собеседника🔎')
-async def choose_sex(message: Message):
-    u = await get_user(message.from_user.id)
-    if u is None:
-        await ensure_user_record(message.from_user)
-        u = await get_user(message.from_user.id)
-    if u.get('banned'):
-        await message.answer("⛔ Вы заблокированы.")
-        return
-    await message.answer("❓ Кого будем искать?", reply_markup=kb_choose_sex())
+    await reply(message, "<b>💻 Главное меню</b>", reply_markup=kb_main())
+
+# Текстовые сообщения разбирает message_router по состоянию разговора (см. fsm.py)
+router = fsm.Router()
+
+@router.on('Поиск собеседника🔎', states=fsm.OUTSIDE_DIALOG)
+async def choose_sex(message: Message, user):
+    await reply(message, "❓ Кого будем искать?", reply_markup=kb_choose_sex())
+
+@router.on('Профиль👤', '/profile', states=fsm.OUTSIDE_DIALOG)
+async def show_profile(message: Message, user):
+    await reply(message, "Ваш профиль:", reply_markup=kb_profile())
+
+@router.on('Пожаловаться🚨', '/complain', states=fsm.OUTSIDE_DIALOG)
+async def complain_prompt(message: Message, user):
+    await reply(message, "Напишите id пользователя или опишите проблему.")
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("choise_sex_"))
 async def on_choose_sex(callback: CallbackQuery):
     uid = callback.from_user.id
     sex = callback.data.split('_', 2)[2]
-    await remove_from_queue(uid)
     await ensure_user_record(callback.from_user)
-    await add_to_queue(uid, sex)
     await bot.answer_callback_query(callback.id, "Вы добавлены в очередь. Ждите собеседника...")
-    # Попробуем найти кандидата (сначала same filter, потом 'Любой')
-    candidate = await pop_queue_candidate(sex_filter=sex, prefer_vip=True)
+    # Кандидат ищется сначала в своей корзине, потом в 'Любой'; забанен/занят — отсеивает Matcher
+    candidate = await match_partner(uid, sex, _profile(await get_user(uid)))
     if candidate is None:
-        candidate = await pop_queue_candidate(sex_filter='Любой', prefer_vip=True)
-    if candidate is None:
-        await bot.send_message(uid, "⏳ Поиск собеседника... Ожидание.", reply_markup=ReplyKeyboardRemove())
-        return
-    # проверяем валидность кандидата
-    cand_user = await get_user(candidate)
-    if cand_user is None or cand_user.get('banned') or cand_user.get('partner'):
-        # пробуем снова (простая стратегия)
-        await on_choose_sex(callback)
+        await send_message(uid, "⏳ Поиск собеседника... Ожидание.", reply_markup=ReplyKeyboardRemove())
         return
-    await set_partner(uid, candidate)
-    await bot.send_message(uid, "✅ Собеседник найден. Общайтесь!", reply_markup=kb_dialog())
-    await bot.send_message(candidate, "✅ Собеседник найден. Общайтесь!", reply_markup=kb_dialog())
+    await start_dialog(uid, candidate)
+
+async def start_dialog(u1:int, u2:int):
+    await set_partner(u1, u2)
+    sweeper.forget_queue(u1)
+    sweeper.forget_queue(u2)
+    sweeper.track_dialog(u1, u2)
+    await send_message(u1, "✅ Собеседник найден. Общайтесь!", priority=DIALOG, reply_markup=kb_dialog())
+    await send_message(u2, "✅ Собеседник найден. Общайтесь!", priority=DIALOG, reply_markup=kb_dialog())
+
+async def end_dialog(uid:int, partner:int):
+    sweeper.forget_dialog(uid, partner)
+    await clear_partner(uid)
+    await clear_partner(partner)
+    await send_message(uid, "❌ Диалог окончен", priority=DIALOG, reply_markup=kb_main())
+    try:
+        await send_message(partner, "❌ Диалог окончен", priority=DIALOG, reply_markup=kb_main())
+    except Exception:
+        pass
+
+async def next_dialog(uid:int, user):
+    partner = user['partner']
+    sweeper.forget_dialog(uid, partner)
+    await clear_partner(uid)
+    await clear_partner(partner)
+    await send_message(partner, "❌ Диалог окончен", priority=DIALOG, reply_markup=kb_main())
+    await add_to_queue(uid, 'Любой', _profile(user))
+    await send_message(uid, "Ищем нового собеседника...", reply_markup=ReplyKeyboardRemove())
 
 @dp.callback_query_handler(lambda c: c.data in ('next_partner','end_chat','complain_partner'))
 async def dialog_controls(callback: CallbackQuery):
@@ -318,103 +494,160 @@ async def dialog_controls(callback: CallbackQuery):
         return
     partner = user['partner']
     if data == 'end_chat':
-        await clear_partner(uid)
-        await clear_partner(partner)
-        await bot.send_message(uid, "❌ Диалог окончен", reply_markup=kb_main())
-        try:
-            await bot.send_message(partner, "❌ Диалог окончен", reply_markup=kb_main())
-        except Exception:
-            pass
+        await end_dialog(uid, partner)
         await bot.answer_callback_query(callback.id)
     elif data == 'next_partner':
-        await clear_partner(uid)
-        await clear_partner(partner)
-        await bot.send_message(partner, "❌ Диалог окончен", reply_markup=kb_main())
-        await add_to_queue(uid, 'Любой')
-        await bot.send_message(uid, "Ищем нового собеседника...", reply_markup=ReplyKeyboardRemove())
+        await next_dialog(uid, user)
         await bot.answer_callback_query(callback.id)
     elif data == 'complain_partner':
         await complain(uid, partner, "Жалоба через кнопку")
         await bot.answer_callback_query(callback.id, "Жалоба отправлена админу. Спасибо.")
 
-@dp.message_handler(content_types=types.ContentType.ANY)
-async def message_router(message: Message):
-    uid = message.from_user.id
-    if rate_limited(uid):
-        await message.answer("⛔ Вы отправляете сообщения слишком быстро. Подождите немного.")
-        return
-    await ensure_user_record(message.from_user)
+# Кнопки главного меню, если клавиатура осталась на экране во время диалога, собеседнику не уходят
+@router.on('Закончить диалог❌', states=(fsm.IN_DIALOG,))
+async def end_dialog_button(message: Message, user):
+    await end_dialog(message.from_user.id, user['partner'])
+
+@router.on('Новый собеседник♻️', states=(fsm.IN_DIALOG,))
+async def next_dialog_button(message: Message, user):
+    await next_dialog(message.from_user.id, user)
+
+@router.on('Поиск собеседника🔎', 'Сменить пол✏️', 'Профиль👤', states=(fsm.IN_DIALOG,))
+async def busy_in_dialog(message: Message, user):
+    await reply(message, "Вы в диалоге. Сначала завершите его.", reply_markup=kb_dialog())
+
+ALBUM_MEDIA = {'photo': InputMediaPhoto, 'video': InputMediaVideo,
+               'document': InputMediaDocument, 'audio': InputMediaAudio}
+
+def _attachment_problem(message: Message):
+    """Почему вложение нельзя пересылать (текст для пользователя) или None."""
+    content = getattr(message, message.content_type, None)
+    if isinstance(content, list):  # photo — список размеров
+        content = content[-1] if content else None
+    if getattr(content, 'file_size', 0) and content.file_size > MAX_FILE_SIZE:
+        return "Файл слишком большой."
+    if message.content_type == 'document':
+        ext = os.path.splitext(message.document.file_name or "")[1].lower()
+        if ext not in ALLOWED_DOCUMENT_EXT:
+            return "Неподдерживаемый тип файла."
+    return None
+
+def _history_label(message: Message):
+    if message.content_type == 'document':
+        return f'[document:{message.document.file_name or ""}]'
+    return f'[{message.content_type}]'
+
+def _album_item(message: Message):
+    media_type = ALBUM_MEDIA.get(message.content_type)
+    if media_type is None:
+        return None
+    content = getattr(message, message.content_type)
+    file_id = content[-1].file_id if message.content_type == 'photo' else content.file_id
+    return media_type(media=file_id, caption=sanitize_text(message.caption or "") or None)
+
+async def _partner_available(uid:int, partner:int):
+    """Можно ли пересылать собеседнику; если нет — диалог завершается."""
+    p = await get_user(partner)
+    if not p or p.get('banned'):
+        await send_message(uid, "⛔ Ваш собеседник недоступен. Диалог завершён.")
+        await clear_partner(uid)
+        return False
+    return True
+
+async def forward_album(messages):
+    """Альбом целиком — одним sendMediaGroup и одной записью в истории."""
+    uid = messages[0].from_user.id
     u = await get_user(uid)
-    if u.get('banned'):
-        await message.answer("⛔ Вы заблокированы.")
+    partner = u.get('partner') if u else None
+    if not partner or not await _partner_available(uid, partner):
         return
-    partner = u.get('partner')
-    if not partner:
-        # Обработка кнопок/текста вне диалога
-        if message.text:
-            txt = message.text.strip().lower()
-            if txt in ('профиль👤','/profile'):
-                await message.answer("Ваш профиль:", reply_markup=kb_profile())
-                return
-            if txt in ('пожаловаться🚨','/complain'):
-                await message.answer("Напишите id пользователя или опишите проблему.")
-                return
+    media, rejected = [], 0
+    for m in messages:
+        item = None if _attachment_problem(m) else _album_item(m)
+        if item is None:
+            rejected += 1
+        else:
+            media.append(item)
+    try:
+        if media:
+            await outbound.call(partner, bot.send_media_group, partner, media, priority=DIALOG)
+            await save_history(uid, 'out', f'[album:{len(media)}]')
+            m_forwarded.inc()
+            await sweeper.touch(uid, partner)
+    except exceptions.BotBlocked:
+        await clear_partner(uid)
+        await send_message(uid, "❌ Ваш собеседник заблокировал бота; диалог завершён.")
+        return
+    except exceptions.TelegramAPIError as e:
+        # например, Telegram отверг группу: отправитель должен узнать, что альбом не дошёл
+        logger.warning("Album from %s not delivered: %s", uid, e)
+        await send_message(uid, "Не удалось переслать альбом.")
+        return
+    except Exception as e:
+        logger.exception("Ошибка при пересылке альбома: %s", e)
+        error_stats.record(e, uid)
+        await send_message(uid, "Произошла ошибка при отправке альбома.")
         return
-    # В диалоге — пересылаем
+    if rejected:
+        await send_message(uid, f"Не отправлено файлов из альбома: {rejected} (слишком большие или неподдерживаемого типа).")
+
+albums = AlbumBuffer(forward_album, window=ALBUM_WINDOW)
+
+@router.default(fsm.IN_DIALOG)
+async def forward_to_partner(message: Message, user):
+    uid = message.from_user.id
+    partner = user['partner']
     try:
-        p = await get_user(partner)
-        if not p or p.get('banned'):
-            await message.answer("⛔ Ваш собеседник недоступен. Диалог завершён.")
-            await clear_partner(uid)
+        if message.media_group_id:
+            # элементы альбома копятся и уходят одним sendMediaGroup (forward_album)
+            albums.add(message)
+            return
+        # недособранный альбом этого пользователя уходит раньше следующего сообщения
+        await albums.flush_sender(uid)
+        if not await _partner_available(uid, partner):
+            return
+        problem = _attachment_problem(message)
+        if problem:
+            await reply(message, problem)
             return
         if message.content_type == 'text':
+            await send_message(partner, message.text, priority=DIALOG)
             await save_history(uid, 'out', message.text)
             await save_history(partner, 'in', message.text)
-            await bot.send_message(partner, message.text)
-        elif message.content_type == 'photo':
-            file_id = message.photo[-1].file_id
-            await save_history(uid, 'out', '[photo]')
-            await bot.send_photo(partner, file_id, caption=sanitize_text(message.caption or ""))
-        elif message.content_type == 'voice':
-            if getattr(message.voice, 'file_size', 0) and message.voice.file_size > MAX_FILE_SIZE:
-                await message.answer("Файл слишком большой.")
-                return
-            fid = message.voice.file_id
-            await save_history(uid, 'out', '[voice]')
-            await bot.send_voice(partner, fid)
-        elif message.content_type == 'document':
-            doc = message.document
-            name = doc.file_name or ""
-            ext = os.path.splitext(name)[1].lower()
-            if getattr(doc, 'file_size', 0) and doc.file_size > MAX_FILE_SIZE:
-                await message.answer("Файл слишком большой.")
-                return
-            if ext not in ALLOWED_DOCUMENT_EXT:
-                await message.answer("Неподдерживаемый тип файла.")
-                return
-            await save_history(uid, 'out', f'[document:{name}]')
-            await bot.send_document(partner, doc.file_id)
-        elif message.content_type == 'sticker':
-            await save_history(uid, 'out', '[sticker]')
-            await bot.send_sticker(partner, message.sticker.file_id)
-        elif message.content_type == 'video':
-            if getattr(message.video, 'file_size', 0) and message.video.file_size > MAX_FILE_SIZE:
-                await message.answer("Файл слишком большой.")
-                return
-            await save_history(uid, 'out', '[video]')
-            await bot.send_video(partner, message.video.file_id)
         else:
-            await save_history(uid, 'out', f"[{message.content_type}]")
+            # любой другой тип — одна копия без подписи «переслано»
             try:
-                await message.forward(partner)
-            except Exception:
-                await message.answer("Не удалось переслать это сообщение.")
+                await outbound.call(partner, bot.copy_message, partner, message.chat.id, message.message_id,
+                                    priority=DIALOG)
+            except exceptions.BotBlocked:
+                raise
+            except exceptions.TelegramAPIError:
+                await reply(message, "Не удалось переслать это сообщение.")
+                return
+            await save_history(uid, 'out', _history_label(message))
+        m_forwarded.inc()
+        await sweeper.touch(uid, partner)
     except exceptions.BotBlocked:
         await clear_partner(uid)
-        await message.answer("❌ Ваш собеседник заблокировал бота; диалог завершён.")
+        await reply(message, "❌ Ваш собеседник заблокировал бота; диалог завершён.")
     except Exception as e:
         logger.exception("Ошибка при пересылке сообщения: %s", e)
-        await message.answer("Произошла ошибка при отправке сообщения.")
+        error_stats.record(e, uid)
+        await reply(message, "Произошла ошибка при отправке сообщения.")
+
+async def message_router(message: Message):
+    """Всё, что не поймали команды: один get_user и маршрут по (состояние, текст)."""
+    uid = message.from_user.id
+    await ensure_user_record(message.from_user)
+    u = await get_user(uid)
+    if u.get('banned'):
+        await reply(message, "⛔ Вы заблокированы.")
+        return
+    handler = router.resolve(fsm.current(u), message.text)
+    if handler is None:
+        return
+    current_handler.set(handler.__name__)
+    await handler(message, u)
 
 # ---------------------------
 # Профиль и настройки
@@ -427,26 +660,86 @@ async def edit_sex_cb(callback: CallbackQuery):
 @dp.callback_query_handler(lambda c: c.data == 'become_vip')
 async def become_vip(callback: CallbackQuery):
     uid = callback.from_user.id
-    await run_db("UPDATE users SET vip = 1 WHERE id = ?", (uid,))
+    await set_user_flag(uid, 'vip', True)
+    await state.set_vip(uid, True)
     await bot.answer_callback_query(callback.id, "Вы стали VIP (демо).")
-    await bot.send_message(uid, "⭐ Вы теперь VIP!")
+    await send_message(uid, "⭐ Вы теперь VIP!")
+
+async def _await_input(callback: CallbackQuery, value:str, prompt:str):
+    uid = callback.from_user.id
+    u = await get_user(uid)
+    if u and u.get('partner'):
+        await bot.answer_callback_query(callback.id, "Сначала завершите диалог.")
+        return
+    await ensure_user_record(callback.from_user)
+    await set_conv_state(uid, value)
+    await bot.answer_callback_query(callback.id)
+    await send_message(uid, prompt)
 
 @dp.callback_query_handler(lambda c: c.data == 'edit_age')
 async def edit_age_cb(callback: CallbackQuery):
-    await bot.send_message(callback.from_user.id, "Напишите ваш возраст (числом).")
+    await _await_input(callback, fsm.AWAITING_AGE, "Напишите ваш возраст (числом). /cancel — отмена.")
 
-@dp.message_handler(lambda m: m.text and m.text.isdigit() and 5 <= int(m.text) <= 120)
-async def set_age_handler(message: Message):
-    age = int(message.text)
-    await run_db("UPDATE users SET age = ? WHERE id = ?", (age, message.from_user.id))
-    await message.answer(f"Возраст обновлён: {age}")
+@dp.callback_query_handler(lambda c: c.data == 'edit_interests')
+async def edit_interests_cb(callback: CallbackQuery):
+    await _await_input(callback, fsm.AWAITING_INTERESTS, "Напишите интересы через запятую. /cancel — отмена.")
 
-@dp.message_handler(lambda m: m.text and m.text.startswith('/setinterests '))
-async def set_interests_cmd(message: Message):
-    data = message.text.replace('/setinterests ', '', 1).strip()
-    interests = ','.join([sanitize_text(s.strip(), 50) for s in data.split(',') if s.strip()])
-    await run_db("UPDATE users SET interests = ? WHERE id = ?", (interests, message.from_user.id))
-    await message.answer("Интересы обновлены.")
+@router.on('/cancel', states=(fsm.AWAITING_AGE, fsm.AWAITING_INTERESTS))
+async def cancel_input(message: Message, user):
+    await set_conv_state(message.from_user.id, fsm.IDLE)
+    await reply(message, "Отменено.", reply_markup=kb_main())
+
+@router.default(fsm.AWAITING_AGE)
+async def set_age_handler(message: Message, user):
+    text = (message.text or "").strip()
+    if not text.isdigit() or not 5 <= int(text) <= 120:
+        await reply(message, "Возраст — число от 5 до 120. /cancel — отмена.")
+        return
+    age = int(text)
+    await update_user(message.from_user.id, age=age, conv_state=fsm.IDLE)
+    await reply(message, f"Возраст обновлён: {age}")
+
+def _parse_interests(text:str):
+    return [sanitize_text(s.strip(), 50) for s in text.split(',') if s.strip()]
+
+@router.default(fsm.AWAITING_INTERESTS)
+async def set_interests_input(message: Message, user):
+    interests = _parse_interests(message.text or "")
+    if not interests:
+        await reply(message, "Напишите интересы текстом через запятую. /cancel — отмена.")
+        return
+    await update_user(message.from_user.id, interests=interests, conv_state=fsm.IDLE)
+    await reply(message, "Интересы обновлены.")
+
+@router.on('/setinterests')
+async def set_interests_cmd(message: Message, user):
+    interests = _parse_interests(message.get_args() or "")
+    if not interests:
+        await reply(message, "Использование: /setinterests музыка, кино")
+        return
+    await update_user(message.from_user.id, interests=interests)
+    await reply(message, "Интересы обновлены.")
+
+@dp.message_handler(commands=['history'])
+async def cmd_history(message: Message):
+    items, cursor = await history_page(storage, message.from_user.id, limit=HISTORY_PAGE_SIZE)
+    if not items:
+        await reply(message, "История пуста.")
+        return
+    await reply(message, _history_text(items), reply_markup=kb_history(cursor))
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith('hist_'))
+async def history_more(callback: CallbackQuery):
+    parts = callback.data.split('_')[1:]
+    if len(parts) != 2 or not all(p.isdigit() for p in parts):
+        await bot.answer_callback_query(callback.id)
+        return
+    cursor = tuple(int(p) for p in parts)
+    items, cursor = await history_page(storage, callback.from_user.id, cursor, limit=HISTORY_PAGE_SIZE)
+    await bot.answer_callback_query(callback.id, None if items else "Больше сообщений нет.")
+    if items:
+        await bot.edit_message_text(_history_text(items), chat_id=callback.from_user.id,
+                                    message_id=callback.message.message_id, reply_markup=kb_history(cursor))
 
 # ---------------------------
 # Админ: декоратор и команды
@@ -455,7 +748,7 @@ def admin_only(handler):
     @wraps(handler)
     async def wrapper(message: Message):
         if not is_admin(message.from_user.id):
-            await message.answer("Нет доступа.")
+            await reply(message, "Нет доступа.")
             return
         return await handler(message)
     return wrapper
@@ -463,121 +756,333 @@ def admin_only(handler):
 @dp.message_handler(commands=['stats'])
 @admin_only
 async def cmd_stats(message: Message):
-    rows = await run_db("SELECT COUNT(*) FROM users", fetch=True)
-    total = rows[0][0] if rows else 0
-    vip_rows = await run_db("SELECT COUNT(*) FROM users WHERE vip = 1", fetch=True)
-    vip = vip_rows[0][0] if vip_rows else 0
-    banned_rows = await run_db("SELECT COUNT(*) FROM users WHERE banned = 1", fetch=True)
-    banned = banned_rows[0][0] if banned_rows else 0
-    q_rows = await run_db("SELECT COUNT(*) FROM search_queue", fetch=True)
-    queued = q_rows[0][0] if q_rows else 0
-    await message.answer(f"👥 Пользователей: {total}\n⭐ VIP: {vip}\n⛔ Заблокировано: {banned}\n⏳ В очереди: {queued}")
+    m = metrics.snapshot()
+    total, vip, banned, queued = m['users_total'], m['users_vip'], m['users_banned'], m['queued']
+    cache = user_cache.stats()
+    out = outbound.stats()
+    await reply(message, f"👥 Пользователей: {total}\n⭐ VIP: {vip}\n⛔ Заблокировано: {banned}\n⏳ В очереди: {queued}\n"
+                         f"💬 Диалогов: {m['active_dialogs']}, переслано {m['messages_forwarded_total']}, "
+                         f"жалоб {m['complaints_total']} (ждут дайджеста {complaints.pending()}, "
+                         f"автобанов {complaints.auto_banned})\n"
+                         f"🗄 Кэш: {cache['size']} записей, hit {cache['hits']} / miss {cache['misses']} ({cache['hit_ratio']:.0%})\n"
+                         f"✍️ Профили: записано {profile_sync_stats['written']}, пропущено {profile_sync_stats['skipped']}\n"
+                         f"🐢 Под лимитом: {rate_limiter.stats()['throttled']}\n"
+                         f"📤 Очередь отправки: {' / '.join(f'{lane} {n}' for lane, n in out['depth'].items())}, отправлено {out['sent']}, ошибок {out['failed']}, "
+                         f"повторов {out['retried']}, p50 {out['latency_p50']*1000:.0f} мс / p95 {out['latency_p95']*1000:.0f} мс")
+
+async def _broadcast_send(uid:int, text:str):
+    await send_message(uid, f"📢 Админ: {text}", priority=BROADCAST)
+
+async def _broadcast_done(job):
+    if ADMIN_ID:
+        try:
+            await send_message(ADMIN_ID, job.summary())
+        except Exception:
+            logger.exception("Can't notify admin of broadcast #%s", job.id)
+
+broadcasts = BroadcastManager(storage, _broadcast_send, rate=BROADCAST_RATE,
+                              concurrency=BROADCAST_CONCURRENCY, on_done=_broadcast_done)
+
+@dp.message_handler(commands=['latency'])
+@admin_only
+async def cmd_latency(message: Message):
+    await reply(message, instrumentation.report())
 
 @dp.message_handler(commands=['broadcast'])
 @admin_only
 async def cmd_broadcast(message: Message):
     parts = message.text.split(' ', 1)
     if len(parts) < 2:
-        await message.answer("Использование: /broadcast текст")
+        await reply(message, "Использование: /broadcast текст")
         return
-    text = parts[1]
-    rows = await run_db("SELECT id FROM users", fetch=True)
-    sent = 0
-    for r in rows:
-        uid = r[0]
-        try:
-            await bot.send_message(uid, f"📢 Админ: {text}")
-            sent += 1
-            await asyncio.sleep(0.05)
-        except Exception:
-            continue
-    await message.answer(f"Отправлено {sent} сообщений.")
+    job = await broadcasts.create(parts[1])
+    await reply(message, f"Рассылка #{job.id} запущена. Прогресс: /broadcast_status {job.id}")
 
-@dp.message_handler(commands=['ban'])
+@dp.message_handler(commands=['broadcast_status'])
 @admin_only
-async def cmd_ban(message: Message):
+async def cmd_broadcast_status(message: Message):
     parts = message.text.split()
     if len(parts) < 2:
-        await message.answer("Использование: /ban <user_id>")
+        running = [j for j in broadcasts.jobs.values() if j.status == 'running']
+        await reply(message, "\n".join(j.summary() for j in running) or "Активных рассылок нет.")
         return
-    try:
-        uid = int(parts[1])
-        await run_db("UPDATE users SET banned = 1 WHERE id = ?", (uid,))
-        try:
-            await bot.send_message(uid, "⛔ Вы заблокированы администратором.")
-        except Exception:
-            pass
-        await message.answer("OK")
-    except Exception as e:
-        await message.answer("Ошибка: " + str(e))
+    job = await broadcasts.get(int(parts[1]))
+    await reply(message, job.summary() if job else "Рассылка не найдена.")
 
-@dp.message_handler(commands=['unban'])
+@dp.message_handler(commands=['broadcast_cancel'])
 @admin_only
-async def cmd_unban(message: Message):
+async def cmd_broadcast_cancel(message: Message):
     parts = message.text.split()
     if len(parts) < 2:
-        await message.answer("Использование: /unban <user_id>")
+        await reply(message, "Использование: /broadcast_cancel <id>")
+        return
+    ok = await broadcasts.cancel(int(parts[1]))
+    await reply(message, "OK" if ok else "Рассылка не выполняется.")
+
+# ---------------------------
+# Админ: массовые операции и выгрузка/загрузка таблиц (см. bulk.py)
+# ---------------------------
+# id — в аргументах команды или файлом (по id в строке, через пробел/запятую), на который команда отвечает
+FLAG_COMMANDS = {
+    'ban': ('banned', True, "⛔ Вы заблокированы администратором."),
+    'unban': ('banned', False, None),
+    'promote': ('vip', True, "⭐ Вам выдан VIP (администратор)."),
+    'demote': ('vip', False, "⭐ VIP снят."),
+}
+
+async def _download(document, suffix=''):
+    fd, path = tempfile.mkstemp(prefix="bot_upload_", suffix=suffix)
+    os.close(fd)
+    await bot.download_file_by_id(document.file_id, destination=path)
+    return path
+
+async def _command_ids(message: Message):
+    ids = bulk.parse_ids(message.get_args())
+    replied = message.reply_to_message
+    if replied and replied.document:
+        path = await _download(replied.document)
+        try:
+            ids += await asyncio.get_running_loop().run_in_executor(None, bulk.read_ids, path)
+        finally:
+            os.remove(path)
+    return list(dict.fromkeys(ids))
+
+async def _bulk_flag(message: Message, command: str):
+    flag, value, notice = FLAG_COMMANDS[command]
+    uids = await _command_ids(message)
+    if not uids:
+        await reply(message, f"Использование: /{command} <user_id> [user_id ...] или ответом на файл со списком id")
         return
-    uid = int(parts[1])
-    await run_db("UPDATE users SET banned = 0 WHERE id = ?", (uid,))
-    await message.answer("OK")
+    changed = await bulk.set_flag_bulk(storage, uids, flag, value)
+    if changed:
+        (m_vip if flag == 'vip' else m_banned).inc(len(changed) if value else -len(changed))
+    for uid in changed:
+        user_cache.update(uid, **{flag: value})
+        if flag == 'vip':
+            await state.set_vip(uid, value)
+        else:
+            # очередь в БД уже почищена той же транзакцией
+            await state.set_banned(uid, value, persist=False)
+    await reply(message, f"OK: изменено {len(changed)} из {len(uids)}")
+    if notice and changed:
+        # уведомления — в фоне и в полосе рассылок, чтобы не теснить диалоги
+        asyncio.ensure_future(_notify_all(changed, notice, priority=BROADCAST))
 
-@dp.message_handler(commands=['promote'])
+@dp.message_handler(commands=list(FLAG_COMMANDS))
 @admin_only
-async def cmd_promote(message: Message):
-    parts = message.text.split()
-    if len(parts) < 2:
-        await message.answer("Использование: /promote <user_id>")
+async def cmd_flag(message: Message):
+    await _bulk_flag(message, message.get_command(pure=True).lower())
+
+@dp.message_handler(commands=['export'])
+@admin_only
+async def cmd_export(message: Message):
+    args = message.get_args().split()
+    table = args[0] if args else ''
+    fmt = args[1] if len(args) > 1 else 'csv'
+    if table not in bulk.TABLES or fmt not in bulk.FORMATS:
+        await reply(message, "Использование: /export users|complaints [csv|jsonl]")
         return
-    uid = int(parts[1])
-    await run_db("UPDATE users SET vip = 1 WHERE id = ?", (uid,))
+    fd, path = tempfile.mkstemp(prefix=f"bot_{table}_", suffix=f".{fmt}")
+    os.close(fd)
     try:
-        await bot.send_message(uid, "⭐ Вам выдан VIP (администратор).")
-    except Exception:
-        pass
-    await message.answer("OK")
+        count = await bulk.export_table(storage, table, fmt, path)
+        filename = f"{table}_{datetime.now():%Y%m%d_%H%M}.{fmt}"
+
+        async def _send_file():
+            # файл открывается на каждую попытку: повтор после RetryAfter читает его с начала
+            with open(path, 'rb') as fh:
+                return await bot.send_document(message.chat.id, types.InputFile(fh, filename=filename),
+                                               caption=f"{table}: {count} строк")
+
+        await outbound.call(message.chat.id, _send_file)
+    finally:
+        os.remove(path)
 
-@dp.message_handler(commands=['demote'])
+@dp.message_handler(commands=['import'])
 @admin_only
-async def cmd_demote(message: Message):
-    parts = message.text.split()
-    if len(parts) < 2:
-        await message.answer("Использование: /demote <user_id>")
+async def cmd_import(message: Message):
+    table = message.get_args().strip().lower()
+    replied = message.reply_to_message
+    document = replied.document if replied else None
+    fmt = bulk.format_of(document.file_name) if document else None
+    if table not in bulk.TABLES or not fmt:
+        await reply(message, "Использование: /import users|complaints — ответом на файл .csv или .jsonl")
         return
-    uid = int(parts[1])
-    await run_db("UPDATE users SET vip = 0 WHERE id = ?", (uid,))
+    path = await _download(document, f".{fmt}")
+    stats = {}
+    error = None
     try:
-        await bot.send_message(uid, "⭐ VIP снят.")
-    except Exception:
-        pass
-    await message.answer("OK")
+        await bulk.import_table(storage, table, fmt, path, stats=stats)
+    except Exception as e:
+        logger.exception("Import of %s failed", table)
+        error = e
+    finally:
+        os.remove(path)
+    # записанные пачки остаются и при обрыве — кэши обновляем в любом случае
+    if table == 'users':
+        # флаги и профили могли поменяться у кого угодно
+        user_cache.clear()
+        await state.reload_flags()
+        await reconcile_metrics()
+    else:
+        await complaints.load()
+    imported, skipped = stats.get('imported', 0), stats.get('skipped', 0)
+    if error is not None:
+        await reply(message, f"{table}: загрузка прервана ({html.escape(str(error))}). "
+                             f"Уже записано {imported}, пропущено {skipped}")
+    else:
+        await reply(message, f"{table}: загружено {imported}, пропущено {skipped}")
 
 # ---------------------------
 # Обработка ошибок
 # ---------------------------
+async def _send_error_summary(text:str):
+    if ADMIN_ID:
+        await send_message(ADMIN_ID, text, parse_mode='HTML')
+
+# Ошибки копятся по отпечатку; админу — не больше одной сводки на отпечаток за окно
+error_stats = ErrorAggregator(_send_error_summary, window=ERROR_SUMMARY_WINDOW)
+
 async def except_handler(update, exception):
     try:
         uid = None
-        if hasattr(update, 'message') and update.message:
-            uid = update.message.chat.id
-            name = update.message.chat.first_name
-        else:
-            name = "unknown"
-        text = f"⛔ Произошла ошибка у пользователя {uid}\n\n<code>{exception}</code>"
-        if ADMIN_ID:
-            try:
-                await bot.send_message(ADMIN_ID, text, parse_mode='HTML')
-            except Exception:
-                logger.exception("Не удалось отправить ошибку админу.")
+        for event in (getattr(update, 'message', None), getattr(update, 'callback_query', None)):
+            if event is not None and event.from_user:
+                uid = event.from_user.id
+                break
+        error_stats.record(exception, uid)
         logger.exception("Error in update: %s", exception)
     except Exception as e:
-        logger.exception("Failed to notify admin: %s", e)
+        logger.exception("Failed to record error: %s", e)
+
+@dp.message_handler(commands=['errors'])
+@admin_only
+async def cmd_errors(message: Message):
+    top = error_stats.top(10)
+    if not top:
+        await reply(message, "Ошибок не было.")
+        return
+    header = f"Всего ошибок: {error_stats.total}, отпечатков: {len(error_stats)}"
+    for text in split_text([header] + [s.summary() for s in top], sep="\n\n"):
+        await reply(message, text, parse_mode='HTML')
 
 dp.register_errors_handler(except_handler)
 
+# Последним: aiogram отдаёт апдейт первому подходящему хендлеру, поэтому catch-all
+# регистрируется после всех команд (иначе /stats, /ban и т. п. до них не доходят)
+dp.register_message_handler(message_router, content_types=types.ContentType.ANY)
+
+# ---------------------------
+# Снятие зависшего: очередь дольше QUEUE_TTL и молчащие диалоги (см. sweeper.py)
+# ---------------------------
+async def _notify_all(uids, text, priority=NOTIFY):
+    failed = await bulk.notify_many(lambda uid: send_message(uid, text, priority=priority, reply_markup=kb_main()),
+                                    uids, concurrency=BROADCAST_CONCURRENCY)
+    if failed:
+        logger.info("Notices: %d of %d not delivered", failed, len(uids))
+
+async def _on_expired(queue_uids, pairs):
+    # в БД всё снято одной транзакцией Sweeper; здесь — кэш, Matcher, счётчик и уведомления
+    for uid in queue_uids:
+        cached = user_cache.get(uid)
+        if cached is not None and cached.get('conv_state') == fsm.SEARCHING:
+            user_cache.update(uid, conv_state=fsm.IDLE)
+    dialog_users = []
+    for u1, u2, cleared in pairs:
+        m_in_dialog.dec(cleared)
+        for uid in (u1, u2):
+            state.set_busy(uid, False)
+            user_cache.update(uid, partner=None, conv_state=fsm.IDLE)
+            dialog_users.append(uid)
+    await _notify_all(queue_uids, "⌛ Собеседник так и не нашёлся, поиск остановлен. Попробуйте ещё раз.")
+    await _notify_all(dialog_users, "❌ Диалог завершён: давно не было сообщений.")
+
+sweeper = Sweeper(storage, _on_expired, queue_ttl=QUEUE_TTL, dialog_idle=DIALOG_IDLE_TIMEOUT,
+                  shared=state.shared, drop=state.drop)
+metrics.gauge("queue_expired", "Queue entries removed after QUEUE_TTL", fn=lambda: sweeper.expired_queue)
+metrics.gauge("dialogs_expired", "Dialogs ended after DIALOG_IDLE_TIMEOUT", fn=lambda: sweeper.expired_dialogs)
+
 # ---------------------------
 # Запуск
 # ---------------------------
+metrics_runner = None
+reconcile_task = None
+rematch_task = None
+
+async def _reconcile_loop(interval=30):
+    # в кластере счётчики двигают все воркеры, каждый видит только свои изменения
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reconcile_metrics()
+        except Exception:
+            logger.exception("Metrics reconcile failed")
+
+async def _rematch_loop():
+    # дождавшиеся конца ожидания по интересам получают пару из общей очереди
+    while True:
+        await asyncio.sleep(MATCH_REMATCH_INTERVAL)
+        try:
+            for u1, u2 in await state.rematch():
+                await start_dialog(u1, u2)
+        except Exception:
+            logger.exception("Rematch failed")
+
+async def on_startup(dp):
+    global metrics_runner, reconcile_task, rematch_task
+    outbound.start()
+    await state.load()
+    await reconcile_metrics()
+    if state.shared:
+        reconcile_task = asyncio.ensure_future(_reconcile_loop())
+    if MATCH_BY_INTERESTS:
+        rematch_task = asyncio.ensure_future(_rematch_loop())
+    # сроки своих пользователей: апдейты делятся между воркерами по user id
+    await sweeper.load(owns=lambda uid: uid % WORKER_COUNT == WORKER_INDEX)
+    sweeper.start()
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(metrics, METRICS_HOST, METRICS_PORT + WORKER_INDEX)
+    history_writer.start()
+    if WORKER_INDEX == 0:
+        history_archiver.start()
+    await complaints.load()
+    complaints.start()
+    error_stats.start()
+    # рассылки ведёт воркер, которому приходят команды админа
+    if ADMIN_ID % WORKER_COUNT == WORKER_INDEX:
+        await broadcasts.resume_all()
+
+async def on_shutdown(dp):
+    for task in (reconcile_task, rematch_task):
+        if task:
+            task.cancel()
+    sweeper.stop()
+    history_archiver.stop()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    await broadcasts.stop()
+    await albums.close()
+    await complaints.stop()
+    error_stats.stop()
+    await outbound.stop()
+    await history_writer.close()
+    storage.close()
+    stop_logging()
+
 if __name__ == '__main__':
-    logger.info("Bot starting...")
-    start_polling(dp, skip_updates=True)
+    logger.info("Bot starting (%s)...", BOT_MODE)
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_HOST:
+            raise RuntimeError("WEBHOOK_HOST is not set. It is required when BOT_MODE=webhook.")
+        from webhook import run_webhook
+        run_webhook(dp, WEBHOOK_HOST, WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT,
+                    concurrency=WEBHOOK_CONCURRENCY, secret=WEBHOOK_SECRET,
+                    on_startup=on_startup, on_shutdown=on_shutdown, loop=loop)
+    elif BOT_MODE == 'worker':
+        if not WORKER_SOCKET:
+            raise RuntimeError("WORKER_SOCKET is not set. Workers are started by cluster.py.")
+        from webhook import run_worker
+        run_worker(dp, WORKER_SOCKET, concurrency=WEBHOOK_CONCURRENCY, max_pending=WORKER_MAX_PENDING,
+                   on_startup=on_startup, on_shutdown=on_shutdown, loop=loop)
+    else:
+        start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,157 @@
+# coding: utf-8
+"""
+Рассылки как фоновые задания.
+Получатели читаются из users порциями по курсору (id > last_uid), отправка идёт
+параллельно под общим token bucket, RetryAfter ставит на паузу весь bucket.
+Прогресс сохраняется в broadcast_jobs после каждой порции, поэтому прерванная
+рассылка продолжается с того же места после рестарта.
+"""
+
+import time
+import asyncio
+import logging
+
+from aiogram.utils import exceptions
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Получатель недоступен навсегда — повторять бессмысленно
+BLOCKED_ERRORS = (exceptions.BotBlocked, exceptions.UserDeactivated, exceptions.ChatNotFound,
+                  exceptions.CantInitiateConversation)
+
+
+class BroadcastJob:
+    def __init__(self, job_id, text, last_uid=0, sent=0, failed=0, blocked=0, status='running', created_at=None):
+        self.id = job_id
+        self.text = text
+        self.last_uid = last_uid
+        self.sent = sent
+        self.failed = failed
+        self.blocked = blocked
+        self.status = status
+        self.created_at = created_at or time.time()
+
+    def summary(self):
+        return f"Рассылка #{self.id} [{self.status}]: отправлено {self.sent}, ошибок {self.failed}, заблокировали {self.blocked}"
+
+
+class BroadcastManager:
+    def __init__(self, storage, send, rate=25.0, concurrency=10, chunk=200, on_done=None):
+        """send(uid, text) — корутина отправки; on_done(job) вызывается по завершении."""
+        self.storage = storage
+        self.send = send
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.chunk = chunk
+        self.on_done = on_done
+        self.jobs = {}
+        self._tasks = {}
+
+    async def create(self, text:str):
+        job = BroadcastJob(None, text)
+        rows = await self.storage.write(
+            "INSERT INTO broadcast_jobs (text, last_uid, sent, failed, blocked, status, created_at) "
+            "VALUES (?, 0, 0, 0, 0, 'running', ?) RETURNING id", (text, job.created_at), fetch=True)
+        job.id = rows[0][0]
+        self._start(job)
+        return job
+
+    async def resume_all(self):
+        rows = await self.storage.read(
+            "SELECT id, text, last_uid, sent, failed, blocked, status, created_at FROM broadcast_jobs WHERE status = 'running'")
+        for row in rows:
+            job = BroadcastJob(*row)
+            logger.info("Resuming broadcast #%s from uid %s", job.id, job.last_uid)
+            self._start(job)
+        return len(rows)
+
+    async def get(self, job_id:int):
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        rows = await self.storage.read(
+            "SELECT id, text, last_uid, sent, failed, blocked, status, created_at FROM broadcast_jobs WHERE id = ?", (job_id,))
+        return BroadcastJob(*rows[0]) if rows else None
+
+    async def cancel(self, job_id:int):
+        task = self._tasks.get(job_id)
+        if not task:
+            return False
+        task.cancel()
+        job = self.jobs[job_id]
+        job.status = 'cancelled'
+        await self._save(job)
+        return True
+
+    async def stop(self):
+        """Остановка при выключении бота: задания остаются 'running' и продолжатся после старта."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for job in self.jobs.values():
+            if job.status == 'running':
+                await self._save(job)
+
+    def _start(self, job):
+        self.jobs[job.id] = job
+        self._tasks[job.id] = asyncio.ensure_future(self._run(job))
+
+    async def _save(self, job):
+        await self.storage.write(
+            "UPDATE broadcast_jobs SET last_uid = ?, sent = ?, failed = ?, blocked = ?, status = ? WHERE id = ?",
+            (job.last_uid, job.sent, job.failed, job.blocked, job.status, job.id))
+
+    async def _run(self, job):
+        try:
+            while True:
+                rows = await self.storage.read(
+                    "SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?", (job.last_uid, self.chunk))
+                if not rows:
+                    break
+                queue = asyncio.Queue()
+                for (uid,) in rows:
+                    queue.put_nowait(uid)
+                workers = [self._worker(job, queue) for _ in range(min(self.concurrency, len(rows)))]
+                await asyncio.gather(*workers)
+                job.last_uid = rows[-1][0]
+                await self._save(job)
+            job.status = 'done'
+            await self._save(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Broadcast #%s failed: %s", job.id, e)
+            job.status = 'failed'
+            await self._save(job)
+        finally:
+            self._tasks.pop(job.id, None)
+        if self.on_done:
+            try:
+                await self.on_done(job)
+            except Exception:
+                logger.exception("Broadcast #%s on_done failed", job.id)
+
+    async def _worker(self, job, queue):
+        while not queue.empty():
+            uid = queue.get_nowait()
+            await self._send_one(job, uid)
+
+    async def _send_one(self, job, uid):
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self.send(uid, job.text)
+                job.sent += 1
+                return
+            except exceptions.RetryAfter as e:
+                logger.warning("Broadcast #%s: flood control, sleeping %ss", job.id, e.timeout)
+                self.bucket.pause(e.timeout)
+            except BLOCKED_ERRORS:
+                job.blocked += 1
+                return
+            except Exception as e:
+                logger.warning("Broadcast #%s: send to %s failed: %s", job.id, uid, e)
+                job.failed += 1
+                return
@@ -0,0 +1,223 @@
+# coding: utf-8
+"""
+Массовые операции админа и выгрузка/загрузка таблиц.
+Флаги vip/banned для списка id меняются одной транзакцией: SELECT тех, у кого флаг
+действительно поменяется, и executemany UPDATE — пачками по chunk id.
+Выгрузка users/complaints в CSV или JSONL идёт курсором (fetchmany) в потоке читателя
+прямо в файл, загрузка — из файла пачками по транзакции на пачку; память не зависит
+от размера таблицы.
+"""
+
+import re
+import csv
+import json
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+ID_RE = re.compile(r'\d+')
+FLAGS = ('vip', 'banned')
+FORMATS = ('csv', 'jsonl')
+
+TABLES = {
+    'users': ('id', 'username', 'name', 'sex', 'age', 'interests', 'vip', 'banned', 'created_at'),
+    'complaints': ('id', 'from_user', 'about_user', 'reason', 'created_at'),
+}
+# партнёр и состояние разговора не переносятся: на момент загрузки они уже неверны
+IMPORT_SQL = {
+    'users': """INSERT INTO users (id, username, name, sex, age, interests, vip, banned, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET username = excluded.username, name = excluded.name,
+                    sex = excluded.sex, age = excluded.age, interests = excluded.interests,
+                    vip = excluded.vip, banned = excluded.banned""",
+    'complaints': """INSERT OR IGNORE INTO complaints (id, from_user, about_user, reason, created_at)
+                     VALUES (?, ?, ?, ?, ?)""",
+}
+INTEGER_COLUMNS = {'id', 'age', 'vip', 'banned', 'from_user', 'about_user'}
+REAL_COLUMNS = {'created_at'}
+
+
+def parse_ids(text:str):
+    """Все числа из текста (через пробел, запятую, с новой строки) без повторов, в исходном порядке."""
+    return list(dict.fromkeys(int(x) for x in ID_RE.findall(text or "")))
+
+
+def read_ids(path:str):
+    ids = {}
+    with open(path, encoding='utf-8', errors='ignore') as fh:
+        for line in fh:
+            for x in ID_RE.findall(line):
+                ids[int(x)] = None
+    return list(ids)
+
+
+def format_of(filename:str):
+    ext = (filename or "").rsplit('.', 1)[-1].lower()
+    return ext if ext in FORMATS else None
+
+
+# ---------------------------
+# Флаги списком
+# ---------------------------
+async def set_flag_bulk(storage, uids, flag:str, value:bool, chunk=500):
+    """Ставит флаг всем uids одной транзакцией. Возвращает id, у которых он действительно поменялся."""
+    if flag not in FLAGS:
+        raise ValueError(f"unknown flag {flag!r}")
+    uids = list(uids)
+
+    def _tx(conn):
+        changed = []
+        for start in range(0, len(uids), chunk):
+            part = uids[start:start + chunk]
+            marks = ",".join("?" * len(part))
+            ids = [row[0] for row in conn.execute(
+                f"SELECT id FROM users WHERE id IN ({marks}) AND {flag} != ?", (*part, int(value)))]
+            conn.executemany(f"UPDATE users SET {flag} = ? WHERE id = ?", [(int(value), uid) for uid in ids])
+            if flag == 'banned' and value:
+                conn.executemany("DELETE FROM search_queue WHERE user_id = ?", [(uid,) for uid in ids])
+            changed.extend(ids)
+        return changed
+
+    return await storage.transaction(_tx, label=f"bulk {flag}")
+
+
+async def notify_many(send, uids, concurrency=10):
+    """send(uid) для всех uids, не больше concurrency одновременно. Возвращает число неудач.
+    Темп отправки держит SendScheduler; здесь только не плодим корутину на каждого получателя."""
+    it = iter(uids)
+    failed = 0
+
+    async def _worker():
+        nonlocal failed
+        for uid in it:
+            try:
+                await send(uid)
+            except Exception:
+                failed += 1
+
+    await asyncio.gather(*(_worker() for _ in range(max(1, concurrency))))
+    return failed
+
+
+# ---------------------------
+# Выгрузка
+# ---------------------------
+def _export_rows(conn, table, fmt, path, chunk):
+    columns = TABLES[table]
+    cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY id")
+    count = 0
+    with open(path, 'w', encoding='utf-8', newline='') as fh:
+        writer = csv.writer(fh) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(columns)
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows:
+                break
+            if writer:
+                writer.writerows(rows)
+            else:
+                fh.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+            count += len(rows)
+    return count
+
+
+async def export_table(storage, table:str, fmt:str, path:str, chunk=1000):
+    """Таблица -> файл path. Возвращает число строк."""
+    if table not in TABLES or fmt not in FORMATS:
+        raise ValueError(f"can't export {table!r} as {fmt!r}")
+    return await storage.read_with(lambda conn: _export_rows(conn, table, fmt, path, chunk),
+                                   label=f"export {table}")
+
+
+# ---------------------------
+# Загрузка
+# ---------------------------
+def _convert(column, value):
+    if value is None or value == '':
+        return None
+    if column in INTEGER_COLUMNS:
+        return int(value)
+    if column in REAL_COLUMNS:
+        # users.created_at — TEXT, у старых строк там бывает дата строкой
+        try:
+            return float(value)
+        except ValueError:
+            return str(value)
+    return str(value)
+
+
+def _decoded(fh, bad):
+    """Строки файла; не-UTF-8 строки пропускаются со счётом в bad[0]."""
+    for raw in fh:
+        try:
+            yield raw.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            bad[0] += 1
+
+
+def _records(fh, fmt, bad):
+    lines = _decoded(fh, bad)
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        while True:
+            try:
+                yield next(reader)
+            except StopIteration:
+                return
+            except csv.Error:
+                bad[0] += 1
+    else:
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                bad[0] += 1
+
+
+def _import_chunks(table, fmt, path, chunk):
+    """Пачки кортежей для IMPORT_SQL. Строки без id или с мусором пропускаются (счёт — в skipped)."""
+    columns = TABLES[table]
+    bad = [0]
+    batch = []
+    with open(path, 'rb') as fh:
+        for record in _records(fh, fmt, bad):
+            try:
+                row = tuple(_convert(column, record.get(column)) for column in columns)
+            except (TypeError, ValueError, AttributeError):
+                row = None
+            if row is None or row[0] is None:
+                bad[0] += 1
+                continue
+            batch.append(row)
+            if len(batch) >= chunk:
+                yield batch, bad[0]
+                batch, bad[0] = [], 0
+    if batch or bad[0]:
+        yield batch, bad[0]
+
+
+async def import_table(storage, table:str, fmt:str, path:str, chunk=1000, stats=None):
+    """Файл -> таблица, транзакция на пачку. Возвращает (загружено, пропущено).
+    stats (dict) обновляется по ходу: если загрузка оборвётся, в нём видно, сколько уже записано."""
+    if table not in TABLES or fmt not in FORMATS:
+        raise ValueError(f"can't import {table!r} from {fmt!r}")
+    stats = stats if stats is not None else {}
+    stats.update(imported=0, skipped=0)
+    loop = asyncio.get_running_loop()
+    chunks = _import_chunks(table, fmt, path, chunk)
+    while True:
+        # файл читается и разбирается в пуле потоков, по пачке за раз
+        item = await loop.run_in_executor(None, next, chunks, None)
+        if item is None:
+            break
+        rows, bad = item
+        stats['skipped'] += bad
+        if rows:
+            await storage.write(IMPORT_SQL[table], rows, many=True)
+            stats['imported'] += len(rows)
+    logger.info("Imported %s: %d rows, %d skipped", table, stats['imported'], stats['skipped'])
+    return stats['imported'], stats['skipped']
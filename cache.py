@@ -0,0 +1,85 @@
+# coding: utf-8
+"""
+Ограниченный LRU-кэш с TTL для строк пользователей.
+Обновляется write-through из тех же хелперов, что пишут в БД.
+"""
+
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize=50000, ttl=600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._loading = {}          # key -> [загрузок в полёте, была ли запись за это время]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[0] > time.monotonic()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        if item[0] <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def update(self, key, **fields):
+        """Меняет поля закэшированного dict; если записи нет — ничего не делает."""
+        self._mark_stale(key)
+        item = self._data.get(key)
+        if item is not None:
+            item[1].update(fields)
+
+    def pop(self, key):
+        self._mark_stale(key)
+        item = self._data.pop(key, None)
+        return item[1] if item else None
+
+    # ---------------------------
+    # Заполнение после промаха: запись, пришедшая во время чтения из БД,
+    # делает прочитанное значение устаревшим — такое в кэш не кладём.
+    # ---------------------------
+    def begin_load(self, key):
+        token = self._loading.setdefault(key, [0, False])
+        token[0] += 1
+        return token
+
+    def finish_load(self, key, value, token):
+        token[0] -= 1
+        if token[0] == 0 and self._loading.get(key) is token:
+            del self._loading[key]
+        if value is not None and not token[1]:
+            self.set(key, value)
+
+    def _mark_stale(self, key):
+        token = self._loading.get(key)
+        if token is not None:
+            token[1] = True
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "hit_ratio": ratio}
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Горизонтальный режим: один приёмник апдейтов и N процессов-воркеров.
+
+Приёмник забирает апдейты через getUpdates и раскладывает их по воркерам по id
+пользователя (key % N): апдейты одного пользователя всегда обрабатывает один процесс,
+и приходят они туда по порядку. Воркер — обычный bot.py с BOT_MODE=worker, который
+принимает пачки апдейтов на своём unix-сокете (webhook.run_worker).
+Очередь поиска и пары воркеры делят через общую SQLite в WAL (STATE_BACKEND=sqlite),
+поэтому пара, где собеседники попали в разные воркеры, работает: пересылка — это
+вызов Bot API из воркера отправителя, партнёр читается из общей БД.
+
+    WORKERS=4 python cluster.py
+
+Упавший воркер перезапускается; SIGTERM/SIGINT — мягкая остановка (приёмник дошлёт
+полученное, воркеры дообработают принятое).
+"""
+
+import os
+import sys
+import signal
+import asyncio
+import logging
+import tempfile
+import subprocess
+
+import aiohttp
+
+from webhook import raw_update_key
+from migrations import migrate
+from logsetup import setup_logging, settings_from_env
+
+# ---------------------------
+# Конфигурация (берётся из окружения)
+# ---------------------------
+TOKEN = os.getenv("TOKEN") or os.getenv("TG_BOT_TOKEN")
+BOT_API_SERVER = os.getenv("BOT_API_SERVER") or "https://api.telegram.org"
+DB_PATH = os.getenv("BOT_DB_PATH", "bot_data.db")
+LOG_FILE = os.getenv("BOT_LOG", "bot.log")
+WORKERS = int(os.getenv("WORKERS") or os.cpu_count() or 2)
+SOCKET_DIR = os.getenv("WORKER_SOCKET_DIR") or tempfile.gettempdir()
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", 20))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", 64))  # пачек в очереди на воркер до паузы в getUpdates
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+
+logger = logging.getLogger("cluster")
+
+_STOP = None
+
+
+class Receiver:
+    """getUpdates -> пачки по шардам -> POST /updates в unix-сокет воркера, по одной пачке за раз на воркер."""
+
+    def __init__(self, api_url:str, token:str, sockets, poll_timeout=20, queue_size=64):
+        self.api_url = f"{api_url.rstrip('/')}/bot{token}/"
+        self.sockets = list(sockets)
+        self.poll_timeout = poll_timeout
+        self.routed = [0] * len(self.sockets)
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in self.sockets]
+        self._stopping = False
+
+    def shard(self, data:dict):
+        return raw_update_key(data) % len(self.sockets)
+
+    async def _api(self, session, method, **params):
+        async with session.post(self.api_url + method, json=params) as resp:
+            payload = await resp.json()
+        if not payload.get("ok"):
+            raise RuntimeError(f"{method}: {payload.get('description')}")
+        return payload["result"]
+
+    async def poll(self):
+        timeout = aiohttp.ClientTimeout(total=self.poll_timeout + 10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            await self._api(session, "deleteWebhook")
+            offset = 0
+            while not self._stopping:
+                try:
+                    updates = await self._api(session, "getUpdates", offset=offset, limit=100,
+                                              timeout=self.poll_timeout)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning("getUpdates failed: %s", e)
+                    await asyncio.sleep(1)
+                    continue
+                if not updates:
+                    continue
+                batches = [[] for _ in self.sockets]
+                for data in updates:
+                    batches[self.shard(data)].append(data)
+                for index, batch in enumerate(batches):
+                    if batch:
+                        self.routed[index] += len(batch)
+                        await self._queues[index].put(batch)
+                offset = updates[-1]["update_id"] + 1
+
+    async def forward(self, index:int):
+        queue = self._queues[index]
+        connector = aiohttp.UnixConnector(path=self.sockets[index])
+        async with aiohttp.ClientSession(connector=connector) as session:
+            stop = False
+            while not stop:
+                batch = await queue.get()
+                if batch is _STOP:
+                    break
+                # склеиваем всё, что накопилось, порядок при этом сохраняется
+                while not queue.empty():
+                    more = queue.get_nowait()
+                    if more is _STOP:
+                        stop = True
+                        break
+                    batch.extend(more)
+                await self._deliver(session, index, batch)
+
+    async def _deliver(self, session, index, batch):
+        delay = 0.1
+        while True:
+            try:
+                async with session.post("http://worker/updates", json=batch) as resp:
+                    if resp.status == 200:
+                        return
+                    logger.warning("Worker %d answered %d, retrying", index, resp.status)
+            except aiohttp.ClientError as e:
+                # воркер ещё стартует или перезапускается
+                logger.debug("Worker %d unavailable: %s", index, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 2.0)
+
+    async def stop(self):
+        self._stopping = True
+        for queue in self._queues:
+            await queue.put(_STOP)
+
+
+class Supervisor:
+    def __init__(self, count:int, socket_dir:str):
+        self.count = count
+        self.sockets = [os.path.join(socket_dir, f"bot-worker-{os.getpid()}-{i}.sock") for i in range(count)]
+        self.procs = [None] * count
+        self._stopping = False
+
+    def spawn(self, index:int):
+        env = dict(os.environ, BOT_MODE="worker", STATE_BACKEND="sqlite", WORKER_INDEX=str(index),
+                   WORKER_COUNT=str(self.count), WORKER_SOCKET=self.sockets[index])
+        self.procs[index] = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+        logger.info("Worker %d started (pid %d)", index, self.procs[index].pid)
+
+    async def watch(self, interval=1.0):
+        for i in range(self.count):
+            self.spawn(i)
+        while not self._stopping:
+            await asyncio.sleep(interval)
+            for i, proc in enumerate(self.procs):
+                if proc.poll() is not None and not self._stopping:
+                    logger.error("Worker %d exited with %s, restarting", i, proc.returncode)
+                    self.spawn(i)
+
+    async def stop(self, timeout=35.0):
+        self._stopping = True
+        for proc in self.procs:
+            if proc and proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        loop = asyncio.get_running_loop()
+        for proc in self.procs:
+            if proc is None:
+                continue
+            try:
+                await loop.run_in_executor(None, proc.wait, timeout)
+            except subprocess.TimeoutExpired:
+                logger.warning("Worker pid %d did not stop in time, killing", proc.pid)
+                proc.kill()
+        for path in self.sockets:
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+async def main():
+    # схему обновляем один раз здесь, до старта воркеров
+    migrate(DB_PATH)
+    supervisor = Supervisor(WORKERS, SOCKET_DIR)
+    receiver = Receiver(BOT_API_SERVER, TOKEN, supervisor.sockets, POLL_TIMEOUT, SHARD_QUEUE_SIZE)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    watcher = asyncio.ensure_future(supervisor.watch())
+    forwarders = [asyncio.ensure_future(receiver.forward(i)) for i in range(WORKERS)]
+    poller = asyncio.ensure_future(receiver.poll())
+    logger.info("Cluster started: %d workers", WORKERS)
+    await asyncio.wait([asyncio.ensure_future(stop.wait()), poller], return_when=asyncio.FIRST_COMPLETED)
+
+    if poller.done() and not poller.cancelled() and poller.exception():
+        logger.error("Receiver failed: %r", poller.exception())
+    logger.info("Cluster stopping...")
+    poller.cancel()
+    await receiver.stop()
+    await asyncio.wait(forwarders, timeout=10)
+    await supervisor.stop()
+    watcher.cancel()
+    logger.info("Cluster stopped, routed per worker: %s", receiver.routed)
+
+
+if __name__ == '__main__':
+    if not TOKEN:
+        raise RuntimeError("TOKEN is not set. Set TOKEN in environment variables.")
+    root, ext = os.path.splitext(LOG_FILE)
+    setup_logging(f"{root}.cluster{ext}", **settings_from_env())
+    asyncio.run(main())
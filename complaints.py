@@ -0,0 +1,186 @@
+# coding: utf-8
+"""
+Агрегация жалоб.
+Жалоба пишется в complaints как раньше, но админу уходит не сразу: за окно digest_interval
+жалобы группируются по about_user и отправляются одним дайджестом.
+Число разных жалобщиков на пользователя за horizon секунд — индекс в памяти
+about_user -> {from_user: время последней жалобы}; при старте он загружается одним
+GROUP BY и дальше поддерживается на каждой жалобе. Порог ban_threshold разных
+жалобщиков — автоматический бан.
+Дайджест режется на сообщения по лимиту Telegram; если отправка не удалась, жалобы
+возвращаются в накопленное и уйдут следующим дайджестом.
+"""
+
+import html
+import time
+import asyncio
+import logging
+
+from outbound import MESSAGE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+LOAD_SQL = """SELECT about_user, from_user, MAX(created_at) FROM complaints
+              WHERE created_at >= ? GROUP BY about_user, from_user"""
+REPORTERS_SQL = """SELECT from_user, MAX(created_at) FROM complaints
+                   WHERE about_user = ? AND created_at >= ? GROUP BY from_user"""
+MAX_REASONS = 3
+REASON_CHARS = 100   # в дайджесте; полный текст — в complaints
+
+
+def _short(reason):
+    reason = reason or ""
+    return reason if len(reason) <= REASON_CHARS else reason[:REASON_CHARS - 1] + "…"
+
+
+class ComplaintAggregator:
+    def __init__(self, storage, notify, ban=None, digest_interval=300.0, ban_threshold=5,
+                 horizon=24 * 3600, shared=False, top=20):
+        """
+        notify(text) — отправка дайджеста админу; ban(uid) -> bool — автобан (True, если забанен сейчас).
+        shared — жалобы пишут и другие процессы: перед проверкой порога reporters перечитываются из БД.
+        """
+        self.storage = storage
+        self.notify = notify
+        self.ban = ban
+        self.digest_interval = digest_interval
+        self.ban_threshold = ban_threshold
+        self.horizon = horizon
+        self.shared = shared
+        self.top = top
+        self.total = 0
+        self.auto_banned = 0
+        self._reporters = {}   # about_user -> {from_user: ts}
+        self._pending = {}     # about_user -> {"count", "reporters": set, "reasons": set, "banned"}
+        self._task = None
+
+    # ---------------------------
+    # Индекс жалобщиков
+    # ---------------------------
+    async def load(self):
+        since = time.time() - self.horizon
+        self._reporters.clear()
+        for about, reporter, ts in await self.storage.read(LOAD_SQL, (since,)):
+            self._reporters.setdefault(about, {})[reporter] = ts
+        logger.info("Complaint index loaded: %d reported users", len(self._reporters))
+
+    def reporters(self, about_user:int, now=None):
+        """Сколько разных пользователей жаловались на about_user за horizon."""
+        reporters = self._reporters.get(about_user)
+        if not reporters:
+            return 0
+        since = (now or time.time()) - self.horizon
+        for uid in [u for u, ts in reporters.items() if ts < since]:
+            del reporters[uid]
+        if not reporters:
+            del self._reporters[about_user]
+        return len(reporters)
+
+    def _prune(self, now):
+        for about in list(self._reporters):
+            self.reporters(about, now)
+
+    # ---------------------------
+    # Поток жалоб
+    # ---------------------------
+    async def add(self, from_user:int, about_user:int, reason:str):
+        now = time.time()
+        self.total += 1
+        if self.shared:
+            rows = await self.storage.read(REPORTERS_SQL, (about_user, now - self.horizon))
+            self._reporters[about_user] = {u: ts for u, ts in rows}
+        self._reporters.setdefault(about_user, {})[from_user] = now
+        item = self._pending.get(about_user)
+        if item is None:
+            item = self._pending[about_user] = {"count": 0, "reporters": set(), "reasons": set(), "banned": False}
+        item["count"] += 1
+        item["reporters"].add(from_user)
+        if len(item["reasons"]) < MAX_REASONS:
+            item["reasons"].add(_short(reason))
+        distinct = self.reporters(about_user, now)
+        if self.ban and self.ban_threshold and distinct >= self.ban_threshold and not item["banned"]:
+            try:
+                if await self.ban(about_user):
+                    item["banned"] = True
+                    self.auto_banned += 1
+                    logger.warning("Auto-banned %s: %d distinct reporters", about_user, distinct)
+            except Exception:
+                logger.exception("Auto-ban of %s failed", about_user)
+        return distinct
+
+    def pending(self):
+        return sum(item["count"] for item in self._pending.values())
+
+    def digest(self, pending):
+        """
+        Дайджест по pending (about_user -> item): [(текст, [about_user, ...])] — сообщения в пределах
+        длины и чьи жалобы в каждом (не попавшие в top — в том, где строка «…и ещё»).
+        """
+        rows = sorted(pending.items(), key=lambda kv: (kv[1]["banned"], kv[1]["count"]), reverse=True)
+        total = sum(item["count"] for item in pending.values())
+        entries = [([], f"⚠️ Жалобы: {total} на {len(pending)} польз.")]
+        for about, item in rows[:self.top]:
+            reporters = sorted(item["reporters"])
+            shown = ", ".join(f"<a href='tg://user?id={u}'>{u}</a>" for u in reporters[:5])
+            more = f" и ещё {len(reporters) - 5}" if len(reporters) > 5 else ""
+            mark = " ⛔ автобан" if item["banned"] else ""
+            entries.append(([about], f"• <a href='tg://user?id={about}'>{about}</a>: {item['count']} "
+                                          f"(разных за {self.horizon / 3600:g} ч: {self.reporters(about)}){mark}"
+                                          f"\n  от {shown}{more}\n"
+                                          f"  {html.escape('; '.join(sorted(item['reasons'])))}"))
+        if len(rows) > self.top:
+            entries.append(([about for about, _ in rows[self.top:]], f"…и ещё {len(rows) - self.top} польз."))
+        chunks = []
+        for abouts, line in entries:
+            line = line[:MESSAGE_LIMIT]
+            if chunks and len(chunks[-1][0]) + 1 + len(line) <= MESSAGE_LIMIT:
+                chunks[-1][0] += "\n" + line
+                chunks[-1][1].extend(abouts)
+            else:
+                chunks.append([line, list(abouts)])
+        return [(text, abouts) for text, abouts in chunks]
+
+    def _restore(self, pending):
+        """Возвращает неотправленное в накопленное (туда могли прийти новые жалобы)."""
+        for about, item in pending.items():
+            current = self._pending.get(about)
+            if current is None:
+                self._pending[about] = item
+                continue
+            current["count"] += item["count"]
+            current["reporters"] |= item["reporters"]
+            current["reasons"] = set(sorted(current["reasons"] | item["reasons"])[:MAX_REASONS])
+            current["banned"] = current["banned"] or item["banned"]
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        chunks = self.digest(pending)
+        for i, (text, _) in enumerate(chunks):
+            try:
+                await self.notify(text)
+            except Exception:
+                logger.exception("Can't send complaint digest")
+                # уже доставленные части второй раз не шлём — возвращаем только свою и следующие
+                self._restore({about: pending[about] for _, abouts in chunks[i:] for about in abouts})
+                return
+
+    # ---------------------------
+    # Фоновая отправка
+    # ---------------------------
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.digest_interval)
+            await self.flush()
+            self._prune(time.time())
+
+    async def stop(self):
+        """Останавливает таймер и отправляет то, что накопилось."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
@@ -0,0 +1,162 @@
+# coding: utf-8
+"""
+Агрегация ошибок вместо сообщения админу на каждое исключение.
+Отпечаток — тип исключения + место в коде (самый глубокий кадр трейсбека из нашего
+кода, а не из библиотек). По отпечатку копятся счётчики и несколько user id для примера;
+таблица ограничена (вытесняются давно не встречавшиеся). Админу по каждому отпечатку
+уходит не больше одной сводки за window секунд: первая — сразу, остальное — итогом окна.
+В сводке — не больше max_report самых частых отпечатков, она режется на сообщения по лимиту
+Telegram; счётчики «новых» сбрасываются только после успешной отправки.
+"""
+
+import os
+import time
+import html
+import asyncio
+import hashlib
+import logging
+import traceback
+from collections import OrderedDict
+
+from outbound import split_text
+
+logger = logging.getLogger(__name__)
+
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _location(exc):
+    frames = traceback.extract_tb(exc.__traceback__) if exc.__traceback__ else []
+    if not frames:
+        return "?"
+    ours = [f for f in frames if os.path.abspath(f.filename).startswith(_PROJECT_DIR)
+            and 'site-packages' not in f.filename]
+    frame = (ours or frames)[-1]
+    return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+
+
+def fingerprint(exc):
+    """(отпечаток, тип, место) — одинаковые ошибки из одного места дают один отпечаток."""
+    kind = type(exc).__qualname__
+    location = _location(exc)
+    digest = hashlib.sha1(f"{kind}|{location}".encode()).hexdigest()[:8]
+    return digest, kind, location
+
+
+class ErrorStats:
+    __slots__ = ('fp', 'kind', 'location', 'message', 'count', 'unreported', 'users',
+                 'first_seen', 'last_seen', 'notified_at')
+
+    def __init__(self, fp, kind, location, message, now):
+        self.fp = fp
+        self.kind = kind
+        self.location = location
+        self.message = message
+        self.count = 0
+        self.unreported = 0   # случаи после последней сводки
+        self.users = []
+        self.first_seen = now
+        self.last_seen = now
+        self.notified_at = None
+
+    def summary(self, now=None):
+        now = now or time.time()
+        users = ", ".join(str(u) for u in self.users) or "—"
+        return (f"<code>{self.fp}</code> {html.escape(self.kind)} × {self.count} "
+                f"(новых {self.unreported}), последняя {now - self.last_seen:.0f} с назад\n"
+                f"  {html.escape(self.location)}: {html.escape(self.message)}\n"
+                f"  пользователи: {users}")
+
+
+class ErrorAggregator:
+    def __init__(self, notify=None, window=300.0, max_fingerprints=500, sample_users=5, max_report=15):
+        """notify(text) — корутина отправки админу (None — только учёт)."""
+        self.notify = notify
+        self.max_report = max_report
+        self.window = window
+        self.max_fingerprints = max_fingerprints
+        self.sample_users = sample_users
+        self.total = 0
+        self.evicted = 0
+        self._table = OrderedDict()   # fp -> ErrorStats, от давно не встречавшихся к свежим
+        self._task = None
+
+    def __len__(self):
+        return len(self._table)
+
+    def record(self, exc, user_id=None):
+        """Учитывает исключение. Возвращает его ErrorStats."""
+        now = time.time()
+        fp, kind, location = fingerprint(exc)
+        stats = self._table.get(fp)
+        if stats is None:
+            stats = self._table[fp] = ErrorStats(fp, kind, location, str(exc)[:200], now)
+            while len(self._table) > self.max_fingerprints:
+                self._table.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._table.move_to_end(fp)
+        self.total += 1
+        stats.count += 1
+        stats.unreported += 1
+        stats.last_seen = now
+        stats.message = str(exc)[:200]
+        if user_id is not None and user_id not in stats.users:
+            stats.users.append(user_id)
+            del stats.users[:-self.sample_users]
+        if stats.notified_at is None or now - stats.notified_at >= self.window:
+            self._report([stats], now)
+        return stats
+
+    def top(self, n=10):
+        return sorted(self._table.values(), key=lambda s: s.count, reverse=True)[:n]
+
+    def _report(self, items, now):
+        if not self.notify or not items:
+            return
+        # остальные не трогаем: они попадут в одну из следующих сводок
+        items = sorted(items, key=lambda s: s.unreported, reverse=True)
+        rest = len(items) - self.max_report
+        items = items[:self.max_report]
+        parts = ["⛔ Ошибки бота:"] + [s.summary(now) for s in items]
+        if rest > 0:
+            parts.append(f"…и ещё {rest} отпечатков, /errors")
+        # notified_at — сразу, чтобы новые случаи не слали сводку, пока эта в пути;
+        # unreported — только после отправки (случаи, пришедшие за это время, сохраняются)
+        sent = [(s, s.unreported, s.notified_at) for s in items]
+        for s in items:
+            s.notified_at = now
+        asyncio.ensure_future(self._send(split_text(parts, sep="\n\n"), sent))
+
+    async def _send(self, texts, sent):
+        try:
+            for text in texts:
+                await self.notify(text)
+        except Exception:
+            # сюда не пишем record(): ошибка отправки сводки не должна порождать новую сводку
+            logger.exception("Can't send error summary")
+            for s, _, notified_at in sent:
+                s.notified_at = notified_at   # попробуем снова при следующем flush
+            return
+        for s, reported, _ in sent:
+            s.unreported -= reported
+
+    def flush(self, now=None):
+        """Итоги окна: отпечатки с новыми случаями, по которым сводка была давно."""
+        now = now or time.time()
+        due = [s for s in self._table.values()
+               if s.unreported and (s.notified_at is None or now - s.notified_at >= self.window)]
+        self._report(due, now)
+
+    def start(self, interval=None):
+        self._task = asyncio.ensure_future(self._run(interval or min(self.window, 60)))
+
+    async def _run(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.flush()
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
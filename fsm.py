@@ -0,0 +1,70 @@
+# coding: utf-8
+"""
+Состояние разговора с пользователем и маршрутизация сообщений по нему.
+Состояние хранится в users.conv_state (и вместе со строкой пользователя — в кэше),
+диалог определяется по users.partner: партнёр есть — in_dialog, что бы ни было записано.
+Маршрут — поиск в словаре по (состояние, текст кнопки/команда), затем по тексту для
+любого состояния, затем обработчик состояния по умолчанию; фильтры не перебираются.
+"""
+
+IDLE = 'idle'
+SEARCHING = 'searching'
+IN_DIALOG = 'in_dialog'
+AWAITING_AGE = 'awaiting_age'
+AWAITING_INTERESTS = 'awaiting_interests'
+
+STATES = (IDLE, SEARCHING, IN_DIALOG, AWAITING_AGE, AWAITING_INTERESTS)
+OUTSIDE_DIALOG = (IDLE, SEARCHING, AWAITING_AGE, AWAITING_INTERESTS)
+
+
+def current(user):
+    """Состояние по строке пользователя (dict из get_user)."""
+    if not user:
+        return IDLE
+    if user.get('partner'):
+        return IN_DIALOG
+    value = user.get('conv_state') or IDLE
+    # диалог уже закончен (партнёра нет), а запись осталась — считаем, что в меню
+    return IDLE if value == IN_DIALOG or value not in STATES else value
+
+
+def route_keys(text):
+    """Ключи для поиска: весь текст, для команды — ещё и сама команда без аргументов и @бота."""
+    if not text:
+        return ()
+    key = text.strip().lower()
+    if key.startswith('/'):
+        command = key.split(maxsplit=1)[0].split('@', 1)[0]
+        if command != key:
+            return key, command
+    return key,
+
+
+class Router:
+    def __init__(self):
+        self._routes = {}     # (state | None, ключ) -> handler; None — любое состояние
+        self._defaults = {}   # state -> handler
+
+    def on(self, *keys, states=None):
+        """Обработчик кнопок/команд keys в состояниях states (None — в любом)."""
+        def decorator(handler):
+            for key in keys:
+                for st in (states or (None,)):
+                    self._routes[(st, key.lower())] = handler
+            return handler
+        return decorator
+
+    def default(self, *states):
+        """Обработчик всего остального в этих состояниях (без него сообщение игнорируется)."""
+        def decorator(handler):
+            for st in states:
+                self._defaults[st] = handler
+            return handler
+        return decorator
+
+    def resolve(self, state, text):
+        for key in route_keys(text):
+            handler = self._routes.get((state, key)) or self._routes.get((None, key))
+            if handler is not None:
+                return handler
+        return self._defaults.get(state)
@@ -0,0 +1,461 @@
+# coding: utf-8
+"""
+История сообщений: фоновая запись, секционирование по времени, архив.
+Записи копятся в ограниченной очереди (put ждёт, если она полна) и сбрасываются
+пачками. Таблица на каждые PARTITION_SECONDS (history_p<номер>), в ней на каждого
+пользователя за сброс — одна строка-блок; короткие блоки хранятся как есть, длинные
+сжимаются zlib. Закрытая секция уплотняется: блоки пользователя сливаются в крупные
+сжатые (history_c<номер>), исходная таблица удаляется; в ещё открытой секции раз в проход
+сливается хвост мелких блоков пользователя (от каждого сброса — свой блок), чтобы горячая
+таблица не была больше, чем строки по сообщению. Секции старше срока хранения
+выгружаются в gzip-файлы и удаляются DROP TABLE (без построчных DELETE), место
+возвращается через PRAGMA incremental_vacuum.
+На пользователя хранится около keep последних сообщений: когда у него со времени прошлой
+обрезки набирается keep/2 новых, при сбросе блоки, целиком лежащие за keep последними,
+удаляются во всех секциях той же транзакцией (и ещё раз — при слиянии мелких блоков).
+Чтение — постранично с курсором (секция, сколько её сообщений старше страницы): по (id, count)
+блоков пользователя в секции находятся нужные, данные читаются только у них.
+"""
+
+import os
+import gzip
+import json
+import time
+import zlib
+import asyncio
+import logging
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+_STOP = None
+
+PARTITION_SECONDS = 7 * 24 * 3600  # ширина секции; менять нельзя — номера секций в именах таблиц
+BLOCK_MAX_ROWS = 200
+COMPRESS_MIN_BYTES = 256  # короче zlib почти не выигрывает, а заголовок и CPU тратит
+HOT_PREFIX = "history_p"
+COMPACT_PREFIX = "history_c"
+
+
+def partition_of(ts:float):
+    return int(ts // PARTITION_SECONDS)
+
+
+def partition_table(number:int, prefix=HOT_PREFIX):
+    return f"{prefix}{number}"
+
+
+def partition_ddl(number:int, prefix=HOT_PREFIX, table=None):
+    table = table or partition_table(number, prefix)
+    index = f"idx_{partition_table(number, prefix)}_user"
+    return [f"""CREATE TABLE IF NOT EXISTS {table} (
+                   id INTEGER PRIMARY KEY,
+                   user_id INTEGER NOT NULL,
+                   count INTEGER,
+                   data BLOB
+               )""",
+            f"CREATE INDEX IF NOT EXISTS {index} ON {table} (user_id, id)"]
+
+
+def encode_block(rows):
+    """[(direction, content, created_at), ...] по времени -> блок (JSON, длинный — сжатый zlib). Время — до секунды."""
+    payload = json.dumps([(d, c, int(ts)) for d, c, ts in rows], ensure_ascii=False, separators=(',', ':')).encode()
+    return zlib.compress(payload, 6) if len(payload) >= COMPRESS_MIN_BYTES else payload
+
+
+def decode_block(data):
+    data = bytes(data)
+    return json.loads(data if data[:1] == b'[' else zlib.decompress(data))
+
+
+def insert_blocks(conn, groups, table=None):
+    """
+    groups: {(секция, user_id): [(direction, content, created_at), ...]} -> блоки. Вызывается в транзакции.
+    table — писать всё в эту таблицу (уплотнение), иначе в горячую таблицу секции.
+    """
+    blocks = 0
+    for (number, uid), rows in groups.items():
+        target = table or partition_table(number)
+        for start in range(0, len(rows), BLOCK_MAX_ROWS):
+            chunk = rows[start:start + BLOCK_MAX_ROWS]
+            conn.execute(f"INSERT INTO {target} (user_id, count, data) VALUES (?, ?, ?)",
+                         (uid, len(chunk), encode_block(chunk)))
+            blocks += 1
+    return blocks
+
+
+def _vacuum_freelist(conn):
+    # sqlite3 делает один шаг PRAGMA incremental_vacuum, а шаг освобождает одну страницу —
+    # поэтому по выражению на страницу (~15 мкс каждое)
+    for _ in range(conn.execute("PRAGMA freelist_count").fetchone()[0]):
+        conn.execute("PRAGMA incremental_vacuum(1)")
+
+
+PARTITIONS_SQL = ("SELECT name FROM sqlite_master WHERE type = 'table' AND "
+                  "(name LIKE 'history_p%' OR name LIKE 'history_c%')")
+
+
+def _partitions(rows):
+    tables = {}
+    for (name,) in rows:
+        prefix, number = name[:len(HOT_PREFIX)], name[len(HOT_PREFIX):]
+        if number.isdigit() and (prefix == COMPACT_PREFIX or int(number) not in tables):
+            tables[int(number)] = name
+    return sorted(tables.items())
+
+
+async def list_partitions(storage):
+    """[(номер, таблица)] по возрастанию; у уплотнённой секции — history_c."""
+    return _partitions(await storage.read(PARTITIONS_SQL))
+
+
+def trim_user(conn, user_id:int, keep:int, partitions):
+    """
+    Удаляет блоки user_id, целиком лежащие за keep новейшими сообщениями. Вызывается в транзакции;
+    partitions — [(номер, таблица)] по возрастанию. Блок на границе остаётся целиком.
+    """
+    seen = 0
+    for _, table in reversed(partitions):
+        if seen >= keep:
+            conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+            continue
+        for block_id, count in conn.execute(f"SELECT id, count FROM {table} WHERE user_id = ? ORDER BY id DESC",
+                                            (user_id,)).fetchall():
+            seen += count
+            if seen >= keep:
+                conn.execute(f"DELETE FROM {table} WHERE user_id = ? AND id < ?", (user_id, block_id))
+                break
+
+
+async def _has_rows(storage, table, user_id):
+    return bool(await storage.read(f"SELECT 1 FROM {table} WHERE user_id = ? LIMIT 1", (user_id,)))
+
+
+async def history_page(storage, user_id:int, cursor=None, limit=10):
+    """
+    Страница истории от новых к старым: ([(direction, content, created_at)], следующий курсор или None).
+    cursor — (секция, сколько сообщений секции старше уже показанного; 0 — вся секция). Позиция
+    считается от старых сообщений, поэтому её не сдвигают ни новые сообщения, ни слияние и
+    уплотнение блоков: по (id, count) блоков находятся нужные, читаются только они.
+    """
+    items = []
+    part, end = cursor or (None, 0)
+    partitions = [(n, t) for n, t in reversed(await list_partitions(storage)) if part is None or n <= part]
+    for i, (number, table) in enumerate(partitions):
+        blocks = await storage.read(f"SELECT id, count FROM {table} WHERE user_id = ? ORDER BY id", (user_id,))
+        total = sum(count for _, count in blocks)
+        stop = min(end, total) if number == part and end else total
+        start = max(0, stop - (limit - len(items)))
+        spans, pos = [], 0
+        for block_id, count in blocks:
+            if pos < stop and pos + count > start:
+                spans.append((block_id, pos))
+            pos += count
+        if spans:
+            marks = ",".join("?" * len(spans))
+            data = dict(await storage.read(f"SELECT id, data FROM {table} WHERE id IN ({marks})",
+                                           [block_id for block_id, _ in spans]))
+            page = []
+            for block_id, offset in spans:
+                page.extend(tuple(m) for m in decode_block(data[block_id])[max(0, start - offset):stop - offset])
+            items.extend(reversed(page))
+        if len(items) < limit:
+            continue
+        if start > 0:
+            return items, (number, start)
+        for older, older_table in partitions[i + 1:]:
+            if await _has_rows(storage, older_table, user_id):
+                return items, (older, 0)
+        break
+    return items, None
+
+
+class HistoryWriter:
+    def __init__(self, storage, keep=50, batch_size=500, max_queue=10000, flush_interval=0.5):
+        """keep — сколько последних сообщений хранить на пользователя (0 — без ограничения, только срок хранения)."""
+        self.storage = storage
+        self.keep = keep
+        self.trim_every = max(1, keep // 2)
+        # uid -> сообщений с последней обрезки; потерянный счёт только откладывает обрезку до слияния
+        self._untrimmed = LRUCache(maxsize=100000, ttl=3600)
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.blocks = 0
+        self.flushes = 0
+        self._created = set()   # секции, для которых уже выполнен CREATE TABLE
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.ensure_future(self._run())
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue else 0
+
+    async def put(self, user_id:int, direction:str, content:str):
+        await self._queue.put((user_id, direction, content, time.time()))
+
+    async def close(self):
+        """Дописывает всё, что уже в очереди, и останавливает writer."""
+        if self._task is None:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        groups = {}
+        for uid, direction, content, ts in batch:
+            groups.setdefault((partition_of(ts), uid), []).append((direction, content, ts))
+        new = {number for number, _ in groups} - self._created
+        trim = []
+        if self.keep:
+            for (_, uid), rows in groups.items():
+                pending = self._untrimmed.get(uid, 0) + len(rows)
+                self._untrimmed.set(uid, pending)
+                if pending >= self.trim_every:
+                    trim.append(uid)
+
+        def _tx(conn):
+            for number in new:
+                for sql in partition_ddl(number):
+                    conn.execute(sql)
+            # сжатие — здесь, в потоке писателя, а не в event loop
+            blocks = insert_blocks(conn, groups)
+            if trim:
+                partitions = _partitions(conn.execute(PARTITIONS_SQL).fetchall())
+                for uid in set(trim):
+                    trim_user(conn, uid, self.keep, partitions)
+            return blocks
+
+        try:
+            self.blocks += await self.storage.transaction(_tx, label="history flush")
+            self._created |= new
+            for uid in trim:
+                self._untrimmed.pop(uid)
+            self.written += len(batch)
+            self.flushes += 1
+        except Exception as e:
+            logger.exception("History flush failed, %d rows lost: %s", len(batch), e)
+
+
+class HistoryArchiver:
+    def __init__(self, storage, retention_days=30, archive_dir="history_archive", interval=3600.0,
+                 chunk=2000, compact_delay=3600.0, merge_blocks=8, merge_users=100, keep=50):
+        """
+        archive_dir=None — старые секции просто удаляются.
+        compact_delay — сколько ждать после конца секции перед уплотнением (запоздавшие сбросы).
+        merge_blocks — со скольких неполных блоков подряд они сливаются в открытой секции (0 — нет);
+        merge_users — пользователей на транзакцию слияния; keep — как у HistoryWriter, при слиянии
+        лишнее сверх него отбрасывается.
+        """
+        self.storage = storage
+        self.retention = retention_days * 86400
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.chunk = chunk
+        self.compact_delay = compact_delay
+        self.merge_blocks = merge_blocks
+        self.merge_users = merge_users
+        self.keep = keep
+        self.merged = 0
+        self.archived = []
+        self.compacted = []
+        self._task = None
+
+    async def expired(self, now=None):
+        oldest = partition_of((now or time.time()) - self.retention)
+        return [(n, table) for n, table in await list_partitions(self.storage) if n < oldest]
+
+    async def sealed(self, now=None):
+        """Горячие таблицы закрытых секций — кандидаты на уплотнение."""
+        current = partition_of((now or time.time()) - self.compact_delay)
+        return [n for n, table in await list_partitions(self.storage)
+                if n < current and table == partition_table(n)]
+
+    # ---------------------------
+    # Уплотнение
+    # ---------------------------
+    async def compact(self, number):
+        """Блоки каждого пользователя секции -> крупные сжатые блоки в history_c<n>."""
+        source = partition_table(number)
+        target = partition_table(number, COMPACT_PREFIX)
+        tmp = target + "_tmp"
+
+        def _prepare(conn):
+            conn.execute(f"DROP TABLE IF EXISTS {tmp}")
+            for sql in partition_ddl(number, COMPACT_PREFIX, table=tmp):
+                conn.execute(sql)
+
+        def _merge(conn, rows):
+            groups = {}
+            for uid, _, data in rows:
+                groups.setdefault((number, uid), []).extend(decode_block(data))
+            return insert_blocks(conn, groups, table=tmp)
+
+        def _swap(conn):
+            conn.execute(f"DROP TABLE IF EXISTS {target}")
+            conn.execute(f"ALTER TABLE {tmp} RENAME TO {target}")
+            conn.execute(f"DROP TABLE {source}")
+            _vacuum_freelist(conn)
+
+        await self.storage.transaction(_prepare, label="history compact")
+        last_uid, last_id, blocks = -1, 0, 0
+        while True:
+            rows = await self.storage.read(f"SELECT user_id, id, data FROM {source} WHERE (user_id, id) > (?, ?) "
+                                           f"ORDER BY user_id, id LIMIT ?", (last_uid, last_id, self.chunk))
+            if not rows:
+                break
+            if len(rows) == self.chunk and rows[0][0] != rows[-1][0]:
+                # последнего пользователя пачки — целиком в следующую, чтобы не резать его блоки
+                rows = [r for r in rows if r[0] != rows[-1][0]]
+            last_uid, last_id = rows[-1][0], rows[-1][1]
+            blocks += await self.storage.transaction(lambda conn, rows=rows: _merge(conn, rows),
+                                                     label="history compact")
+        await self.storage.transaction(_swap, label="history compact")
+        self.compacted.append(number)
+        logger.info("History partition %s compacted into %d blocks", number, blocks)
+
+    def _merge_user(self, conn, table, uid, partitions):
+        # только хвост неполных блоков после последнего полного: слитые сообщения идут подряд
+        tail = []
+        for row in reversed(conn.execute(f"SELECT id, count, data FROM {table} WHERE user_id = ? ORDER BY id",
+                                         (uid,)).fetchall()):
+            if row[1] >= BLOCK_MAX_ROWS:
+                break
+            tail.append(row)
+        if len(tail) < self.merge_blocks:
+            return 0
+        tail.reverse()
+        messages = [m for _, _, data in tail for m in decode_block(data)]
+        if self.keep:
+            messages = messages[-self.keep:]
+        chunks = [messages[i:i + BLOCK_MAX_ROWS] for i in range(0, len(messages), BLOCK_MAX_ROWS)]
+        ids = [block_id for block_id, _, _ in tail]
+        conn.executemany(f"DELETE FROM {table} WHERE id = ?", [(block_id,) for block_id in ids])
+        # новые блоки берут последние id хвоста: все блоки новее остаются после них
+        conn.executemany(f"INSERT INTO {table} (id, user_id, count, data) VALUES (?, ?, ?, ?)",
+                         [(block_id, uid, len(chunk), encode_block(chunk))
+                          for block_id, chunk in zip(ids[-len(chunks):], chunks)])
+        if self.keep:
+            trim_user(conn, uid, self.keep, partitions)
+        return len(tail) - len(chunks)
+
+    async def merge(self, number):
+        """Открытая секция: хвосты из merge_blocks и больше мелких блоков -> блоки до BLOCK_MAX_ROWS."""
+        if not self.merge_blocks:
+            return 0
+        table = partition_table(number)
+        uids = [uid for (uid,) in await self.storage.read(
+            f"SELECT user_id FROM {table} WHERE count < ? GROUP BY user_id HAVING COUNT(*) >= ?",
+            (BLOCK_MAX_ROWS, self.merge_blocks))]
+        removed = 0
+
+        def _tx(conn, part):
+            partitions = _partitions(conn.execute(PARTITIONS_SQL).fetchall())
+            return sum(self._merge_user(conn, table, uid, partitions) for uid in part)
+
+        for start in range(0, len(uids), self.merge_users):
+            part = uids[start:start + self.merge_users]
+            removed += await self.storage.transaction(lambda conn, part=part: _tx(conn, part),
+                                                      label="history merge")
+        if removed:
+            await self.storage.transaction(_vacuum_freelist, label="history merge")
+            self.merged += removed
+            logger.info("History partition %s: %d small blocks merged away", number, removed)
+        return removed
+
+    # ---------------------------
+    # Архив
+    # ---------------------------
+    async def _export(self, number, table):
+        """Секция -> <archive_dir>/history_p<n>.jsonl.gz, по строке на сообщение. Путь к файлу."""
+        loop = asyncio.get_running_loop()
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"{partition_table(number)}.jsonl.gz")
+        fh = await loop.run_in_executor(None, gzip.open, path + ".part", "wt", 6, "utf-8")
+        try:
+            last = 0
+            while True:
+                rows = await self.storage.read(f"SELECT id, user_id, data FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                                               (last, self.chunk))
+                if not rows:
+                    break
+                await loop.run_in_executor(None, _write_rows, fh, rows)
+                last = rows[-1][0]
+        finally:
+            await loop.run_in_executor(None, fh.close)
+        os.replace(path + ".part", path)
+        return path
+
+    async def archive(self, number, table):
+        path = await self._export(number, table) if self.archive_dir else None
+
+        def _tx(conn):
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+            # страницы удалённой таблицы — обратно файловой системе, а не во freelist
+            _vacuum_freelist(conn)
+
+        await self.storage.transaction(_tx, label="history archive")
+        self.archived.append(number)
+        logger.info("History partition %s archived to %s", number, path or "(dropped)")
+
+    async def run_once(self, now=None):
+        for number, table in await self.expired(now):
+            await self.archive(number, table)
+        sealed = await self.sealed(now)
+        for number in sealed:
+            await self.compact(number)
+        for number, table in await list_partitions(self.storage):
+            if table == partition_table(number) and number not in sealed:
+                await self.merge(number)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("History maintenance failed")
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+def _write_rows(fh, rows):
+    for _, uid, data in rows:
+        for direction, content, created_at in decode_block(data):
+            fh.write(json.dumps({"user_id": uid, "direction": direction, "content": content,
+                                 "created_at": created_at}, ensure_ascii=False) + "\n")
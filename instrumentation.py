@@ -0,0 +1,77 @@
+# coding: utf-8
+"""
+Замеры задержек: хендлеры, запросы к SQLite (ожидание потока отдельно от выполнения)
+и вызовы Bot API. Всё пишется в гистограммы реестра метрик; операции дольше порога
+логируются вместе с хендлером и пользователем, в контексте которых они выполнялись.
+"""
+
+import time
+import logging
+import contextvars
+
+from aiogram import Bot
+
+logger = logging.getLogger(__name__)
+
+current_handler = contextvars.ContextVar('current_handler', default='-')
+current_user = contextvars.ContextVar('current_user', default=None)
+
+
+class Instrumentation:
+    def __init__(self, registry, slow_threshold=0.5):
+        self.slow_threshold = slow_threshold
+        self.handlers = registry.histogram("handler_seconds", "Handler latency", label='handler')
+        self.db_wait = registry.histogram("db_wait_seconds", "Time a DB statement waited for its thread", label='kind')
+        self.db_exec = registry.histogram("db_exec_seconds", "DB statement execution time", label='kind')
+        self.api = registry.histogram("api_seconds", "Bot API call latency", label='method')
+
+    def _slow(self, what, seconds, detail):
+        logger.warning("Slow %s: %.0f ms [handler=%s user=%s] %s", what, seconds * 1000,
+                       current_handler.get(), current_user.get(), detail,
+                       extra={'latency_ms': round(seconds * 1000, 1)})
+
+    def observe_handler(self, name, seconds):
+        self.handlers.observe(seconds, name)
+        if seconds >= self.slow_threshold:
+            self._slow("handler", seconds, name)
+
+    def observe_db(self, kind, sql, wait, execution):
+        """Подходит как Storage.observer."""
+        self.db_wait.observe(wait, kind)
+        self.db_exec.observe(execution, kind)
+        if wait + execution >= self.slow_threshold:
+            self._slow(f"db {kind} (wait {wait * 1000:.0f} ms, exec {execution * 1000:.0f} ms)",
+                       wait + execution, " ".join(str(sql).split()))
+
+    def observe_api(self, method, seconds):
+        self.api.observe(seconds, method)
+        if seconds >= self.slow_threshold:
+            self._slow("api", seconds, method)
+
+    def report(self, top=10):
+        """Текст для админа: сводка по хендлерам, БД и Bot API."""
+        lines = []
+        for title, hist in (("Хендлеры", self.handlers), ("БД: ожидание потока", self.db_wait),
+                            ("БД: выполнение", self.db_exec), ("Bot API", self.api)):
+            rows = sorted(hist.summary().items(), key=lambda kv: kv[1][0] * kv[1][1], reverse=True)[:top]
+            if not rows:
+                continue
+            lines.append(f"<b>{title}</b>")
+            for name, (count, mean, p50, p95, mx) in rows:
+                lines.append(f"{name}: n={count} avg={mean * 1000:.1f} p50≤{p50 * 1000:.0f} "
+                             f"p95≤{p95 * 1000:.0f} max={mx * 1000:.0f} мс")
+        return "\n".join(lines) or "Нет данных."
+
+
+class InstrumentedBot(Bot):
+    """Bot, замеряющий каждый вызов Bot API."""
+
+    instrumentation = None
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        finally:
+            if self.instrumentation:
+                self.instrumentation.observe_api(method, time.perf_counter() - started)
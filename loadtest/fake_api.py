@@ -0,0 +1,165 @@
+# coding: utf-8
+"""
+Локальная заглушка Telegram Bot API на aiohttp.
+Понимает getUpdates (long polling из внутренней очереди), getMe, set/deleteWebhook
+и все send*/copy/forward/answerCallbackQuery/edit* — они просто записываются.
+Задержка ответа и доля ответов 429 настраиваются.
+
+Можно запустить отдельно и направить на неё бота через BOT_API_SERVER:
+
+    python -m loadtest.fake_api --port 8081 --latency 0.05 --flood 0.01
+"""
+
+import time
+import json
+import random
+import asyncio
+import logging
+import argparse
+from collections import Counter
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, jitter=0.0, flood_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls = Counter()       # method -> сколько раз вызвали
+        self.floods = 0
+        self.listeners = []          # fn(method, params) — вызывается на каждый исходящий вызов бота
+        self._rnd = random.Random(seed)
+        self._updates = []
+        self._update_id = 0
+        self._message_id = 0
+        self._new_updates = asyncio.Event()
+        self._runner = None
+
+    # ---------------------------
+    # Апдейты для бота
+    # ---------------------------
+    def push_update(self, payload: dict):
+        """payload — {'message': {...}} или {'callback_query': {...}}; update_id проставится сам."""
+        self._update_id += 1
+        self._updates.append(dict(payload, update_id=self._update_id))
+        self._new_updates.set()
+        return self._update_id
+
+    def pending_updates(self):
+        return len(self._updates)
+
+    # ---------------------------
+    # HTTP
+    # ---------------------------
+    async def start(self, host='127.0.0.1', port=8081):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _params(self, request):
+        if request.content_type == 'application/json':
+            return await request.json()
+        data = await request.post()
+        params = {}
+        for key, value in data.items():
+            if hasattr(value, 'file'):
+                params[key] = '<file>'
+                continue
+            try:
+                params[key] = json.loads(value)
+            except (TypeError, ValueError):
+                params[key] = value
+        return params
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        if method == 'getUpdates':
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        self.calls[method] += 1
+        delay = self.latency + (self._rnd.random() * self.jitter if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.flood_rate and method.startswith(('send', 'copy', 'forward')) and self._rnd.random() < self.flood_rate:
+            self.floods += 1
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": f"Too Many Requests: retry after {self.retry_after}",
+                                      "parameters": {"retry_after": self.retry_after}}, status=429)
+        for listener in self.listeners:
+            listener(method, params)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        return self._updates[:limit]
+
+    def _message(self, chat_id, **fields):
+        self._message_id += 1
+        msg = {"message_id": self._message_id, "date": int(time.time()), "from": BOT_USER,
+               "chat": {"id": int(chat_id), "type": "private"}}
+        msg.update(fields)
+        return msg
+
+    def _result(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('setWebhook', 'deleteWebhook', 'answerCallbackQuery', 'close', 'logOut'):
+            return True
+        if method == 'getWebhookInfo':
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        chat_id = params.get('chat_id', 0)
+        if method == 'sendMediaGroup':
+            media = params.get('media') or []
+            return [self._message(chat_id) for _ in media]
+        if method == 'copyMessage':
+            self._message_id += 1
+            return {"message_id": self._message_id}
+        if method == 'sendMessage' or method.startswith('edit'):
+            return self._message(chat_id, text=str(params.get('text', '')))
+        return self._message(chat_id)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0.0)
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--flood", type=float, default=0.0, help="доля send-вызовов, получающих 429")
+    args = ap.parse_args()
+
+    async def serve():
+        api = FakeBotAPI(latency=args.latency, jitter=args.jitter, flood_rate=args.flood)
+        url = await api.start(args.host, args.port)
+        print(f"Fake Bot API on {url}")
+        while True:
+            await asyncio.sleep(3600)
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# coding: utf-8
+"""
+Нагрузочный прогон бота без сети: поднимает FakeBotAPI, запускает bot.py в этом же
+процессе (polling к заглушке, отдельная временная БД) и гоняет тысячи симулированных
+пользователей: /start, выбор пола, пара, переписка, «следующий», жалобы.
+
+    python -m loadtest.run --users 2000 --duration 60
+
+В конце печатает пары/сек, перцентили задержки пересылки, запросов к БД на сообщение
+и прирост памяти процесса.
+"""
+
+import os
+import re
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+
+from loadtest.fake_api import FakeBotAPI
+
+FAKE_TOKEN = "123456789:AAHfakeTokenForLoadTestingOnly000000"
+ADMIN_ID = 1
+SEXES = ['Мужчина', 'Женщина', 'Любой']
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class SimUser:
+    def __init__(self, uid):
+        self.uid = uid
+        self.matched = asyncio.Event()
+        self.sent = 0
+
+
+class LoadTest:
+    def __init__(self, api: FakeBotAPI, args):
+        self.api = api
+        self.args = args
+        self.users = {}
+        self.matches = 0
+        self.latencies = []
+        self.updates = 0
+        self._msg_id = 0
+        api.listeners.append(self._on_call)
+
+    # ---------------------------
+    # Что бот отправил
+    # ---------------------------
+    def _on_call(self, method, params):
+        if method != 'sendMessage':
+            return
+        user = self.users.get(int(params.get('chat_id', 0)))
+        text = str(params.get('text', ''))
+        if user is None:
+            return
+        if text.startswith('✅ Собеседник найден'):
+            self.matches += 1
+            user.matched.set()
+        elif text.startswith('❌ Диалог окончен'):
+            user.matched.clear()
+        elif text.startswith('lt '):
+            self.latencies.append(time.perf_counter() - float(text.split()[3]))
+
+    # ---------------------------
+    # Что «пишут» пользователи
+    # ---------------------------
+    def _actor(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+
+    def _message(self, uid, text):
+        self._msg_id += 1
+        return {"message_id": self._msg_id, "date": int(time.time()), "from": self._actor(uid),
+                "chat": {"id": uid, "type": "private", "first_name": f"u{uid}"}, "text": text}
+
+    def send_text(self, uid, text):
+        self.updates += 1
+        self.api.push_update({"message": self._message(uid, text)})
+
+    def press(self, uid, data):
+        self.updates += 1
+        self.api.push_update({"callback_query": {
+            "id": str(self.updates), "from": self._actor(uid), "chat_instance": str(uid), "data": data,
+            "message": self._message(uid, "menu")}})
+
+    async def run_user(self, user: SimUser, deadline):
+        a = self.args
+        rnd = random.Random(user.uid)
+        await asyncio.sleep(rnd.random() * a.ramp)
+        self.send_text(user.uid, "/start")
+        await asyncio.sleep(a.think)
+        self.send_text(user.uid, "Поиск собеседника🔎")
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(a.think)
+            self.press(user.uid, "choise_sex_" + rnd.choice(SEXES))
+            try:
+                await asyncio.wait_for(user.matched.wait(), a.match_timeout)
+            except asyncio.TimeoutError:
+                continue
+            for seq in range(a.msgs):
+                if not user.matched.is_set() or time.perf_counter() >= deadline:
+                    break
+                self.send_text(user.uid, f"lt {user.uid} {seq} {time.perf_counter()}")
+                user.sent += 1
+                await asyncio.sleep(a.msg_interval)
+            if user.matched.is_set() and rnd.random() < a.complain_rate:
+                self.press(user.uid, "complain_partner")
+            if user.matched.is_set():
+                self.press(user.uid, "next_partner")
+                user.matched.clear()
+
+    async def run(self):
+        a = self.args
+        base = 10 ** 6
+        self.users = {base + i: SimUser(base + i) for i in range(a.users)}
+        deadline = time.perf_counter() + a.duration
+        await asyncio.gather(*(self.run_user(u, deadline) for u in self.users.values()))
+
+
+def db_statements(botmod):
+    return sum(botmod.instrumentation.db_exec.value.values())
+
+
+async def main_async(args):
+    api = FakeBotAPI(latency=args.latency, jitter=args.jitter, flood_rate=args.flood, seed=args.seed)
+    url = await api.start('127.0.0.1', args.port)
+    tmp = tempfile.mkdtemp(prefix="bot-loadtest-")
+    os.environ.update(TOKEN=FAKE_TOKEN, ADMIN_ID=str(ADMIN_ID), BOT_API_SERVER=url,
+                      BOT_DB_PATH=os.path.join(tmp, "bot_data.db"), BOT_LOG=os.path.join(tmp, "bot.log"))
+    rss_before = rss_mb()
+    import bot as botmod  # импорт после окружения: bot.py читает конфиг при импорте
+
+    await botmod.on_startup(botmod.dp)
+    polling = asyncio.ensure_future(botmod.dp.start_polling(timeout=1, relax=0))
+    test = LoadTest(api, args)
+    db_before = db_statements(botmod)
+    started = time.perf_counter()
+    await test.run()
+    # даём боту дообработать хвост
+    drain_deadline = time.perf_counter() + 10
+    while api.pending_updates() and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(1)
+    elapsed = time.perf_counter() - started
+    db_total = db_statements(botmod) - db_before
+    rss_after = rss_mb()
+
+    botmod.dp.stop_polling()
+    await botmod.dp.wait_closed()
+    polling.cancel()
+    await botmod.on_shutdown(botmod.dp)
+    session = await botmod.bot.get_session()
+    await session.close()
+    await api.stop()
+
+    forwarded = len(test.latencies)
+    print(f"users:              {args.users} over {elapsed:.1f}s (db in {tmp})")
+    print(f"updates sent:       {test.updates} ({test.updates / elapsed:.0f}/s)")
+    print(f"matches:            {test.matches // 2} ({test.matches / 2 / elapsed:.1f}/s)")
+    print(f"forwarded messages: {forwarded}")
+    print(f"forward latency:    p50 {percentile(test.latencies, .5) * 1000:.0f} ms, "
+          f"p95 {percentile(test.latencies, .95) * 1000:.0f} ms, "
+          f"p99 {percentile(test.latencies, .99) * 1000:.0f} ms, max {max(test.latencies or [0]) * 1000:.0f} ms")
+    print(f"db statements:      {db_total} total, {db_total / max(test.updates, 1):.2f}/update, "
+          f"{db_total / max(forwarded, 1):.2f}/forwarded message")
+    print(f"memory (RSS):       {rss_before:.0f} MB -> {rss_after:.0f} MB (+{rss_after - rss_before:.0f} MB)")
+    print(f"bot api calls:      {dict(api.calls.most_common())}, 429 injected: {api.floods}")
+    print(re.sub(r"</?b>", "", botmod.instrumentation.report()))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--duration", type=float, default=60, help="секунд симуляции")
+    ap.add_argument("--ramp", type=float, default=10, help="за сколько секунд подключаются все пользователи")
+    ap.add_argument("--think", type=float, default=0.5, help="пауза между действиями пользователя")
+    ap.add_argument("--msgs", type=int, default=5, help="сообщений в одном диалоге")
+    ap.add_argument("--msg-interval", type=float, default=3.5)
+    ap.add_argument("--match-timeout", type=float, default=15)
+    ap.add_argument("--complain-rate", type=float, default=0.05)
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка ответа заглушки API, с")
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--flood", type=float, default=0.0, help="доля send-вызовов с ответом 429")
+    ap.add_argument("--port", type=int, default=18081)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
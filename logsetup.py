@@ -0,0 +1,159 @@
+# coding: utf-8
+"""
+Логирование без записи на диск из event loop.
+Хендлеры логгеров только кладут запись в ограниченную очередь (QueueHandler); в файл
+пишет фоновый поток QueueListener. Очередь переполнена — запись отбрасывается и
+считается, а не блокирует хендлер. Формат — JSON-строки с user_id, handler и latency_ms
+(берутся из контекста instrumentation и extra), ротация по размеру или по времени,
+выборка по уровням (например, INFO=0.1 — пишется примерно каждая десятая INFO-запись).
+"""
+
+import os
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+import traceback
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+from instrumentation import current_handler, current_user
+
+_listener = None
+
+
+def parse_sampling(spec:str):
+    """'DEBUG=0.01,INFO=0.5' -> {10: 0.01, 20: 0.5}; не указанные уровни пишутся все."""
+    rates = {}
+    for part in (spec or "").split(","):
+        if "=" not in part:
+            continue
+        name, rate = part.split("=", 1)
+        level = logging.getLevelName(name.strip().upper())
+        if isinstance(level, int):
+            rates[level] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out = 0
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        if rate is None or rate >= 1.0 or random.random() < rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler, который не ждёт: при полной очереди запись отбрасывается."""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # в потоке вызывающего: контекст (пользователь/хендлер) и готовый текст трейсбека,
+        # сам трейсбек и аргументы дальше не передаём
+        record = copy.copy(record)
+        record.user_id = getattr(record, 'user_id', None) or current_user.get()
+        record.handler = getattr(record, 'handler', None) or current_handler.get()
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ('user_id', 'handler', 'latency_ms')
+
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value not in (None, '-'):
+                data[field] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [user=%(user_id)s handler=%(handler)s] %(message)s")
+
+
+def _file_handler(path, rotate, max_bytes, backups, when):
+    if rotate == 'time':
+        return TimedRotatingFileHandler(path, when=when, backupCount=backups, encoding='utf-8', delay=True)
+    return RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8', delay=True)
+
+
+def settings_from_env(environ=os.environ):
+    """
+    Настройки setup_logging из окружения — общие для bot.py и cluster.py:
+    LOG_LEVEL, LOG_FORMAT (json | text), LOG_ROTATE (size | time), LOG_MAX_BYTES, LOG_BACKUPS,
+    LOG_ROTATE_WHEN (для time), LOG_SAMPLE (доля записей по уровням, напр. DEBUG=0.01,INFO=0.2),
+    LOG_QUEUE_SIZE (при переполнении записи отбрасываются).
+    """
+    return {
+        "level": environ.get("LOG_LEVEL", "INFO").upper(),
+        "fmt": environ.get("LOG_FORMAT", "json"),
+        "rotate": environ.get("LOG_ROTATE", "size"),
+        "max_bytes": int(environ.get("LOG_MAX_BYTES", 50 * 1024 * 1024)),
+        "backups": int(environ.get("LOG_BACKUPS", 5)),
+        "when": environ.get("LOG_ROTATE_WHEN", "midnight"),
+        "sampling": environ.get("LOG_SAMPLE", ""),
+        "queue_size": int(environ.get("LOG_QUEUE_SIZE", 10000)),
+    }
+
+
+def setup_logging(path:str, level=logging.INFO, fmt='json', rotate='size', max_bytes=10 * 1024 * 1024,
+                  backups=5, when='midnight', sampling=None, queue_size=10000):
+    """Настраивает корневой логгер. Возвращает DroppingQueueHandler (счётчики dropped и фильтр выборки)."""
+    global _listener
+    stop_logging()
+    target = _file_handler(path, rotate, max_bytes, backups, when)
+    target.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    handler.sampling = SamplingFilter(parse_sampling(sampling) if isinstance(sampling, str) else (sampling or {}))
+    handler.addFilter(handler.sampling)
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    _listener = QueueListener(handler.queue, target, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return handler
+
+
+def stop_logging():
+    """Дописывает очередь и останавливает поток записи (повторный вызов ничего не делает)."""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
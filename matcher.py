@@ -0,0 +1,291 @@
+# coding: utf-8
+"""
+In-memory очередь поиска собеседника.
+Корзина на каждый sex_filter — куча (VIP первыми, дальше FIFO), удаление ленивое.
+Факты о пригодности (бан, занят диалогом, VIP) держим в памяти.
+Все операции синхронные, поэтому в event loop пара выбирается атомарно.
+
+Подбор по профилю (by_profile=True): для стоящих в очереди держим обратный индекс
+интерес -> пользователи и корзины по возрасту, кандидат ищется пересечением этих
+множеств (просматривается не больше scan_limit самых старых записей на интерес).
+Пользователь с интересами/возрастом первые wait секунд ждёт только пару по профилю
+и в FIFO-кучи не попадает; после этого он становится обычным участником FIFO,
+а rematch() пробует подобрать ему пару сразу.
+"""
+
+import time
+import heapq
+import itertools
+from collections import deque
+
+ANY_FILTER = 'Любой'
+
+
+def sex_filters(sex_filter):
+    return [sex_filter] if sex_filter == ANY_FILTER else [sex_filter, ANY_FILTER]
+
+
+class Matcher:
+    def __init__(self, by_profile=False, wait=15.0, scan_limit=64, age_step=5):
+        self.by_profile = by_profile
+        self.wait = wait
+        self.scan_limit = scan_limit
+        self.age_step = age_step
+        self._buckets = {}   # sex_filter -> [(rank, seq, uid)]
+        self._entries = {}   # uid -> (sex_filter, seq) — актуальная запись в очереди
+        self._vip = set()
+        self._banned = set()
+        self._busy = set()   # у пользователя есть собеседник
+        self._dropped = []   # выброшены из очереди при pop, ещё не удалены из БД
+        self._seq = itertools.count()
+        # подбор по профилю
+        self._profiles = {}  # uid -> (interests, age) — только для стоящих в очереди
+        self._by_tag = {}    # интерес -> {uid: None} (dict — порядок постановки)
+        self._by_age = {}    # корзина возраста -> {uid: None}
+        self._reserved = set()   # ждут пару по профилю, в кучах их нет
+        self._waiting = deque()  # (открывается в, uid, seq) — в порядке постановки
+        self._opened = []        # уже попали в FIFO, rematch для них ещё не пробовали
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, uid):
+        return uid in self._entries
+
+    # ---------------------------
+    # Факты о пользователях
+    # ---------------------------
+    def set_vip(self, uid:int, vip:bool):
+        if vip == (uid in self._vip):
+            return
+        (self._vip.add if vip else self._vip.discard)(uid)
+        entry = self._entries.get(uid)
+        if entry and uid not in self._reserved:
+            # переставляем с новым приоритетом, сохраняя место в FIFO
+            self._push(uid, entry[0], entry[1])
+
+    def set_banned(self, uid:int, banned:bool):
+        (self._banned.add if banned else self._banned.discard)(uid)
+        if banned:
+            self.remove(uid)
+
+    def set_busy(self, uid:int, busy:bool):
+        (self._busy.add if busy else self._busy.discard)(uid)
+
+    def eligible(self, uid:int):
+        return uid not in self._banned and uid not in self._busy
+
+    def set_profile(self, uid:int, interests=None, age=None):
+        """Обновляет профиль стоящего в очереди (None — поле не меняется)."""
+        if uid not in self._profiles:
+            return
+        old_interests, old_age = self._profiles[uid]
+        self._unindex(uid)
+        self._index(uid, (old_interests if interests is None else interests, old_age if age is None else age))
+
+    # ---------------------------
+    # Индексы профиля
+    # ---------------------------
+    def _age_bucket(self, age):
+        return age // self.age_step if age else None
+
+    def _index(self, uid, profile):
+        interests, age = profile
+        interests = frozenset(t.strip().lower() for t in interests or () if t and t.strip())
+        self._profiles[uid] = (interests, age or 0)
+        for tag in interests:
+            self._by_tag.setdefault(tag, {})[uid] = None
+        bucket = self._age_bucket(age)
+        if bucket is not None:
+            self._by_age.setdefault(bucket, {})[uid] = None
+
+    def _unindex(self, uid):
+        profile = self._profiles.pop(uid, None)
+        if profile is None:
+            return
+        interests, age = profile
+        for tag in interests:
+            users = self._by_tag.get(tag)
+            if users is not None:
+                users.pop(uid, None)
+                if not users:
+                    del self._by_tag[tag]
+        bucket = self._age_bucket(age)
+        users = self._by_age.get(bucket)
+        if users is not None:
+            users.pop(uid, None)
+            if not users:
+                del self._by_age[bucket]
+
+    def _best_by_profile(self, uid, filters):
+        """Кандидат с наибольшим числом общих интересов (+1 за ту же корзину возраста)."""
+        interests, age = self._profiles.get(uid, ((), 0))
+        scores = {}
+        for tag in interests:
+            for cid in itertools.islice(self._by_tag.get(tag, ()), self.scan_limit):
+                scores[cid] = scores.get(cid, 0) + 2
+        bucket = self._age_bucket(age)
+        if bucket is not None:
+            for cid in itertools.islice(self._by_age.get(bucket, ()), self.scan_limit):
+                scores[cid] = scores.get(cid, 0) + 1
+        best, best_key = None, None
+        for cid, score in scores.items():
+            entry = self._entries.get(cid)
+            if cid == uid or entry is None or entry[0] not in filters:
+                continue
+            if not self.eligible(cid):
+                self._drop(cid)
+                self._dropped.append(cid)
+                continue
+            key = (score, cid in self._vip, -entry[1])
+            if best_key is None or key > best_key:
+                best, best_key = cid, key
+        return best
+
+    # ---------------------------
+    # Очередь
+    # ---------------------------
+    def _push(self, uid, sex_filter, seq):
+        rank = 0 if uid in self._vip else 1
+        self._entries[uid] = (sex_filter, seq)
+        heap = self._buckets.setdefault(sex_filter, [])
+        heapq.heappush(heap, (rank, seq, uid))
+        if len(heap) > 2 * len(self._entries) + 64:
+            self._compact(sex_filter)
+
+    def _compact(self, sex_filter):
+        heap = [(0 if uid in self._vip else 1, seq, uid)
+                for uid, (f, seq) in self._entries.items() if f == sex_filter and uid not in self._reserved]
+        heapq.heapify(heap)
+        self._buckets[sex_filter] = heap
+
+    def _drop(self, uid):
+        self._unindex(uid)
+        self._reserved.discard(uid)
+        return self._entries.pop(uid, None) is not None
+
+    def _open_expired(self, now):
+        """Переводит в FIFO тех, чьё ожидание пары по профилю истекло."""
+        while self._waiting and self._waiting[0][0] <= now:
+            _, uid, seq = self._waiting.popleft()
+            entry = self._entries.get(uid)
+            if entry is None or entry[1] != seq or uid not in self._reserved:
+                continue
+            self._reserved.discard(uid)
+            self._push(uid, entry[0], seq)
+            self._opened.append(uid)
+
+    def add(self, uid:int, sex_filter:str, profile=None, now=None):
+        """profile — (interests, age); учитывается только при by_profile."""
+        self._drop(uid)
+        seq = next(self._seq)
+        if self.by_profile and profile and (profile[0] or profile[1]):
+            self._index(uid, profile)
+            self._entries[uid] = (sex_filter, seq)
+            self._reserved.add(uid)
+            self._waiting.append(((time.monotonic() if now is None else now) + self.wait, uid, seq))
+            return
+        if self.by_profile:
+            self._index(uid, ((), 0))
+        self._push(uid, sex_filter, seq)
+
+    def remove(self, uid:int):
+        return self._drop(uid)
+
+    def pop(self, sex_filter:str, exclude=None):
+        """Лучший пригодный кандидат из FIFO-корзины или None. Непригодные выбрасываются из очереди."""
+        heap = self._buckets.get(sex_filter)
+        skipped = None
+        found = None
+        while heap:
+            rank, seq, uid = heap[0]
+            entry = self._entries.get(uid)
+            current_rank = 0 if uid in self._vip else 1
+            if entry != (sex_filter, seq) or rank != current_rank or uid in self._reserved:
+                heapq.heappop(heap)  # устаревшая запись
+                continue
+            if uid == exclude:
+                # сам себе не пара: откладываем и возвращаем после поиска
+                skipped = heapq.heappop(heap)
+                continue
+            heapq.heappop(heap)
+            self._drop(uid)
+            if not self.eligible(uid):
+                self._dropped.append(uid)
+                continue
+            found = uid
+            break
+        if skipped is not None:
+            heapq.heappush(heap, skipped)
+        return found
+
+    def _find(self, uid, sex_filter, use_profile, fifo):
+        filters = sex_filters(sex_filter)
+        if use_profile:
+            candidate = self._best_by_profile(uid, filters)
+            if candidate is not None:
+                self._drop(candidate)
+                return candidate
+        if fifo:
+            for f in filters:
+                candidate = self.pop(f, exclude=uid)
+                if candidate is not None:
+                    return candidate
+        return None
+
+    def match(self, uid:int, sex_filter:str, profile=None, now=None):
+        """
+        Ищет пару для uid (сначала своя корзина, потом 'Любой').
+        Нашли — оба помечаются занятыми и uid в очередь не ставится.
+        Не нашли — uid встаёт в очередь. Возвращает кандидата или None.
+        С by_profile и непустым профилем uid берёт только пару по профилю, а в FIFO
+        попадает через wait секунд.
+        """
+        self.remove(uid)
+        now = time.monotonic() if now is None else now
+        with_profile = bool(self.by_profile and profile and (profile[0] or profile[1]))
+        if self.by_profile:
+            self._open_expired(now)
+            self._index(uid, profile or ((), 0))
+        candidate = self._find(uid, sex_filter, use_profile=with_profile, fifo=not with_profile)
+        self._unindex(uid)
+        if candidate is not None:
+            self._busy.add(uid)
+            self._busy.add(candidate)
+            return candidate
+        self.add(uid, sex_filter, profile, now=now)
+        return None
+
+    def rematch(self, now=None):
+        """
+        Для тех, у кого истекло ожидание по профилю: пара по профилю, иначе первый из FIFO.
+        Возвращает [(uid, кандидат)]; оба уже вынуты из очереди и помечены занятыми.
+        """
+        self._open_expired(time.monotonic() if now is None else now)
+        opened, self._opened = self._opened, []
+        pairs = []
+        for uid in opened:
+            entry = self._entries.get(uid)
+            if entry is None:
+                continue
+            if not self.eligible(uid):
+                self._drop(uid)
+                self._dropped.append(uid)
+                continue
+            candidate = self._find(uid, entry[0], use_profile=True, fifo=True)
+            if candidate is None:
+                continue
+            self._drop(uid)
+            self._busy.add(uid)
+            self._busy.add(candidate)
+            pairs.append((uid, candidate))
+        return pairs
+
+    def take_dropped(self):
+        dropped, self._dropped = self._dropped, []
+        return dropped
+
+    def queued(self):
+        """Снимок очереди: [(uid, sex_filter)] в порядке постановки."""
+        items = sorted(self._entries.items(), key=lambda kv: kv[1][1])
+        return [(uid, entry[0]) for uid, entry in items]
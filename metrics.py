@@ -0,0 +1,168 @@
+# coding: utf-8
+"""
+Метрики процесса: счётчики и gauge в памяти + HTTP-эндпоинт в формате Prometheus.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._value = 0
+
+    def inc(self, n=1):
+        self._value += n
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, fn=None):
+        """fn — если задан, значение считается при чтении (должно быть O(1))."""
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, n=1):
+        self._value += n
+
+    def dec(self, n=1):
+        self._value -= n
+
+    @property
+    def value(self):
+        return self.fn() if self.fn else self._value
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Гистограмма с одним лейблом (например, handler): корзины как в Prometheus + sum/count/max."""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label='name', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}  # значение лейбла -> [counts по корзинам (+Inf последней), sum, count, max]
+
+    def observe(self, value, label_value=''):
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0, 0.0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        series[1] += value
+        series[2] += 1
+        if value > series[3]:
+            series[3] = value
+
+    def quantile(self, label_value, q):
+        """Оценка квантиля по корзинам (верхняя граница корзины, в которую он попал)."""
+        series = self._series.get(label_value)
+        if not series or not series[2]:
+            return 0.0
+        rank = q * series[2]
+        seen = 0
+        for i, n in enumerate(series[0]):
+            seen += n
+            if seen >= rank:
+                return min(self.buckets[i], series[3]) if i < len(self.buckets) else series[3]
+        return series[3]
+
+    def summary(self):
+        """{значение лейбла: (count, mean, p50, p95, max)}"""
+        return {lv: (c, total / c if c else 0.0, self.quantile(lv, 0.5), self.quantile(lv, 0.95), mx)
+                for lv, (_, total, c, mx) in self._series.items()}
+
+    @property
+    def value(self):
+        return {lv: series[2] for lv, series in self._series.items()}
+
+    def render(self, full):
+        lines = []
+        for lv, (counts, total, count, _) in self._series.items():
+            label = f'{self.label}="{lv}"'
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append(f'{full}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{full}_sum{{{label}}} {total}")
+            lines.append(f"{full}_count{{{label}}} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self, prefix='bot_'):
+        self.prefix = prefix
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name, help_text, fn=None):
+        return self._register(Gauge(name, help_text, fn))
+
+    def histogram(self, name, help_text, label='name', buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, label, buckets))
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def snapshot(self):
+        return {name: m.value for name, m in self._metrics.items() if m.kind != 'histogram'}
+
+    def render(self):
+        lines = []
+        for name, m in self._metrics.items():
+            full = self.prefix + name
+            lines.append(f"# HELP {full} {m.help}")
+            lines.append(f"# TYPE {full} {m.kind}")
+            if m.kind == 'histogram':
+                lines.extend(m.render(full))
+            else:
+                lines.append(f"{full} {m.value}")
+        return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(registry: Registry, host: str, port: int, path='/metrics'):
+    """Поднимает aiohttp-сервер с эндпоинтом метрик. Возвращает AppRunner (для cleanup())."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get(path, handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics endpoint on http://%s:%s%s", host, port, path)
+    return runner
@@ -0,0 +1,99 @@
+# coding: utf-8
+"""
+Middleware диспетчера.
+"""
+
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from cache import LRUCache
+from instrumentation import current_handler as handler_name, current_user
+
+THROTTLE_NOTICE_INTERVAL = 10  # не чаще раза в 10 секунд напоминаем про лимит
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """
+    Срабатывает до фильтров хендлеров: превысивший лимит апдейт дальше не идёт.
+    Области: 'messages' — любые сообщения, 'queue' — выбор пола (вход в очередь),
+    'callbacks' — остальные inline-кнопки. Альбом считается одним сообщением:
+    решение по первому элементу применяется ко всем остальным.
+    """
+
+    def __init__(self, limiter, exempt=(), reply=None):
+        """reply(message, text) — чем отвечать пользователю; по умолчанию message.answer."""
+        super().__init__()
+        self.limiter = limiter
+        self.exempt = set(exempt)
+        self.reply = reply or (lambda message, text: message.answer(text))
+        self._albums = LRUCache(maxsize=10000, ttl=60)  # media_group_id -> отклонён ли альбом
+
+    def _limited(self, scope, uid):
+        if uid in self.exempt:
+            return False, False
+        noticed = self.limiter.recently_throttled(uid, THROTTLE_NOTICE_INTERVAL)
+        return self.limiter.hit(scope, uid), not noticed
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        album = message.media_group_id
+        limited = self._albums.get(album) if album else None
+        if limited is not None:
+            notify = False
+        else:
+            limited, notify = self._limited('messages', message.from_user.id)
+            if album:
+                self._albums.set(album, limited)
+        if limited:
+            if notify:
+                await self.reply(message, "⛔ Вы отправляете сообщения слишком быстро. Подождите немного.")
+            raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        scope = 'queue' if (callback.data or '').startswith('choise_sex_') else 'callbacks'
+        limited, notify = self._limited(scope, callback.from_user.id)
+        if limited:
+            await callback.answer("⛔ Слишком часто. Подождите немного." if notify else None)
+            raise CancelHandler()
+
+
+class LatencyMiddleware(BaseMiddleware):
+    """
+    Замеряет время хендлеров сообщений и колбэков (после фильтров, до ответа хендлера)
+    и выставляет текущие хендлер/пользователя для логов медленных операций.
+    """
+
+    def __init__(self, instrumentation):
+        super().__init__()
+        self.instrumentation = instrumentation
+
+    def _start(self, user_id, data):
+        name = getattr(current_handler.get(), '__name__', None) or 'unknown'
+        handler_name.set(name)
+        current_user.set(user_id)
+        data['_latency'] = (name, time.perf_counter())
+
+    def _finish(self, data):
+        started = data.pop('_latency', None)
+        if started:
+            self.instrumentation.observe_handler(started[0], time.perf_counter() - started[1])
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        current_user.set(message.from_user.id)
+
+    async def on_pre_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        current_user.set(callback.from_user.id)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._start(message.from_user.id, data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._finish(data)
+
+    async def on_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        self._start(callback.from_user.id, data)
+
+    async def on_post_process_callback_query(self, callback: types.CallbackQuery, results, data: dict):
+        self._finish(data)
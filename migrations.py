@@ -0,0 +1,188 @@
+# coding: utf-8
+"""
+Версионированные миграции схемы.
+Текущая версия хранится в schema_version; каждая миграция применяется в своей
+транзакции вместе с записью о ней, так что прерванный запуск безопасно повторить.
+Шаг миграции — SQL-строка или функция fn(conn).
+"""
+
+import time
+import logging
+
+from storage import connect
+from history import partition_of, partition_ddl, insert_blocks
+
+logger = logging.getLogger(__name__)
+
+
+def _dedupe_search_queue(conn):
+    # до уникального индекса в очереди могли остаться дубли (add_to_queue без удаления) — оставляем последнюю
+    conn.execute("""DELETE FROM search_queue WHERE rowid NOT IN (
+                        SELECT MAX(rowid) FROM search_queue GROUP BY user_id)""")
+
+
+def _partition_history(conn, chunk=5000):
+    # старая история (строка на сообщение) -> секции по времени со сжатыми блоками, см. history.py;
+    # по пользователю за раз (индекс user_id, id), чтобы память не зависела от размера таблицы
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history'").fetchone():
+        return
+    created = set()
+
+    def _write(groups):
+        for number, _ in groups:
+            if number not in created:
+                created.add(number)
+                for sql in partition_ddl(number):
+                    conn.execute(sql)
+        insert_blocks(conn, groups)
+
+    cursor = conn.execute("SELECT user_id, direction, content, created_at FROM history ORDER BY user_id, id")
+    groups, current = {}, None
+    while True:
+        rows = cursor.fetchmany(chunk)
+        if not rows:
+            break
+        for uid, direction, content, ts in rows:
+            if uid != current:
+                _write(groups)
+                groups, current = {}, uid
+            ts = ts or 0.0
+            groups.setdefault((partition_of(ts), uid), []).append((direction, content, ts))
+    _write(groups)
+    conn.execute("DROP TABLE history")
+
+
+def _enable_incremental_vacuum(conn):
+    # auto_vacuum меняется только полным VACUUM, а он не работает внутри транзакции
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        logger.info("auto_vacuum switched to INCREMENTAL")
+
+
+MIGRATIONS = [
+    (1, "base schema", [
+        """CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            name TEXT,
+            sex TEXT DEFAULT 'Не выбран',
+            age INTEGER DEFAULT 0,
+            interests TEXT DEFAULT '',
+            vip INTEGER DEFAULT 0,
+            partner INTEGER DEFAULT NULL,
+            banned INTEGER DEFAULT 0,
+            created_at TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS search_queue (
+            user_id INTEGER,
+            sex_filter TEXT,
+            queued_at REAL
+        )""",
+        """CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            direction TEXT,
+            content TEXT,
+            created_at REAL
+        )""",
+        """CREATE TABLE IF NOT EXISTS complaints (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_user INTEGER,
+            about_user INTEGER,
+            reason TEXT,
+            created_at REAL
+        )""",
+        """CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT,
+            last_uid INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'running',
+            created_at REAL
+        )""",
+    ]),
+    (2, "hot-path indexes", [
+        # pop/восстановление очереди: фильтр + порядок по времени
+        "CREATE INDEX IF NOT EXISTS idx_search_queue_filter_time ON search_queue (sex_filter, queued_at)",
+        # save_history (обрезка) и get_history
+        "CREATE INDEX IF NOT EXISTS idx_history_user_id ON history (user_id, id)",
+        # /stats и загрузка Matcher: частичные индексы маленькие и покрывают COUNT(*)
+        "CREATE INDEX IF NOT EXISTS idx_users_vip ON users (vip) WHERE vip = 1",
+        "CREATE INDEX IF NOT EXISTS idx_users_banned ON users (banned) WHERE banned = 1",
+        "CREATE INDEX IF NOT EXISTS idx_users_partner ON users (partner) WHERE partner IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_complaints_about_user ON complaints (about_user)",
+    ]),
+    (3, "unique search_queue.user_id", [
+        _dedupe_search_queue,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_search_queue_user_id ON search_queue (user_id)",
+    ]),
+    (4, "users.conv_state", [
+        # состояние разговора (см. fsm.py); для уже идущих диалогов и очереди — по текущим данным
+        "ALTER TABLE users ADD COLUMN conv_state TEXT DEFAULT 'idle'",
+        "UPDATE users SET conv_state = 'in_dialog' WHERE partner IS NOT NULL",
+        "UPDATE users SET conv_state = 'searching' WHERE partner IS NULL AND id IN (SELECT user_id FROM search_queue)",
+    ]),
+    (5, "users.last_active", [
+        # активность в диалоге для снятия брошенных диалогов в кластере (см. sweeper.py)
+        "ALTER TABLE users ADD COLUMN last_active REAL",
+    ]),
+    (6, "partitioned compressed history", [
+        _partition_history,
+    ]),
+]
+
+# Шаги, которые нельзя выполнить в транзакции: после миграций, если версия схемы уже >= номера.
+# Должны быть идемпотентными.
+POST_MIGRATION = [
+    (6, _enable_incremental_vacuum),
+]
+
+
+def current_version(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT,
+                        applied_at REAL
+                    )""")
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(path: str, target=None):
+    """Применяет недостающие миграции (до target включительно). Возвращает список применённых версий."""
+    conn = connect(path)
+    applied = []
+    try:
+        version = current_version(conn)
+        for number, name, steps in MIGRATIONS:
+            if number <= version or (target is not None and number > target):
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                             (number, name, time.time()))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                logger.exception("Migration %s (%s) failed", number, name)
+                raise
+            logger.info("Applied migration %s: %s", number, name)
+            applied.append(number)
+        version = current_version(conn)
+        for number, step in POST_MIGRATION:
+            if version >= number:
+                step(conn)
+        # полный ANALYZE — только после изменения схемы; на обычном старте (и в каждом воркере)
+        # хватает PRAGMA optimize: он пересчитывает статистику лишь там, где она устарела
+        conn.execute("ANALYZE" if applied else "PRAGMA optimize")
+    finally:
+        conn.close()
+    return applied
@@ -0,0 +1,202 @@
+# coding: utf-8
+"""
+Единый планировщик исходящих вызовов Bot API.
+Глобальный token bucket + bucket на каждый чат, полосы приоритета
+(диалог > уведомления > рассылки), повтор по RetryAfter, порядок сообщений
+внутри одного чата сохраняется (в каждый чат одновременно летит не больше одного запроса).
+"""
+
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import deque
+
+from aiogram.utils import exceptions
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+DIALOG, NOTIFY, BROADCAST = 0, 1, 2
+LANE_NAMES = {DIALOG: 'dialog', NOTIFY: 'notify', BROADCAST: 'broadcast'}
+MESSAGE_LIMIT = 4096   # длина текста сообщения в Telegram
+
+
+def split_text(parts, sep="\n", limit=MESSAGE_LIMIT):
+    """Склеивает части в тексты не длиннее limit, не разрывая часть (слишком длинная обрезается)."""
+    chunks, current = [], ""
+    for part in parts:
+        part = part[:limit]
+        if current and len(current) + len(sep) + len(part) > limit:
+            chunks.append(current)
+            current = part
+        else:
+            current = current + sep + part if current else part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _settle(future, result=None, error=None):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class _Job:
+    __slots__ = ('priority', 'fn', 'args', 'kwargs', 'future', 'enqueued', 'attempts')
+
+    def __init__(self, priority, fn, args, kwargs, future):
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+class _Chat:
+    __slots__ = ('jobs', 'bucket', 'scheduled')
+
+    def __init__(self, rate, burst):
+        self.jobs = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.scheduled = False  # стоит в куче готовых или ждёт таймера/в полёте
+
+
+class SendScheduler:
+    def __init__(self, global_rate=28.0, chat_rate=1.0, chat_burst=5, workers=8, max_retries=3, latency_window=1000):
+        self.bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._chats = {}
+        self._ready = []                 # (priority, seq, chat_id)
+        self._seq = itertools.count()
+        self._depth = {lane: 0 for lane in LANE_NAMES}
+        self._latencies = deque(maxlen=latency_window)  # от постановки в очередь до ответа API
+        self._wakeup = None
+        self._tasks = []
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=5.0):
+        """Даёт очередям опустеть (не дольше timeout), потом останавливает воркеров."""
+        deadline = time.monotonic() + timeout
+        while sum(self._depth.values()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def call(self, chat_id:int, fn, *args, priority=NOTIFY, **kwargs):
+        """Ставит fn(*args, **kwargs) в очередь чата. Возвращает future с результатом или исключением."""
+        future = asyncio.get_running_loop().create_future()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(self.chat_rate, self.chat_burst)
+        chat.jobs.append(_Job(priority, fn, args, kwargs, future))
+        self._depth[priority] += 1
+        if not chat.scheduled:
+            self._schedule(chat_id, chat)
+        return future
+
+    # ---------------------------
+    # Планирование
+    # ---------------------------
+    def _schedule(self, chat_id, chat):
+        chat.scheduled = True
+        wait = chat.bucket.try_take()
+        if wait:
+            asyncio.get_running_loop().call_later(wait, self._schedule, chat_id, chat)
+            return
+        heapq.heappush(self._ready, (chat.jobs[0].priority, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    async def _next_chat(self):
+        while not self._ready:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        return heapq.heappop(self._ready)[2]
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._next_chat()
+            await self.bucket.acquire()
+            chat = self._chats[chat_id]
+            job = chat.jobs.popleft()
+            self._depth[job.priority] -= 1
+            try:
+                await self._send(chat, job)
+            except Exception:
+                logger.exception("Outbound worker error")
+            if chat.jobs:
+                self._schedule(chat_id, chat)
+            else:
+                chat.scheduled = False
+                if chat.bucket.full():
+                    del self._chats[chat_id]
+                else:
+                    asyncio.get_running_loop().call_later(self.chat_burst / self.chat_rate, self._forget, chat_id)
+
+    def _forget(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is not None and not chat.jobs and not chat.scheduled:
+            del self._chats[chat_id]
+
+    async def _send(self, chat, job):
+        if job.future.cancelled():
+            return
+        try:
+            result = await job.fn(*job.args, **job.kwargs)
+        except exceptions.RetryAfter as e:
+            job.attempts += 1
+            if job.attempts > self.max_retries:
+                self.failed += 1
+                _settle(job.future, error=e)
+                return
+            self.retried += 1
+            logger.warning("Flood control, retry in %ss", e.timeout)
+            chat.jobs.appendleft(job)
+            self._depth[job.priority] += 1
+            chat.bucket.pause(e.timeout)
+        except Exception as e:
+            self.failed += 1
+            _settle(job.future, error=e)
+        else:
+            self.sent += 1
+            self._latencies.append(time.monotonic() - job.enqueued)
+            _settle(job.future, result=result)
+
+    # ---------------------------
+    # Метрики
+    # ---------------------------
+    def stats(self):
+        lat = sorted(self._latencies)
+
+        def pct(p):
+            return lat[min(len(lat) - 1, int(len(lat) * p))] if lat else 0.0
+
+        return {
+            "depth": {LANE_NAMES[lane]: n for lane, n in self._depth.items()},
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_p50": pct(0.5),
+            "latency_p95": pct(0.95),
+            "latency_max": lat[-1] if lat else 0.0,
+        }
@@ -0,0 +1,117 @@
+# coding: utf-8
+"""
+Ограничители скорости.
+"""
+
+import time
+import asyncio
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate:float, capacity:float=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n=1):
+        """Берёт n токенов. Возвращает 0, если получилось, иначе сколько секунд подождать."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+    async def acquire(self, n=1):
+        while True:
+            wait = self.try_take(n)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def full(self):
+        """Ведро полное и не на паузе — состояние ничем не отличается от нового."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def pause(self, seconds:float):
+        """Полная остановка выдачи (например, по RetryAfter от Telegram)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+class RateLimiter:
+    """
+    Token bucket на пользователя в каждой области (scope): сообщения, колбэки, вход в очередь...
+    Состояние — [tokens, updated] на пользователя, O(1) память.
+    Записи, которые успели наполниться до capacity, ничем не отличаются от новых —
+    evict_idle() их выбрасывает.
+    """
+
+    def __init__(self, scopes:dict, evict_interval=60.0, throttle_window=60.0):
+        """scopes: {scope: (limit, period_seconds)}, например {'messages': (20, 60)}."""
+        self.scopes = {name: (limit / period, float(limit)) for name, (limit, period) in scopes.items()}
+        self.evict_interval = evict_interval
+        self.throttle_window = throttle_window
+        self._state = {name: {} for name in scopes}
+        self._throttled = {}  # uid -> когда последний раз упёрся в лимит
+        self._last_evict = time.monotonic()
+
+    def hit(self, scope:str, uid:int):
+        """Списывает токен. True — пользователь превысил лимит."""
+        rate, capacity = self.scopes[scope]
+        now = time.monotonic()
+        if now - self._last_evict >= self.evict_interval:
+            self.evict_idle(now)
+        buckets = self._state[scope]
+        state = buckets.get(uid)
+        if state is None:
+            buckets[uid] = [capacity - 1, now]
+            return False
+        tokens = min(capacity, state[0] + (now - state[1]) * rate)
+        state[1] = now
+        if tokens < 1:
+            state[0] = tokens
+            self._throttled[uid] = now
+            return True
+        state[0] = tokens - 1
+        return False
+
+    def evict_idle(self, now=None):
+        now = now if now is not None else time.monotonic()
+        self._last_evict = now
+        removed = 0
+        for name, buckets in self._state.items():
+            rate, capacity = self.scopes[name]
+            idle = [uid for uid, (tokens, updated) in buckets.items()
+                    if tokens + (now - updated) * rate >= capacity]
+            for uid in idle:
+                del buckets[uid]
+            removed += len(idle)
+        expired = [uid for uid, ts in self._throttled.items() if now - ts > self.throttle_window]
+        for uid in expired:
+            del self._throttled[uid]
+        return removed
+
+    def recently_throttled(self, uid:int, within:float):
+        ts = self._throttled.get(uid)
+        return ts is not None and time.monotonic() - ts < within
+
+    def stats(self):
+        now = time.monotonic()
+        throttled = sum(1 for ts in self._throttled.values() if now - ts <= self.throttle_window)
+        tracked = {name: len(buckets) for name, buckets in self._state.items()}
+        return {"throttled": throttled, "tracked": tracked}
@@ -0,0 +1,227 @@
+# coding: utf-8
+"""
+Где живёт очередь поиска и кто с кем в паре.
+
+LocalState — один процесс: очередь в Matcher (память), search_queue в БД только для
+восстановления после рестарта.
+SharedSQLiteState — несколько процессов-воркеров над одной БД в WAL: очередь и пары
+живут только в SQLite, подбор пары — одна транзакция писателя (BEGIN IMMEDIATE),
+поэтому два воркера не заберут одного кандидата. Кэшировать строки users в этом
+режиме нельзя: партнёра может поменять воркер другого пользователя.
+"""
+
+import time
+import logging
+
+from matcher import Matcher, sex_filters
+
+logger = logging.getLogger(__name__)
+
+UPSERT_QUEUE_SQL = """INSERT INTO search_queue (user_id, sex_filter, queued_at) VALUES (?, ?, ?)
+                      ON CONFLICT(user_id) DO UPDATE SET sex_filter = excluded.sex_filter,
+                                                         queued_at = excluded.queued_at"""
+
+
+class LocalState:
+    shared = False
+    caches_users = True
+
+    def __init__(self, storage, matcher=None):
+        self.storage = storage
+        self.matcher = matcher or Matcher()
+
+    def __len__(self):
+        return len(self.matcher)
+
+    async def _sync(self, remove=(), add=None):
+        remove = list(remove) + self.matcher.take_dropped()
+        if not remove and add is None:
+            return
+        def _tx(conn):
+            if remove:
+                conn.executemany("DELETE FROM search_queue WHERE user_id = ?", [(u,) for u in remove])
+            if add is not None:
+                conn.execute(UPSERT_QUEUE_SQL, (add[0], add[1], time.time()))
+        await self.storage.transaction(_tx, label="sync search_queue")
+
+    async def load(self):
+        m = self.matcher
+        for (uid,) in await self.storage.read("SELECT id FROM users WHERE vip = 1"):
+            m.set_vip(uid, True)
+        for (uid,) in await self.storage.read("SELECT id FROM users WHERE banned = 1"):
+            m.set_banned(uid, True)
+        for (uid,) in await self.storage.read("SELECT id FROM users WHERE partner IS NOT NULL"):
+            m.set_busy(uid, True)
+        for uid, sex_filter, interests, age in await self.storage.read(
+                """SELECT q.user_id, q.sex_filter, u.interests, u.age FROM search_queue q
+                   LEFT JOIN users u ON u.id = q.user_id ORDER BY q.queued_at ASC"""):
+            if m.eligible(uid):
+                m.add(uid, sex_filter, profile=(interests.split(',') if interests else [], age))
+        logger.info("Matcher restored: %d queued", len(m))
+
+    async def enqueue(self, uid:int, sex_filter:str, profile=None):
+        self.matcher.add(uid, sex_filter, profile)
+        await self._sync(add=(uid, sex_filter))
+
+    async def dequeue(self, uid:int):
+        self.matcher.remove(uid)
+        await self._sync(remove=[uid])
+
+    def drop(self, uid:int):
+        """Только из памяти: search_queue чистит вызывающий (см. Sweeper)."""
+        self.matcher.remove(uid)
+
+    async def pop(self, sex_filter:str, exclude=None):
+        cid = self.matcher.pop(sex_filter, exclude=exclude)
+        await self._sync(remove=[cid] if cid is not None else [])
+        return cid
+
+    async def match(self, uid:int, sex_filter:str, profile=None):
+        """Атомарно подбирает пару или ставит uid в очередь. Возвращает кандидата или None.
+        profile — (interests, age), нужен для подбора по интересам."""
+        candidate = self.matcher.match(uid, sex_filter, profile)
+        if candidate is None:
+            await self._sync(add=(uid, sex_filter))
+        else:
+            await self._sync(remove=[uid, candidate])
+        return candidate
+
+    async def rematch(self):
+        """Пары для тех, кто дождался конца ожидания по профилю (см. Matcher.rematch)."""
+        pairs = self.matcher.rematch()
+        await self._sync(remove=[u for pair in pairs for u in pair])
+        return pairs
+
+    def set_profile(self, uid:int, interests=None, age=None):
+        self.matcher.set_profile(uid, interests, age)
+
+    def set_busy(self, uid:int, busy:bool):
+        self.matcher.set_busy(uid, busy)
+
+    async def set_vip(self, uid:int, vip:bool):
+        self.matcher.set_vip(uid, vip)
+
+    async def set_banned(self, uid:int, banned:bool, persist=True):
+        """persist=False — из search_queue уже удалено вызывающим (массовый бан одной транзакцией)."""
+        self.matcher.set_banned(uid, banned)
+        if banned and persist:
+            await self._sync(remove=[uid])
+
+    async def reload_flags(self):
+        """vip/banned заново из БД (после загрузки users из файла)."""
+        m = self.matcher
+        vip = {uid for (uid,) in await self.storage.read("SELECT id FROM users WHERE vip = 1")}
+        banned = {uid for (uid,) in await self.storage.read("SELECT id FROM users WHERE banned = 1")}
+        for uid in (m._vip | vip):
+            m.set_vip(uid, uid in vip)
+        removed = [uid for uid in banned - m._banned if uid in m]
+        for uid in (m._banned | banned):
+            m.set_banned(uid, uid in banned)
+        await self._sync(remove=removed)
+
+
+class SharedSQLiteState:
+    shared = True
+    caches_users = False
+
+    # VIP ищем от частичного индекса idx_users_vip (CROSS JOIN фиксирует порядок обхода),
+    # остальных — по idx_search_queue_filter_time до первого пригодного; IS NOT, а не != —
+    # иначе при exclude=None сравнение с NULL ложно и никто не подбирается
+    VIP_SQL = """SELECT q.user_id FROM users u CROSS JOIN search_queue q ON q.user_id = u.id
+                 WHERE u.vip = 1 AND q.sex_filter = ? AND q.user_id IS NOT ? AND u.banned = 0 AND u.partner IS NULL
+                 ORDER BY q.queued_at ASC LIMIT 1"""
+    FIFO_SQL = """SELECT q.user_id FROM search_queue q JOIN users u ON u.id = q.user_id
+                  WHERE q.sex_filter = ? AND q.user_id IS NOT ? AND u.banned = 0 AND u.partner IS NULL
+                  ORDER BY q.queued_at ASC LIMIT 1"""
+
+    def __init__(self, storage, count_interval=5.0):
+        self.storage = storage
+        self.count_interval = count_interval
+        self._queued = 0
+        self._counted_at = 0.0
+
+    def __len__(self):
+        # для gauge: COUNT(*) делаем не чаще count_interval внутри уже идущих транзакций
+        return self._queued
+
+    def _recount(self, conn):
+        now = time.monotonic()
+        if now - self._counted_at >= self.count_interval:
+            self._counted_at = now
+            self._queued = conn.execute("SELECT COUNT(*) FROM search_queue").fetchone()[0]
+
+    def _pop(self, conn, sex_filter, exclude):
+        row = (conn.execute(self.VIP_SQL, (sex_filter, exclude)).fetchone()
+               or conn.execute(self.FIFO_SQL, (sex_filter, exclude)).fetchone())
+        if row is None:
+            return None
+        conn.execute("DELETE FROM search_queue WHERE user_id = ?", (row[0],))
+        return row[0]
+
+    async def load(self):
+        rows = await self.storage.read("SELECT COUNT(*) FROM search_queue")
+        self._queued = rows[0][0] if rows else 0
+        self._counted_at = time.monotonic()
+
+    async def enqueue(self, uid:int, sex_filter:str, profile=None):
+        def _tx(conn):
+            conn.execute(UPSERT_QUEUE_SQL, (uid, sex_filter, time.time()))
+            self._recount(conn)
+        await self.storage.transaction(_tx, label="enqueue")
+
+    async def dequeue(self, uid:int):
+        await self.storage.write("DELETE FROM search_queue WHERE user_id = ?", (uid,))
+
+    def drop(self, uid:int):
+        pass
+
+    async def pop(self, sex_filter:str, exclude=None):
+        return await self.storage.transaction(lambda conn: self._pop(conn, sex_filter, exclude), label="pop")
+
+    async def match(self, uid:int, sex_filter:str, profile=None):
+        # подбор по интересам здесь не поддерживается — только FIFO (VIP первыми)
+        def _tx(conn):
+            conn.execute("DELETE FROM search_queue WHERE user_id = ?", (uid,))
+            for f in sex_filters(sex_filter):
+                candidate = self._pop(conn, f, uid)
+                if candidate is not None:
+                    return candidate
+            conn.execute(UPSERT_QUEUE_SQL, (uid, sex_filter, time.time()))
+            self._recount(conn)
+            return None
+        return await self.storage.transaction(_tx, label="match")
+
+    async def rematch(self):
+        return []
+
+    def set_profile(self, uid:int, interests=None, age=None):
+        pass
+
+    def set_busy(self, uid:int, busy:bool):
+        # занятость — это users.partner, отдельно хранить нечего
+        pass
+
+    async def set_vip(self, uid:int, vip:bool):
+        pass
+
+    async def set_banned(self, uid:int, banned:bool, persist=True):
+        if banned and persist:
+            await self.dequeue(uid)
+
+    async def reload_flags(self):
+        # флаги читаются из БД при каждом подборе
+        pass
+
+
+STATE_BACKENDS = {'local': LocalState, 'sqlite': SharedSQLiteState}
+
+
+def make_state(name:str, storage, matcher_options=None):
+    """matcher_options — аргументы Matcher для LocalState (by_profile, wait, ...)."""
+    if name not in STATE_BACKENDS:
+        raise RuntimeError(f"Unknown STATE_BACKEND {name!r}, expected one of: {', '.join(STATE_BACKENDS)}")
+    if name == 'local':
+        return LocalState(storage, Matcher(**(matcher_options or {})))
+    if matcher_options and matcher_options.get('by_profile'):
+        logger.warning("STATE_BACKEND=%s matches FIFO only, MATCH_BY_INTERESTS is ignored", name)
+    return STATE_BACKENDS[name](storage)
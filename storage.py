@@ -0,0 +1,209 @@
+# coding: utf-8
+"""
+Хранилище SQLite с долгоживущими соединениями.
+WAL, один поток-писатель с групповым коммитом, пул читателей,
+кэш подготовленных выражений на каждом соединении.
+"""
+
+import time
+import queue
+import sqlite3
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def connect(path: str, cached_statements=256):
+    # isolation_level=None: транзакциями управляем сами (BEGIN/COMMIT)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                           cached_statements=cached_statements)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def _run_statement(conn, query, params, fetch, many):
+    cur = conn.cursor()
+    if many:
+        cur.executemany(query, params)
+    else:
+        cur.execute(query, params)
+    if fetch:
+        return cur.fetchall()
+    return None
+
+
+def _is_read(query: str, many: bool):
+    return not many and query.lstrip()[:6].upper() == "SELECT"
+
+
+def _resolve(fut, result, error):
+    if fut.cancelled():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+
+class Storage:
+    """
+    Все записи идут через один поток: задания из очереди собираются в пачку
+    и коммитятся одной транзакцией (каждое — в своём SAVEPOINT, чтобы ошибка
+    одного не откатывала остальные). Чтения выполняются в пуле потоков,
+    у каждого потока своё соединение.
+    """
+
+    def __init__(self, path: str, readers=4, batch_size=256, commit_delay=0.0, cached_statements=256, observer=None):
+        """observer(kind, sql, wait, exec) вызывается в event loop после каждого запроса:
+        wait — ожидание потока (пула читателей или писателя), exec — выполнение (для записи — вместе с коммитом)."""
+        self.path = path
+        self.observer = observer
+        self.batch_size = batch_size
+        self.commit_delay = commit_delay
+        self.cached_statements = cached_statements
+        self.commits = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._closed = False
+        self._writer.start()
+
+    # ---------------------------
+    # Публичный async API
+    # ---------------------------
+    async def execute(self, query, params=(), fetch=False, many=False):
+        if _is_read(query, many):
+            return await self.read(query, params)
+        return await self.write(query, params, fetch=fetch, many=many)
+
+    async def read(self, query, params=()):
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        rows, started, finished = await loop.run_in_executor(self._readers, self._read, query, params)
+        if self.observer:
+            self.observer('read', query, started - submitted, finished - started)
+        return rows
+
+    async def read_with(self, fn, label=None):
+        """fn(conn) в потоке читателя — для длинных чтений курсором (выгрузки), не держит писателя."""
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        result, started, finished = await loop.run_in_executor(self._readers, self._read_with, fn)
+        if self.observer:
+            self.observer('read', label or getattr(fn, '__qualname__', 'read_with'),
+                          started - submitted, finished - started)
+        return result
+
+    async def write(self, query, params=(), fetch=False, many=False):
+        return await self.transaction(lambda conn: _run_statement(conn, query, params, fetch, many), label=query)
+
+    async def transaction(self, fn, label=None):
+        """fn(conn) выполняется в потоке писателя внутри общей транзакции. label — как показывать в метриках."""
+        if self._closed:
+            raise RuntimeError("Storage is closed")
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        timing = [time.perf_counter(), 0.0, 0.0]  # поставлено, начато, закоммичено
+        self._queue.put((fn, fut, loop, timing))
+        try:
+            return await fut
+        finally:
+            if self.observer and timing[1] and timing[2]:
+                self.observer('write', label or getattr(fn, '__qualname__', 'transaction'),
+                              timing[1] - timing[0], timing[2] - timing[1])
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+
+    # ---------------------------
+    # Потоки
+    # ---------------------------
+    def _reader_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.path, self.cached_statements)
+            self._local.conn = conn
+        return conn
+
+    def _read(self, query, params):
+        started = time.perf_counter()
+        rows = self._reader_conn().execute(query, params).fetchall()
+        return rows, started, time.perf_counter()
+
+    def _read_with(self, fn):
+        started = time.perf_counter()
+        result = fn(self._reader_conn())
+        return result, started, time.perf_counter()
+
+    def _writer_loop(self):
+        conn = connect(self.path, self.cached_statements)
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    if self.commit_delay:
+                        item = self._queue.get(timeout=self.commit_delay)
+                    else:
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit_batch(conn, batch)
+        conn.close()
+
+    def _commit_batch(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, fut, loop, timing in batch:
+                timing[1] = time.perf_counter()
+                conn.execute("SAVEPOINT job")
+                try:
+                    res = fn(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((fut, loop, None, e))
+                else:
+                    conn.execute("RELEASE job")
+                    results.append((fut, loop, res, None))
+            conn.execute("COMMIT")
+        except Exception as e:
+            logger.exception("DB group commit failed: %s", e)
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            done = {id(r[0]) for r in results}
+            results = [(fut, loop, None, e) for fut, loop, res, err in results]
+            results += [(fut, loop, None, e) for fn, fut, loop, timing in batch if id(fut) not in done]
+        committed = time.perf_counter()
+        for job in batch:
+            job[3][2] = committed
+        self.commits += 1
+        self.writes += len(batch)
+        for fut, loop, res, err in results:
+            try:
+                loop.call_soon_threadsafe(_resolve, fut, res, err)
+            except RuntimeError:
+                # цикл уже закрыт — ответ некому отдавать
+                pass
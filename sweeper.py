@@ -0,0 +1,249 @@
+# coding: utf-8
+"""
+Истечение ожидания в очереди и брошенных диалогов.
+Сроки лежат в хешированном колесе таймеров: запись попадает в слот по времени
+срабатывания, каждый тик просматривает один слот, так что стоимость тика зависит от
+числа сроков в слоте, а не от размера очереди или числа диалогов. Активность в диалоге
+только обновляет время в словаре; сработавший таймер сверяется с ним и при свежей
+активности переставляется заново.
+Всё истёкшее за тик чистится одной транзакцией (search_queue, users.partner, conv_state);
+условия в UPDATE/DELETE не дают снять то, что успело поменяться (повторная постановка,
+новый диалог). В кластере (shared) активность видна частями разным воркерам, поэтому
+она с прореживанием пишется в users.last_active и проверяется в той же транзакции.
+"""
+
+import math
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SLACK = 5.0  # queued_at в БД пишется чуть позже, чем время постановки в памяти
+
+
+class TimerWheel:
+    def __init__(self, tick=1.0, slots=512, now=None):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]   # слот -> {key: deadline}
+        self._where = {}                          # key -> номер слота
+        self._cursor = 0
+        self._time = time.time() if now is None else now
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, deadline):
+        """Ставит (или переставляет) срок key."""
+        self.cancel(key)
+        ticks = max(1, math.ceil((deadline - self._time) / self.tick))
+        slot = (self._cursor + ticks) % len(self._slots)
+        self._slots[slot][key] = deadline
+        self._where[key] = slot
+
+    def cancel(self, key):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def advance(self, now):
+        """Прокручивает колесо до now. Возвращает ключи, чей срок наступил."""
+        ticks = int((now - self._time) // self.tick)
+        if ticks <= 0:
+            return []
+        expired = []
+        count = len(self._slots)
+        # после долгой паузы хватает одного оборота: в нём просмотрены все слоты
+        for step in range(1, min(ticks, count) + 1):
+            bucket = self._slots[(self._cursor + step) % count]
+            for key in [k for k, deadline in bucket.items() if deadline <= now]:
+                del bucket[key]
+                del self._where[key]
+                expired.append(key)
+        self._cursor = (self._cursor + ticks) % count
+        self._time += ticks * self.tick
+        return expired
+
+
+class Sweeper:
+    def __init__(self, storage, on_expired, queue_ttl=600.0, dialog_idle=1800.0, tick=1.0,
+                 slots=512, batch=200, shared=False, persist_every=None, drop=None):
+        """
+        on_expired(queue_uids, pairs) — корутина: уведомить пользователей и обновить кэши,
+        в БД к этому моменту всё уже снято. drop(uid) — убрать из очереди в памяти (до транзакции,
+        чтобы не снять повторную постановку). queue_ttl / dialog_idle = 0 — не снимать.
+        """
+        self.storage = storage
+        self.on_expired = on_expired
+        self.drop = drop
+        self.queue_ttl = queue_ttl
+        self.dialog_idle = dialog_idle
+        self.batch = batch
+        self.shared = shared
+        self.persist_every = persist_every if persist_every is not None else dialog_idle / 4
+        self.wheel = TimerWheel(tick, slots)
+        self.expired_queue = 0
+        self.expired_dialogs = 0
+        self._queued = {}    # uid -> когда встал в очередь
+        self._dialogs = {}   # (меньший id, больший id) -> последняя активность
+        self._written = {}   # uid -> когда last_active последний раз записан в БД (shared)
+        self._task = None
+
+    # ---------------------------
+    # Учёт сроков
+    # ---------------------------
+    def track_queue(self, uid:int, now=None):
+        if not self.queue_ttl:
+            return
+        now = now or time.time()
+        self._queued[uid] = now
+        self.wheel.schedule(('q', uid), now + self.queue_ttl)
+
+    def forget_queue(self, uid:int):
+        if self._queued.pop(uid, None) is not None:
+            self.wheel.cancel(('q', uid))
+
+    def track_dialog(self, u1:int, u2:int, now=None):
+        if not self.dialog_idle:
+            return
+        pair = (min(u1, u2), max(u1, u2))
+        now = now or time.time()
+        self._dialogs[pair] = now
+        self.wheel.schedule(('d',) + pair, now + self.dialog_idle)
+
+    def forget_dialog(self, u1:int, u2:int):
+        pair = (min(u1, u2), max(u1, u2))
+        if self._dialogs.pop(pair, None) is not None:
+            self.wheel.cancel(('d',) + pair)
+        for uid in pair:
+            self._written.pop(uid, None)
+
+    async def touch(self, uid:int, partner:int):
+        """Активность в диалоге: в памяти — всегда, в users.last_active — не чаще persist_every."""
+        if not self.dialog_idle:
+            return
+        pair = (min(uid, partner), max(uid, partner))
+        now = time.time()
+        if pair in self._dialogs:
+            self._dialogs[pair] = now
+        else:
+            # диалог начат на другом воркере или до рестарта
+            self.track_dialog(uid, partner, now)
+        if self.shared and now - self._written.get(uid, 0) >= self.persist_every:
+            self._written[uid] = now
+            await self.storage.write("UPDATE users SET last_active = ? WHERE id = ?", (now, uid))
+
+    async def load(self, owns=None):
+        """Сроки по текущим данным; owns(uid) — какие пользователи относятся к этому процессу."""
+        owns = owns or (lambda uid: True)
+        now = time.time()
+        if self.queue_ttl:
+            for uid, queued_at in await self.storage.read("SELECT user_id, queued_at FROM search_queue"):
+                if owns(uid):
+                    self._queued[uid] = queued_at or now
+                    self.wheel.schedule(('q', uid), max(queued_at or now, now - self.queue_ttl) + self.queue_ttl)
+        if self.dialog_idle:
+            # когда в них писали последний раз, неизвестно — отсчёт с рестарта
+            for u1, u2 in await self.storage.read(
+                    "SELECT id, partner FROM users WHERE partner IS NOT NULL AND id < partner"):
+                if owns(u1):
+                    self.track_dialog(u1, u2, now)
+        logger.info("Sweeper loaded: %d queued, %d dialogs", len(self._queued), len(self._dialogs))
+
+    # ---------------------------
+    # Тик
+    # ---------------------------
+    def _due(self, now):
+        queue_uids, pairs = [], []
+        for key in self.wheel.advance(now):
+            if key[0] == 'q':
+                queued_at = self._queued.get(key[1])
+                if queued_at is None:
+                    continue
+                if queued_at + self.queue_ttl > now:
+                    self.wheel.schedule(key, queued_at + self.queue_ttl)
+                elif len(queue_uids) + len(pairs) >= self.batch:
+                    self.wheel.schedule(key, now)   # в следующий тик
+                else:
+                    queue_uids.append(key[1])
+            else:
+                pair = key[1:]
+                last = self._dialogs.get(pair)
+                if last is None:
+                    continue
+                if last + self.dialog_idle > now:
+                    self.wheel.schedule(key, last + self.dialog_idle)
+                elif len(queue_uids) + len(pairs) >= self.batch:
+                    self.wheel.schedule(key, now)
+                else:
+                    pairs.append(pair)
+        return queue_uids, pairs
+
+    def _expire_tx(self, conn, queue_uids, pairs, now):
+        queue_cutoff = now - self.queue_ttl + QUEUE_SLACK
+        # last_active пишется с прореживанием: реальная активность могла быть до persist_every позже
+        active_cutoff = now - self.dialog_idle - self.persist_every
+        expired_queue, expired_pairs, busy = [], [], []
+        for uid in queue_uids:
+            if conn.execute("DELETE FROM search_queue WHERE user_id = ? AND queued_at <= ? RETURNING user_id",
+                            (uid, queue_cutoff)).fetchall():
+                conn.execute("UPDATE users SET conv_state = 'idle' WHERE id = ? AND conv_state = 'searching'", (uid,))
+                expired_queue.append(uid)
+        for u1, u2 in pairs:
+            if self.shared and conn.execute(
+                    "SELECT COUNT(*) FROM users WHERE id IN (?, ?) AND last_active >= ?",
+                    (u1, u2, active_cutoff)).fetchone()[0]:
+                busy.append((u1, u2))
+                continue
+            cleared = conn.executemany("UPDATE users SET partner = NULL, conv_state = 'idle' WHERE id = ? AND partner = ?",
+                                       [(u1, u2), (u2, u1)]).rowcount
+            if cleared:
+                expired_pairs.append((u1, u2, cleared))
+        return expired_queue, expired_pairs, busy
+
+    async def sweep(self, now=None):
+        now = now or time.time()
+        queue_uids, pairs = self._due(now)
+        for uid in queue_uids:
+            self._queued.pop(uid, None)
+            if self.drop:
+                self.drop(uid)
+        for pair in pairs:
+            del self._dialogs[pair]
+        if not queue_uids and not pairs:
+            return [], []
+        expired_queue, expired_pairs, busy = await self.storage.transaction(
+            lambda conn: self._expire_tx(conn, queue_uids, pairs, now), label="sweep expired")
+        for u1, u2 in busy:
+            # собеседник пишет через другой воркер — ждём дальше
+            self.track_dialog(u1, u2, now)
+        for u1, u2, _ in expired_pairs:
+            for uid in (u1, u2):
+                self._written.pop(uid, None)
+        self.expired_queue += len(expired_queue)
+        self.expired_dialogs += len(expired_pairs)
+        if expired_queue or expired_pairs:
+            await self.on_expired(expired_queue, expired_pairs)
+        return expired_queue, expired_pairs
+
+    # ---------------------------
+    # Фоновый цикл
+    # ---------------------------
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Sweep failed")
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
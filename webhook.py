@@ -0,0 +1,191 @@
+# coding: utf-8
+"""
+Режим вебхука на aiohttp (и воркер кластера — тот же сервер на unix-сокете).
+Апдейты обрабатываются параллельно (не больше limit одновременно), но апдейты
+одного пользователя — строго по очереди. При остановке сервер перестаёт
+принимать запросы и дожидается обработки уже принятых апдейтов.
+"""
+
+import asyncio
+import logging
+from collections import deque
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+logger = logging.getLogger(__name__)
+
+
+USER_EVENTS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+               'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request')
+CHAT_EVENTS = ('channel_post', 'edited_channel_post')
+
+
+def update_key(update: types.Update):
+    """Ключ очереди: id пользователя, от которого пришёл апдейт (или id апдейта, если его нет)."""
+    for name in USER_EVENTS:
+        event = getattr(update, name, None)
+        if event is not None and getattr(event, 'from_user', None) is not None:
+            return event.from_user.id
+    for name in CHAT_EVENTS:
+        event = getattr(update, name, None)
+        if event is not None:
+            return event.chat.id
+    return update.update_id
+
+
+def raw_update_key(data: dict):
+    """То же, что update_key, но по сырому JSON апдейта (без разбора в types.Update)."""
+    for name in USER_EVENTS:
+        event = data.get(name)
+        if event and event.get('from'):
+            return event['from']['id']
+    for name in CHAT_EVENTS:
+        event = data.get(name)
+        if event:
+            return event['chat']['id']
+    return data['update_id']
+
+
+class KeyedRunner:
+    """Очередь на ключ + общий семафор: порядок внутри ключа, параллельность между ключами."""
+
+    def __init__(self, handler, limit=64):
+        self.handler = handler
+        self.limit = limit
+        self._sem = asyncio.Semaphore(limit)
+        self._queues = {}
+        self._tasks = set()
+        self.processed = 0
+        self.failed = 0
+
+    def pending(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def submit(self, key, item):
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(item)
+            return
+        queue = self._queues[key] = deque([item])
+        task = asyncio.ensure_future(self._drain_key(key, queue))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain_key(self, key, queue):
+        try:
+            while queue:
+                item = queue.popleft()
+                async with self._sem:
+                    try:
+                        await self.handler(item)
+                        self.processed += 1
+                    except Exception:
+                        self.failed += 1
+                        logger.exception("Update handler failed")
+        finally:
+            del self._queues[key]
+
+    async def drain(self, timeout=30.0):
+        """Ждёт завершения всех принятых апдейтов (не дольше timeout)."""
+        if not self._tasks:
+            return True
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        if pending:
+            logger.warning("Webhook drain timeout: %d users still in progress", len(pending))
+            for task in pending:
+                task.cancel()
+        return not pending
+
+
+def make_app(dp: Dispatcher, path: str, concurrency=64, secret=None):
+    runner = KeyedRunner(dp.process_update, limit=concurrency)
+
+    async def handle(request: web.Request):
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=403)
+        if request.app['closing']:
+            return web.Response(status=503)
+        update = types.Update(**(await request.json()))
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+        runner.submit(update_key(update), update)
+        # отвечаем сразу: Telegram не ждёт обработки и не ретраит апдейт
+        return web.Response()
+
+    app = web.Application()
+    app['runner'] = runner
+    app['closing'] = False
+    app.router.add_post(path, handle)
+    return app
+
+
+def make_worker_app(dp: Dispatcher, path='/updates', concurrency=64, max_pending=1000):
+    """Приём пачек апдейтов от приёмника cluster.py (JSON-массив, уже разложенный по пользователям)."""
+    runner = KeyedRunner(dp.process_update, limit=concurrency)
+
+    async def handle(request: web.Request):
+        if request.app['closing']:
+            return web.Response(status=503)
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+        for data in await request.json():
+            update = types.Update(**data)
+            runner.submit(update_key(update), update)
+        # обратное давление: следующую пачку приёмник пришлёт, когда воркер разгребётся
+        while runner.pending() > max_pending:
+            await asyncio.sleep(0.01)
+        return web.Response()
+
+    app = web.Application()
+    app['runner'] = runner
+    app['closing'] = False
+    app.router.add_post(path, handle)
+    return app
+
+
+def _lifecycle(app, dp: Dispatcher, on_startup=None, on_shutdown=None, drain_timeout=30.0, after_startup=None):
+    async def _startup(app):
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+        if on_startup:
+            await on_startup(dp)
+        if after_startup:
+            await after_startup()
+
+    async def _shutdown(app):
+        app['closing'] = True
+        await app['runner'].drain(drain_timeout)
+        if on_shutdown:
+            await on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(_startup)
+    app.on_shutdown.append(_shutdown)
+
+
+def run_webhook(dp: Dispatcher, webhook_url: str, path: str, host: str, port: int,
+                concurrency=64, secret=None, on_startup=None, on_shutdown=None, drain_timeout=30.0, loop=None):
+    app = make_app(dp, path, concurrency=concurrency, secret=secret)
+
+    async def set_webhook():
+        await dp.bot.set_webhook(webhook_url + path, secret_token=secret)
+        logger.info("Webhook set to %s%s, serving on %s:%s", webhook_url, path, host, port)
+
+    _lifecycle(app, dp, on_startup, on_shutdown, drain_timeout, after_startup=set_webhook)
+    web.run_app(app, host=host, port=port, shutdown_timeout=drain_timeout, loop=loop)
+
+
+def run_worker(dp: Dispatcher, socket_path: str, concurrency=64, max_pending=1000,
+               on_startup=None, on_shutdown=None, drain_timeout=30.0, loop=None):
+    """Воркер кластера: слушает unix-сокет, апдейты ему раздаёт приёмник (см. cluster.py)."""
+    app = make_worker_app(dp, concurrency=concurrency, max_pending=max_pending)
+
+    async def ready():
+        logger.info("Worker serving on %s", socket_path)
+
+    _lifecycle(app, dp, on_startup, on_shutdown, drain_timeout, after_startup=ready)
+    web.run_app(app, path=socket_path, shutdown_timeout=drain_timeout, loop=loop, print=None)